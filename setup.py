@@ -76,6 +76,10 @@ setup(
     entry_points='''
     [paste.filter_app_factory]
     longrequest= cipher.longrequest.longrequest:make_filter
+    [console_scripts]
+    cipher-longrequest-replay = cipher.longrequest.capture:main
+    cipher-longrequest-benchmark = cipher.longrequest.benchmark:main
+    cipher-longrequest-loadtest = cipher.longrequest.loadtest:main
     [distutils.commands]
     ftest = zope.testrunner.eggsupport:ftest
     '''
@@ -0,0 +1,302 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks of the checker thread hot path
+
+Runs `RequestCheckerThread.doWork` against synthetic thread pools and
+reports, per tick, the CPU time, the peak of allocated memory and the
+latency imposed on a probe thread standing in for the workers, i.e. how
+long the checker holds the GIL.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import math
+import re
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+import zope.component
+# make sure events get dispatched to the component registry
+import zope.component.event  # noqa: F401 imported but unused
+
+from cipher.longrequest import interfaces
+from cipher.longrequest import longrequest
+
+
+THREADS = (10, 100, 1000)
+PATTERNS = (0, 50, 500)
+VERBOSE = (False, True)
+
+# share of the synthetic requests over the first level, keep it low,
+# verbose cold ticks cost O(slow threads * threads)
+SLOW_FRACTION = 0.01
+
+# number of extra HTTP headers in a synthetic environment
+ENVIRON_HEADERS = 30
+
+# compared in baselines, lower is better
+METRICS = ('cpu_cold', 'cpu_warm', 'alloc_peak', 'probe_latency')
+
+HANDLERS = (
+    (longrequest.addLogEntryInfo, interfaces.ILongRequestEventOver1),
+    (longrequest.addLogEntryWarn, interfaces.ILongRequestEventOver2),
+    (longrequest.addLogEntryError, interfaces.ILongRequestEventOver3),
+    (longrequest.addLogEntryFinishedInfo,
+     interfaces.ILongRequestFinishedEvent),
+)
+
+
+class SyntheticThreadPool:
+    """A thread pool look-alike with `threads` busy workers"""
+
+    def __init__(self, threads, now, slowFraction=SLOW_FRACTION,
+                 headers=ENVIRON_HEADERS):
+        self.worker_tracker = {}
+        slow = int(math.ceil(threads * slowFraction))
+        for i in range(threads):
+            # thread ids far away from real ones
+            thread_id = 10 ** 9 + i
+            duration = 60 if i < slow else 0.5
+            self.worker_tracker[thread_id] = [
+                now - duration, makeEnviron(i, headers)]
+
+
+def makeEnviron(i, headers=ENVIRON_HEADERS):
+    """Return a WSGI environment of a realistic size"""
+    environ = {
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'https',
+        'wsgi.multithread': True,
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/customers/%s/reports/monthly' % i,
+        'QUERY_STRING': 'year=2020&month=%s&format=html' % (i % 12 + 1),
+        'SERVER_NAME': 'app.example.com',
+        'SERVER_PORT': '443',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '10.0.%s.%s' % (i // 256 % 256, i % 256),
+        'HTTP_HOST': 'app.example.com',
+        'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101',
+        'HTTP_ACCEPT': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+        'HTTP_COOKIE': 'session=%s; tracking=%s' % ('s' * 64, 't' * 128),
+    }
+    for n in range(headers):
+        environ['HTTP_X_CUSTOM_%s' % n] = 'value-%s-%s' % (n, 'x' * 40)
+    return environ
+
+
+def makePatterns(count):
+    """Return `count` exclusion patterns, none of them matching"""
+    return [re.compile('.*/excluded-%s/.*' % i) for i in range(count)]
+
+
+@contextlib.contextmanager
+def logSubscribers():
+    """Register the log entry subscribers, with a logger writing nothing
+
+    So that log entries get formatted, as in production.
+    """
+    saved = (longrequest.LOG.propagate, longrequest.LOG.level,
+             longrequest.LOG.handlers)
+    sm = zope.component.getGlobalSiteManager()
+    for func, iface in HANDLERS:
+        sm.registerHandler(func, (iface,))
+    try:
+        longrequest.LOG.propagate = False
+        longrequest.LOG.handlers = [logging.NullHandler()]
+        longrequest.LOG.setLevel(logging.DEBUG)
+        yield
+    finally:
+        for func, iface in HANDLERS:
+            sm.unregisterHandler(func, (iface,))
+        longrequest.LOG.propagate, level, longrequest.LOG.handlers = saved
+        longrequest.LOG.setLevel(level)
+
+
+@contextlib.contextmanager
+def scenario(threads, patterns, verbose, slowFraction=SLOW_FRACTION):
+    """Set up the module globals of longrequest for a benchmark run
+
+    Verbose runs report every busy thread in full, whatever their number,
+    so that results stay comparable with the baselines.
+    """
+    saved = (longrequest.THREADPOOL, longrequest.CONFIG,
+             longrequest.VERBOSE_MAX_THREADS, longrequest.CORUNNING_SUMMARY)
+    try:
+        with logSubscribers():
+            longrequest.THREADPOOL = SyntheticThreadPool(
+                threads, longrequest.NOW(), slowFraction)
+            longrequest.CONFIG = longrequest.CONFIG.replace(
+                ignoreURLs=makePatterns(patterns), verbose=verbose)
+            longrequest.VERBOSE_MAX_THREADS = None
+            longrequest.CORUNNING_SUMMARY = False
+            yield
+    finally:
+        longrequest.THREAD_STATES.clear()
+        (longrequest.THREADPOOL, longrequest.CONFIG,
+         longrequest.VERBOSE_MAX_THREADS,
+         longrequest.CORUNNING_SUMMARY) = saved
+
+
+class LatencyProbe(threading.Thread):
+    """A thread sleeping in short intervals, recording how late it wakes up
+
+    Stands in for worker threads, which have to wait for the GIL while
+    the checker holds it.
+    """
+
+    daemon = True
+    interval = 0.0005
+
+    def __init__(self):
+        super().__init__(name='cipher.longrequest benchmark probe')
+        self.latencies = []
+        self.running = True
+
+    def run(self):
+        while self.running:
+            started = time.perf_counter()
+            time.sleep(self.interval)
+            self.latencies.append(
+                time.perf_counter() - started - self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def measure(func, ticks):
+    """Return the median CPU time of `ticks` calls of `func`"""
+    times = []
+    for i in range(ticks):
+        started = time.process_time()
+        func()
+        times.append(time.process_time() - started)
+    return statistics.median(times)
+
+
+def runScenario(threads, patterns, verbose, ticks=3,
+                slowFraction=SLOW_FRACTION):
+    """Benchmark the checker, return a dict of metrics
+
+    cpu_cold: CPU seconds of a tick where every slow request crosses a level
+    cpu_warm: CPU seconds of a tick where all crossings were already notified
+    alloc_peak: peak bytes allocated during a cold tick
+    probe_latency: worst wake-up delay of a probe thread during cold ticks
+    """
+    with scenario(threads, patterns, verbose, slowFraction):
+        def coldTick():
+            longrequest.THREAD_STATES.clear()
+            longrequest.RequestCheckerThread(None, None, None, None).doWork()
+
+        checker = longrequest.RequestCheckerThread(None, None, None, None)
+        checker.doWork()
+
+        result = dict(threads=threads, patterns=patterns, verbose=verbose)
+        result['cpu_warm'] = measure(checker.doWork, ticks)
+
+        probe = LatencyProbe()
+        probe.start()
+        try:
+            result['cpu_cold'] = measure(coldTick, ticks)
+        finally:
+            probe.stop()
+        result['probe_latency'] = max(probe.latencies, default=0.0)
+
+        tracemalloc.start()
+        try:
+            coldTick()
+            result['alloc_peak'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def getKey(result):
+    return 'threads=%(threads)s patterns=%(patterns)s verbose=%(verbose)s' % (
+        result)
+
+
+def compareResults(results, baseline, tolerance=0.25):
+    """Return messages about the metrics worse than `baseline`
+
+    A metric regressed when it is more than `tolerance` above the baseline.
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get(getKey(result))
+        if base is None:
+            continue
+        for metric in METRICS:
+            if not base.get(metric):
+                continue
+            change = result[metric] / base[metric] - 1
+            if change > tolerance:
+                regressions.append('%s %s: %.6g -> %.6g (+%d%%)' % (
+                    getKey(result), metric, base[metric], result[metric],
+                    change * 100))
+    return regressions
+
+
+def formatResult(result):
+    return ('%-40s cold %8.2f ms  warm %8.2f ms  alloc %9d B'
+            '  probe %7.2f ms' % (
+                getKey(result), result['cpu_cold'] * 1000,
+                result['cpu_warm'] * 1000, result['alloc_peak'],
+                result['probe_latency'] * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the cipher.longrequest checker thread')
+    parser.add_argument('--threads', type=int, nargs='+', default=THREADS)
+    parser.add_argument('--patterns', type=int, nargs='+', default=PATTERNS)
+    parser.add_argument('--ticks', type=int, default=3,
+                        help='ticks measured per scenario')
+    parser.add_argument('--slow-fraction', type=float, default=SLOW_FRACTION,
+                        help='share of requests over the first level')
+    parser.add_argument('--save', metavar='FILE',
+                        help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    results = []
+    for threads in args.threads:
+        for patterns in args.patterns:
+            for verbose in VERBOSE:
+                result = runScenario(threads, patterns, verbose, args.ticks,
+                                     args.slow_fraction)
+                print(formatResult(result))
+                results.append(result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({getKey(r): r for r in results}, f, indent=1,
+                      sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compareResults(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,247 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Capture of slow requests, and replaying them offline
+"""
+import argparse
+import importlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+
+try:
+    from paste.deploy import loadapp
+except ImportError:
+    loadapp = None
+
+
+CHUNK_SIZE = 64 * 1024
+
+# never written to captures
+REDACTED_HEADERS = ('HTTP_AUTHORIZATION', 'HTTP_COOKIE',
+                    'HTTP_PROXY_AUTHORIZATION')
+
+_names = itertools.count(1)
+
+
+class RequestBody:
+    """The body of a request, spooled so that it can be read again
+
+    Bodies up to `memoryLimit` bytes are kept in memory, bigger ones in a
+    temporary file.  Each `open()` returns a new, independent stream.
+    """
+
+    data = b''
+    filename = None
+
+    def __init__(self, stream, length, memoryLimit):
+        self.size = length
+        if length <= memoryLimit:
+            self.data = stream.read(length) if length else b''
+            self.size = len(self.data)
+            return
+        fd, self.filename = tempfile.mkstemp(prefix='cipher-longrequest-')
+        self.size = 0
+        with os.fdopen(fd, 'wb') as f:
+            while self.size < length:
+                chunk = stream.read(min(CHUNK_SIZE, length - self.size))
+                if not chunk:
+                    break
+                f.write(chunk)
+                self.size += len(chunk)
+
+    def open(self):
+        if self.filename is None:
+            return io.BytesIO(self.data)
+        return open(self.filename, 'rb')
+
+    def close(self):
+        if self.filename is not None:
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
+            self.filename = None
+
+
+class Capture:
+    """A request that may get captured, once at most
+
+    `body` is its spooled RequestBody, None if it was not spooled.
+    """
+
+    __slots__ = ('body', 'captured')
+
+    def __init__(self, body=None):
+        self.body = body
+        self.captured = False
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+
+    def __repr__(self):
+        return '<Capture %s%s>' % (
+            'no body' if self.body is None else '%s bytes' % self.body.size,
+            ', captured' if self.captured else '')
+
+
+def spoolBody(environ, memoryLimit, maxSize):
+    """Spool the body of a request, replacing `wsgi.input`
+
+    Returns None if the body is too big, or its size is unknown, leaving
+    `wsgi.input` alone.
+    """
+    length = environ.get('CONTENT_LENGTH')
+    if not length:
+        # chunked, or read until the connection closes
+        return None
+    try:
+        length = int(length)
+    except ValueError:
+        return None
+    if length < 0 or length > maxSize:
+        return None
+    if length and environ.get('wsgi.input') is None:
+        return None
+    body = RequestBody(environ.get('wsgi.input'), length, memoryLimit)
+    environ['wsgi.input'] = body.open()
+    return body
+
+
+def filterEnviron(environ, redact=REDACTED_HEADERS):
+    """Return the text values of `environ`, without secret headers"""
+    return {k: v for k, v in environ.items()
+            if isinstance(v, str) and k not in redact}
+
+
+def getCaptureName(thread_id):
+    """Return a new capture name, unique in this process"""
+    return '%s-%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), thread_id,
+                         next(_names))
+
+
+def writeCapture(directory, event, body, level, redact=REDACTED_HEADERS):
+    """Persist a long request to `directory`, return the capture file name
+
+    The environment goes to a ``.json`` file, the body to a ``.body`` file
+    next to it.
+    """
+    name = getCaptureName(event.thread_id)
+    data = dict(
+        uri=event.uri,
+        thread_id=event.thread_id,
+        request_id=getattr(event, 'request_id', None),
+        duration=event.duration,
+        level=level,
+        captured=time.time(),
+        environ=filterEnviron(event.worker_environ or {}, redact),
+        body=None,
+        body_size=0,
+    )
+    if body is not None:
+        data['body'] = name + '.body'
+        data['body_size'] = body.size
+        with body.open() as src, \
+                open(os.path.join(directory, data['body']), 'wb') as dst:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+    filename = os.path.join(directory, name + '.json')
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    return filename
+
+
+def loadCapture(filename):
+    """Return (WSGI environment, body) of a captured request"""
+    with open(filename) as f:
+        data = json.load(f)
+    body = b''
+    if data['body']:
+        path = os.path.join(os.path.dirname(filename), data['body'])
+        with open(path, 'rb') as f:
+            body = f.read()
+    environ = dict(data['environ'])
+    environ.setdefault('REQUEST_METHOD', 'GET')
+    environ.setdefault('SCRIPT_NAME', '')
+    environ.setdefault('PATH_INFO', '/')
+    environ.setdefault('SERVER_NAME', 'localhost')
+    environ.setdefault('SERVER_PORT', '80')
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ['wsgi.version'] = (1, 0)
+    environ['wsgi.url_scheme'] = urlsplit(data['uri']).scheme or 'http'
+    environ['wsgi.errors'] = sys.stderr
+    environ['wsgi.multithread'] = False
+    environ['wsgi.multiprocess'] = False
+    environ['wsgi.run_once'] = False
+    return environ, body
+
+
+def replay(app, filename):
+    """Replay a captured request, return (status, seconds, response size)"""
+    environ, body = loadCapture(filename)
+    environ['wsgi.input'] = io.BytesIO(body)
+    status = []
+
+    def start_response(status_, headers, exc_info=None):
+        status.append(status_)
+        return lambda data: None
+
+    size = 0
+    started = time.perf_counter()
+    app_iter = app(environ, start_response)
+    try:
+        for chunk in app_iter:
+            size += len(chunk)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    duration = time.perf_counter() - started
+    return (status[0] if status else None), duration, size
+
+
+def loadApplication(spec):
+    """Load a WSGI application from ``module:name`` or ``config:file.ini``"""
+    if spec.startswith('config:'):
+        if loadapp is None:
+            raise ValueError('PasteDeploy is needed to load %s' % spec)
+        return loadapp(spec, relative_to=os.getcwd())
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name or 'application')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay requests captured by cipher.longrequest')
+    parser.add_argument(
+        'app', help='the WSGI application, module:name or config:file.ini')
+    parser.add_argument('captures', nargs='+', help='captured .json files')
+    parser.add_argument('-n', '--repeat', type=int, default=1,
+                        help='replay each request this many times')
+    args = parser.parse_args(argv)
+
+    app = loadApplication(args.app)
+    for filename in args.captures:
+        for i in range(args.repeat):
+            status, duration, size = replay(app, filename)
+            print('%s %s %.3f sec %s bytes' % (
+                filename, status, duration, size))
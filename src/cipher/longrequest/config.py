@@ -0,0 +1,191 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""The settings which can change while running
+"""
+import logging
+import re
+from configparser import RawConfigParser
+
+from paste.util.converters import asbool
+
+
+SECTION = 'cipher.longrequest'
+
+LOG_LEVELS = {'info': logging.INFO, 'warn': logging.WARN,
+              'error': logging.ERROR}
+
+
+class Config:
+    """Immutable settings, replaced as a whole to change any of them
+
+    So that whoever reads them gets a consistent set, without locking.
+    Exclusion patterns and per-URL thresholds get compiled on creation.
+    """
+
+    __slots__ = ('durationLevels', 'tick', 'verbose', 'finishedLogLevel',
+                 'ignoreURLs', 'urlThresholds')
+
+    def __init__(self, durationLevels=(2, 10, 30), tick=1, verbose=False,
+                 finishedLogLevel=logging.INFO, ignoreURLs=(),
+                 urlThresholds=()):
+        init = object.__setattr__
+        init(self, 'durationLevels', tuple(durationLevels))
+        init(self, 'tick', tick)
+        init(self, 'verbose', verbose)
+        init(self, 'finishedLogLevel', finishedLogLevel)
+        init(self, 'ignoreURLs', tuple(compileURL(url) for url in ignoreURLs))
+        init(self, 'urlThresholds', tuple(
+            (compileURL(url), tuple(levels)) for url, levels in urlThresholds))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config is immutable, use replace()')
+
+    def replace(self, **changes):
+        """Return a copy with `changes`"""
+        kw = {name: getattr(self, name) for name in self.__slots__}
+        kw.update(changes)
+        return Config(**kw)
+
+    def format(self):
+        """Return the settings as options of the ini file
+
+        Levels not set get an empty value.
+        """
+        lines = ['duration-level-%s =%s' % (
+                     i, '' if level is None else ' %s' % level)
+                 for i, level in enumerate(self.durationLevels, 1)]
+        lines.append('tick = %s' % self.tick)
+        lines.append('verbose = %s' % ('true' if self.verbose else 'false'))
+        lines.append('finished-log-level = %s' % (
+            logging.getLevelName(self.finishedLogLevel).lower()
+            .replace('warning', 'warn')))
+        for i, pattern in enumerate(self.ignoreURLs, 1):
+            lines.append('exclude-url-%s = %s' % (i, pattern.pattern))
+        for i, (pattern, levels) in enumerate(self.urlThresholds, 1):
+            lines.append('threshold-url-%s = %s' % (i, pattern.pattern))
+            lines.append('threshold-levels-%s = %s' % (
+                i, ' '.join(str(level) for level in levels)))
+        return '\n'.join(lines) + '\n'
+
+    def __repr__(self):
+        return '<Config levels %s, tick %s, verbose %s>' % (
+            self.durationLevels, self.tick, self.verbose)
+
+
+def compileURL(url):
+    if isinstance(url, str):
+        return re.compile(url)  # no flags, use `(?iLmsux)`
+    return url
+
+
+def readOptions(config, option, section=SECTION):
+    """Return the values of `option`-1, `option`-2, ... up to the first gap"""
+    values = []
+    i = 1
+    while config.has_option(section, '%s-%i' % (option, i)):
+        values.append(config.get(section, '%s-%i' % (option, i)))
+        i += 1
+    return values
+
+
+def fromParser(config, base=None, section=SECTION):
+    """Return the settings of a section of a RawConfigParser
+
+    Settings missing in it are taken from `base`, the defaults if None.
+    Empty duration levels are not set, an empty first exclude-url or
+    threshold-url removes those of `base`.  A tick that is not positive
+    raises ValueError.
+    """
+    if base is None:
+        base = Config()
+    changes = {}
+
+    levels = list(base.durationLevels)
+    for i in range(3):
+        option = 'duration-level-%s' % (i + 1)
+        if config.has_option(section, option):
+            value = config.get(section, option).strip()
+            levels[i] = int(value) if value else None
+    changes['durationLevels'] = levels
+
+    if config.has_option(section, 'tick'):
+        tick = changes['tick'] = config.getint(section, 'tick')
+        if tick <= 0:
+            raise ValueError('tick %s is not positive' % tick)
+
+    if config.has_option(section, 'verbose'):
+        changes['verbose'] = asbool(config.get(section, 'verbose'))
+
+    if config.has_option(section, 'finished-log-level'):
+        value = config.get(section, 'finished-log-level').lower()
+        if value in LOG_LEVELS:
+            changes['finishedLogLevel'] = LOG_LEVELS[value]
+
+    urls = readOptions(config, 'exclude-url', section)
+    if urls:
+        changes['ignoreURLs'] = [url for url in urls if url]
+
+    urls = readOptions(config, 'threshold-url', section)
+    if urls:
+        changes['urlThresholds'] = [
+            (url, tuple(int(level) for level in config.get(
+                section, 'threshold-levels-%i' % i).split()))
+            for i, url in enumerate(urls, 1) if url]
+
+    return base.replace(**changes)
+
+
+def checkSection(config, section):
+    """Raise ValueError for options only the main section can have
+
+    The one checker thread ticks for all monitors.
+    """
+    if section != SECTION and config.has_option(section, 'tick'):
+        raise ValueError('tick is the same for all applications, set it in'
+                         ' [%s], not in [%s]' % (SECTION, section))
+
+
+def forSection(config, section=SECTION):
+    """Return the settings of `section`, missing ones from the main section"""
+    rv = fromParser(config)
+    if section != SECTION:
+        checkSection(config, section)
+        rv = fromParser(config, rv, section)
+    return rv
+
+
+def readFile(filename):
+    """Return a RawConfigParser with an ini file read"""
+    config = RawConfigParser()
+    config.optionxform = str
+    if not config.read(filename):
+        raise OSError('Cannot read %s' % filename)
+    return config
+
+
+def fromFile(filename, section=SECTION):
+    """Return the settings of a section of an ini file"""
+    return forSection(readFile(filename), section)
+
+
+def fromOptions(options, base, section=SECTION):
+    """Return `base` with the settings of an options dict changed
+
+    The settings of the monitor of `section`.
+    """
+    config = RawConfigParser()
+    config.optionxform = str
+    config.read_dict({section: options})
+    checkSection(config, section)
+    return fromParser(config, base, section)
@@ -0,0 +1,98 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Which URL templates tend to be busy when requests get long
+"""
+import heapq
+import threading
+
+
+# at most this many pairs of templates get counted
+MAX_PAIRS = 1000
+
+
+class CoRunning:
+    """Count how often requests of two URL templates ran together
+
+    Counted once per long request, for it and each other request busy
+    when it became a long one.  The pairs are unordered, (a, a) counts
+    requests of the same template.  At most `maxPairs` pairs get
+    counted, a new pair replaces the least counted one and takes over its
+    count, as in Space-Saving, so that often seen pairs show up even
+    after many rare ones.
+    """
+
+    def __init__(self, maxPairs=MAX_PAIRS):
+        self.maxPairs = maxPairs
+        self.counts = {}
+        # (count, pair) for every pair counted, the counts may be lower
+        # than the real ones, they only get updated when found at the top
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def record(self, template, running):
+        """Count `template` running together with the requests `running`
+
+        `running` maps the URL templates of the busy requests to their
+        number, the request of `template` itself included.
+        """
+        counts = self.counts
+        with self.lock:
+            for other, count in running.items():
+                if other == template:
+                    # not with itself
+                    count -= 1
+                if count <= 0:
+                    continue
+                pair = (template, other) if template <= other else (
+                    other, template)
+                old = counts.get(pair)
+                if old is None:
+                    old = 0
+                    if len(counts) >= self.maxPairs:
+                        old = self._evict()
+                    heapq.heappush(self.heap, (old + count, pair))
+                counts[pair] = old + count
+
+    def _evict(self):
+        """Stop counting the least counted pair, return its count"""
+        counts = self.counts
+        heap = self.heap
+        while True:
+            count, pair = heap[0]
+            current = counts[pair]
+            if current == count:
+                heapq.heappop(heap)
+                del counts[pair]
+                return count
+            # counted more since, look again
+            heapq.heapreplace(heap, (current, pair))
+
+    def top(self, n=10, template=None):
+        """Return [((template, template), count), ...], most counted first
+
+        Only the pairs including `template`, if given.
+        """
+        with self.lock:
+            items = [(pair, count) for pair, count in self.counts.items()
+                     if template is None or template in pair]
+        items.sort(key=lambda item: -item[1])
+        return items[:n]
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+            self.heap = []
+
+    def __repr__(self):
+        return '<CoRunning %s/%s>' % (len(self.counts), self.maxPairs)
@@ -0,0 +1,154 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Health of the thread pool as a whole
+"""
+import _thread
+import re
+import sys
+import threading
+
+from cipher.longrequest import locks
+
+
+HEALTHY = 'healthy'
+SATURATED = 'saturated'  # all threads busy
+STALLED = 'stalled'  # all threads busy, and none finishing
+
+STATES = (HEALTHY, SATURATED, STALLED)
+
+# the re-entrant locks of the _thread module, also once locks.patch() made
+# threading.RLock create locks.TrackedRLock
+RLOCK_TYPE = _thread.RLock
+
+# _thread.RLock reprs tell the owner
+RLOCK_OWNER_RE = re.compile(r'^<locked .*RLock object owner=(\d+) count=(\d+)')
+
+
+class PoolHealth:
+    """State machine of the health of a thread pool, fed once per tick
+
+    The pool is saturated when all its threads are busy, or requests wait
+    `queueThreshold` seconds or more for a thread, stalled when it was
+    saturated and no request finished for `stallTicks` ticks.  Getting
+    worse takes effect at once, getting better only after `recoverTicks`
+    ticks in a row, so that the state doesn't flap.
+    """
+
+    def __init__(self, stallTicks=5, recoverTicks=3, queueThreshold=None):
+        self.stallTicks = stallTicks
+        self.recoverTicks = recoverTicks
+        self.queueThreshold = queueThreshold
+        self.state = HEALTHY
+        # whether requests waited queueThreshold for a thread
+        self.queueing = False
+        # thread_id -> time_started of the previous tick
+        self.starts = {}
+        # ticks saturated without any request finishing
+        self.stuckTicks = 0
+        # ticks in a row looking better than the state
+        self.betterTicks = 0
+
+    def update(self, workers, poolSize, queueDelay=None):
+        """Feed the busy workers of a tick, thread_id -> (time_started, ...)
+
+        `poolSize` is the number of threads, None if not known,
+        `queueDelay` the longest wait of the requests started since the
+        last tick, None if none started or not known.  Returns (old
+        state, new state) if the state changed, None otherwise.
+        """
+        starts = {thread_id: value[0] for thread_id, value in workers.items()}
+        previous = self.starts
+        self.starts = starts
+        finished = any(starts.get(thread_id) != started
+                       for thread_id, started in previous.items())
+
+        if self.queueThreshold is not None:
+            if queueDelay is not None:
+                self.queueing = queueDelay >= self.queueThreshold
+            elif finished:
+                # a thread got free and no request was waiting for it
+                self.queueing = False
+
+        saturated = ((poolSize is not None and len(starts) >= poolSize)
+                     or self.queueing)
+        if saturated and not finished:
+            self.stuckTicks += 1
+        else:
+            self.stuckTicks = 0
+
+        if self.stuckTicks >= self.stallTicks:
+            target = STALLED
+        elif saturated:
+            target = SATURATED
+        else:
+            target = HEALTHY
+
+        old = self.state
+        if STATES.index(target) >= STATES.index(old):
+            self.betterTicks = 0
+            if target == old:
+                return None
+        else:
+            self.betterTicks += 1
+            if self.betterTicks < self.recoverTicks:
+                return None
+            self.betterTicks = 0
+        self.state = target
+        return old, target
+
+
+def getPoolSize(thread_pool):
+    """Return the number of threads of `thread_pool`, None if not known"""
+    workers = getattr(thread_pool, 'workers', None)
+    if workers is not None:
+        return len(workers)
+    return getattr(thread_pool, 'nworkers', None)
+
+
+def getQueueDepth(thread_pool):
+    """Return the number of requests waiting for a thread, None if unknown"""
+    try:
+        return thread_pool.queue.qsize()
+    except AttributeError:
+        return None
+
+
+def getLockOwners():
+    """Return (name, owner thread_id, count) of the held re-entrant locks
+
+    Only the locks in module globals are found, plain locks don't know
+    their owner.  Both the locks of the _thread module and tracked ones,
+    those created before and after patching threading.RLock.
+    """
+    owners = []
+    for moduleName, module in list(sys.modules.items()):
+        namespace = getattr(module, '__dict__', None)
+        if not namespace:
+            continue
+        for name, value in list(namespace.items()):
+            if isinstance(value, threading.Condition):
+                value = value._lock
+            if type(value) is locks.TrackedRLock:
+                owner, count = value.owner, value.count
+                if owner is not None:
+                    owners.append(('%s.%s' % (moduleName, name), owner,
+                                   count))
+                continue
+            if type(value) is not RLOCK_TYPE:
+                continue
+            match = RLOCK_OWNER_RE.match(repr(value))
+            if match is not None:
+                owners.append(('%s.%s' % (moduleName, name),
+                               int(match.group(1)), int(match.group(2))))
+    return owners
@@ -0,0 +1,139 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""The principals or tenants spending the most time in long requests
+"""
+import threading
+
+
+# at most this many principals or tenants get counted
+CAPACITY = 1000
+
+
+class HitterStats:
+    """The long requests of one principal or tenant"""
+
+    __slots__ = ('count', 'seconds', 'concurrent', 'error')
+
+    def __init__(self, count=0, seconds=0, concurrent=0, error=0):
+        self.count = count
+        self.seconds = seconds  # in long requests, in total
+        self.concurrent = concurrent  # long requests running now
+        self.error = error  # seconds possibly belonging to others
+
+    def copy(self):
+        return HitterStats(self.count, self.seconds, self.concurrent,
+                           self.error)
+
+    def __repr__(self):
+        return '<HitterStats count %s, %s sec, concurrent %s, error %s>' % (
+            self.count, self.seconds, self.concurrent, self.error)
+
+
+class SpaceSaving:
+    """Count the top consumers in bounded memory, by Space-Saving
+
+    A. Metwally, D. Agrawal and A. El Abbadi, "Efficient computation of
+    frequent and top-k elements in data streams", 2005.
+
+    At most `capacity` keys get counted.  A new key replaces the one with
+    the fewest seconds and takes over its count and seconds, the seconds
+    taken over are its `error`: its real seconds are between `seconds -
+    error` and `seconds`.  Any key with more seconds than the fewest
+    counted is sure to be counted.  Keys with long requests running are
+    never replaced, so that `concurrent` stays exact, when all are busy a
+    new key only gets counted in `dropped`.
+    """
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.entries = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def _getEntry(self, key):
+        """Return the entry of `key`, making room for it, None if none"""
+        entries = self.entries
+        entry = entries.get(key)
+        if entry is not None:
+            return entry
+        if len(entries) < self.capacity:
+            entry = entries[key] = HitterStats()
+            return entry
+        # a linear scan, but only for keys not counted yet
+        victim = None
+        for other, candidate in entries.items():
+            if candidate.concurrent:
+                continue
+            if victim is None or candidate.seconds < victim[1].seconds:
+                victim = other, candidate
+        if victim is None:
+            self.dropped += 1
+            return None
+        other, old = victim
+        del entries[other]
+        entry = entries[key] = HitterStats(old.count, old.seconds, 0,
+                                           old.seconds)
+        return entry
+
+    def started(self, key):
+        """Count a long request of `key` starting
+
+        Returns False if `key` could not be counted.
+        """
+        with self.lock:
+            entry = self._getEntry(key)
+            if entry is None:
+                return False
+            entry.count += 1
+            entry.concurrent += 1
+            return True
+
+    def add(self, key, seconds):
+        """Add `seconds` to a started long request of `key`"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.seconds += seconds
+
+    def finished(self, key):
+        """Count a started long request of `key` finishing"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.concurrent:
+                entry.concurrent -= 1
+
+    def get(self, key):
+        """Return a copy of the HitterStats of `key`, None if not counted"""
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else entry.copy()
+
+    def top(self, n=10):
+        """Return [(key, HitterStats), ...] of the `n` keys with most seconds
+
+        The stats are copies, most seconds first.
+        """
+        with self.lock:
+            items = [(key, entry.copy())
+                     for key, entry in self.entries.items()]
+        items.sort(key=lambda item: (-item[1].seconds, -item[1].count))
+        return items[:n]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.dropped = 0
+
+    def __repr__(self):
+        return '<SpaceSaving %s/%s>' % (len(self.entries), self.capacity)
@@ -0,0 +1,167 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Long requests with similar stacks grouped into incidents
+"""
+import itertools
+import time
+
+
+SIMILARITY = 0.5  # of stacks, to be part of the same incident
+CLOSE_AFTER = 60  # sec without long requests, for an incident to close
+MAX_OPEN = 100  # incidents open at once
+MAX_TEMPLATES = 10  # URL templates counted per incident
+
+_ids = itertools.count(1)
+
+
+def getFingerprint(stack):
+    """Return the functions of a stacks.Stack, as a frozenset
+
+    Line numbers are left out, requests busy in different lines of the
+    same functions are alike.
+    """
+    return frozenset((code.co_filename, code.co_name)
+                     for code, lineno in stack.entries)
+
+
+def similarity(a, b):
+    """Return the Jaccard similarity of two fingerprints, 0 to 1"""
+    union = len(a | b)
+    if not union:
+        return 1.0
+    return len(a & b) / union
+
+
+class Incident:
+    """Long requests having a problem in common
+
+    `id` stays the same for the whole incident, `start` and `end` are
+    when its first and last long requests were seen, `count` the number
+    of requests affected, `active` the keys of those still running.  Its
+    representative `stack` is the one of its first request.
+    """
+
+    def __init__(self, start, fingerprint, stack):
+        self.id = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S',
+                                           time.gmtime(start)), next(_ids))
+        self.start = start
+        self.end = start
+        self.count = 0
+        self.active = set()
+        # template -> count of requests, for at most MAX_TEMPLATES
+        self.templates = {}
+        self.fingerprint = fingerprint
+        self.stack = stack
+
+    def add(self, key, template):
+        self.count += 1
+        self.active.add(key)
+        if (template in self.templates
+                or len(self.templates) < MAX_TEMPLATES):
+            self.templates[template] = self.templates.get(template, 0) + 1
+
+    def getTemplates(self):
+        """Return [(template, count), ...], most requests first"""
+        return sorted(self.templates.items(), key=lambda item: -item[1])
+
+    def __repr__(self):
+        return '<Incident %s, %s requests, %s active>' % (
+            self.id, self.count, len(self.active))
+
+
+class IncidentTracker:
+    """Group long requests into incidents, incrementally per tick
+
+    A new long request joins the open incident with the most similar
+    stack, at least `threshold` similar, half as much for an incident
+    having requests of its URL template.  Otherwise it opens an incident,
+    at most `maxOpen` can be open.  An incident closes once it had no
+    long request running for `closeAfter` seconds.  Only the open
+    incidents and their running requests are kept.
+    """
+
+    def __init__(self, threshold=SIMILARITY, closeAfter=CLOSE_AFTER,
+                 maxOpen=MAX_OPEN):
+        self.threshold = threshold
+        self.closeAfter = closeAfter
+        self.maxOpen = maxOpen
+        self.open = []
+        # key of a running long request -> its Incident, None if dropped
+        self.assigned = {}
+        self.dropped = 0
+
+    def isKnown(self, key):
+        return key in self.assigned
+
+    def match(self, template, fingerprint):
+        """Return the open incident a request belongs to, None if none"""
+        best = None
+        bestSimilarity = -1
+        for incident in self.open:
+            threshold = self.threshold
+            if template in incident.templates:
+                threshold /= 2
+            value = similarity(fingerprint, incident.fingerprint)
+            if value >= threshold and value > bestSimilarity:
+                best, bestSimilarity = incident, value
+        return best
+
+    def update(self, running, new, now):
+        """Feed the long requests of a tick
+
+        `running` are the keys of all long requests running now, `new`
+        [(key, template, stacks.Stack), ...] of those not known yet.
+        Returns the incidents (opened, updated, closed) in this tick.
+        """
+        assigned = self.assigned
+        for key in list(assigned):
+            if key not in running:
+                incident = assigned.pop(key)
+                if incident is not None:
+                    incident.active.discard(key)
+
+        opened = []
+        updated = []
+        for key, template, stack in new:
+            fingerprint = getFingerprint(stack)
+            incident = self.match(template, fingerprint)
+            if incident is None:
+                if len(self.open) >= self.maxOpen:
+                    self.dropped += 1
+                    assigned[key] = None
+                    continue
+                incident = Incident(now, fingerprint, stack)
+                self.open.append(incident)
+                opened.append(incident)
+            elif incident not in opened and incident not in updated:
+                updated.append(incident)
+            incident.add(key, template)
+            assigned[key] = incident
+
+        closed = []
+        still = []
+        for incident in self.open:
+            if incident.active:
+                incident.end = now
+            if not incident.active and now - incident.end >= self.closeAfter:
+                closed.append(incident)
+            else:
+                still.append(incident)
+        self.open = still
+        return opened, updated, closed
+
+    def clear(self):
+        self.open = []
+        self.assigned.clear()
+        self.dropped = 0
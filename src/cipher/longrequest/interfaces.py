@@ -30,6 +30,16 @@ class ILongRequestEvent(zope.interface.Interface):
             title='URI',
             required=False)
 
+    template = zope.schema.TextLine(
+            title='URI template',
+            description='The URI with IDs replaced, to aggregate by',
+            required=False)
+
+    client_ip = zope.schema.TextLine(
+            title='Client IP address',
+            description='As reported by proxies, if any',
+            required=False)
+
     # BIG FAT WARNING:
     # this is the request environment passed in as a reference
     # so it can CHANGE easily, even go away
@@ -47,16 +57,45 @@ class ILongRequestEvent(zope.interface.Interface):
             description='',
             required=False)
 
+    snapshot = zope.interface.Attribute(
+            "The snapshot of the thread pool the event was detected in, "
+            "None if not known")
+
+    monitor = zope.interface.Attribute(
+            "The Monitor watching the application serving the request, "
+            "None if not known")
+
+    queue_delay = zope.interface.Attribute(
+            "Seconds the request waited for a thread, None if not known")
+
+    request_id = zope.schema.TextLine(
+            title='Request ID',
+            description='From X-Request-ID or traceparent, or made up',
+            required=False)
+
 
 @zope.interface.implementer(ILongRequestEvent)
 class LongRequestEvent:
 
-    def __init__(self, thread_id, duration, uri, worker_environ, zope_request):
+    # events get created every tick, keep them small
+    __slots__ = ('thread_id', 'duration', 'uri', 'worker_environ',
+                 'zope_request', 'template', 'client_ip', 'snapshot',
+                 'monitor', 'queue_delay', 'request_id')
+
+    def __init__(self, thread_id, duration, uri, worker_environ, zope_request,
+                 template=None, client_ip=None, snapshot=None, monitor=None,
+                 queue_delay=None, request_id=None):
         self.thread_id = thread_id
         self.duration = duration
         self.uri = uri
         self.worker_environ = worker_environ
         self.zope_request = zope_request
+        self.template = template
+        self.client_ip = client_ip
+        self.snapshot = snapshot
+        self.monitor = monitor
+        self.queue_delay = queue_delay
+        self.request_id = request_id
 
 
 class ILongRequestEventOver1(ILongRequestEvent):
@@ -65,7 +104,7 @@ class ILongRequestEventOver1(ILongRequestEvent):
 
 @zope.interface.implementer(ILongRequestEventOver1)
 class LongRequestEventOver1(LongRequestEvent):
-    pass
+    __slots__ = ()
 
 
 class ILongRequestEventOver2(ILongRequestEvent):
@@ -74,7 +113,7 @@ class ILongRequestEventOver2(ILongRequestEvent):
 
 @zope.interface.implementer(ILongRequestEventOver2)
 class LongRequestEventOver2(LongRequestEvent):
-    pass
+    __slots__ = ()
 
 
 class ILongRequestEventOver3(ILongRequestEvent):
@@ -83,7 +122,7 @@ class ILongRequestEventOver3(ILongRequestEvent):
 
 @zope.interface.implementer(ILongRequestEventOver3)
 class LongRequestEventOver3(LongRequestEvent):
-    pass
+    __slots__ = ()
 
 
 class ILongRequestFinishedEvent(zope.interface.Interface):
@@ -99,14 +138,194 @@ class ILongRequestFinishedEvent(zope.interface.Interface):
             title='URI',
             required=False)
 
+    template = zope.schema.TextLine(
+            title='URI template',
+            description='The URI with IDs replaced, to aggregate by',
+            required=False)
+
+    monitor = zope.interface.Attribute(
+            "The Monitor watching the application serving the request, "
+            "None if not known")
+
+    request_id = zope.schema.TextLine(
+            title='Request ID',
+            description='From X-Request-ID or traceparent, or made up',
+            required=False)
+
 
 @zope.interface.implementer(ILongRequestFinishedEvent)
 class LongRequestFinishedEvent:
 
-    def __init__(self, thread_id, duration, uri):
+    __slots__ = ('thread_id', 'duration', 'uri', 'template', 'monitor',
+                 'request_id')
+
+    def __init__(self, thread_id, duration, uri, template=None, monitor=None,
+                 request_id=None):
         self.thread_id = thread_id
         self.duration = duration
         self.uri = uri
+        self.template = template
+        self.monitor = monitor
+        self.request_id = request_id
+
+
+class ILongRequestBatchEvent(zope.interface.Interface):
+    """All the events of a tick, for subscribers handling them in one go
+
+    Notified after the individual events, only if there were any.
+    """
+
+    events = zope.interface.Attribute(
+        "The ILongRequestEvents notified in the tick")
+
+    finished = zope.interface.Attribute(
+        "The ILongRequestFinishedEvents notified in the tick")
+
+    snapshot = zope.interface.Attribute(
+        "The snapshot of the thread pool of the tick")
+
+
+@zope.interface.implementer(ILongRequestBatchEvent)
+class LongRequestBatchEvent:
+
+    __slots__ = ('events', 'finished', 'snapshot')
+
+    def __init__(self, events, finished=(), snapshot=None):
+        self.events = events
+        self.finished = finished
+        self.snapshot = snapshot
+
+
+class IPoolStateChangedEvent(zope.interface.Interface):
+    """The thread pool changed between healthy, saturated and stalled"""
+
+    old_state = zope.interface.Attribute("The previous state")
+
+    state = zope.interface.Attribute("The new state")
+
+    snapshot = zope.interface.Attribute(
+        "The snapshot of the thread pool of the tick")
+
+
+class IPoolStalledEvent(IPoolStateChangedEvent):
+    """All threads are busy and none of them finishes"""
+
+    diagnostics = zope.interface.Attribute(
+        "Text report of the whole process: all stacks, lock owners, "
+        "queued requests")
+
+
+@zope.interface.implementer(IPoolStateChangedEvent)
+class PoolStateChangedEvent:
+
+    __slots__ = ('old_state', 'state', 'snapshot')
+
+    def __init__(self, old_state, state, snapshot=None):
+        self.old_state = old_state
+        self.state = state
+        self.snapshot = snapshot
+
+
+@zope.interface.implementer(IPoolStalledEvent)
+class PoolStalledEvent(PoolStateChangedEvent):
+
+    __slots__ = ('diagnostics',)
+
+    def __init__(self, old_state, state, snapshot=None, diagnostics=''):
+        super().__init__(old_state, state, snapshot)
+        self.diagnostics = diagnostics
+
+
+class IDeadlockEvent(zope.interface.Interface):
+    """Threads wait in a circle for tracked locks held by each other"""
+
+    cycle = zope.interface.Attribute(
+        "The (thread_id, lock it waits for) pairs of the circle")
+
+    description = zope.interface.Attribute("The circle, as text")
+
+    snapshot = zope.interface.Attribute(
+        "The snapshot of the thread pool of the tick")
+
+
+@zope.interface.implementer(IDeadlockEvent)
+class DeadlockEvent:
+
+    __slots__ = ('cycle', 'description', 'snapshot')
+
+    def __init__(self, cycle, description, snapshot=None):
+        self.cycle = cycle
+        self.description = description
+        self.snapshot = snapshot
+
+
+class IReportsSuppressedEvent(zope.interface.Interface):
+    """Reports of long requests were left out in a tick, rate limited"""
+
+    level = zope.interface.Attribute("The duration level, 1, 2 or 3")
+
+    count = zope.interface.Attribute("The number of reports left out")
+
+    snapshot = zope.interface.Attribute(
+        "The snapshot of the thread pool of the tick")
+
+
+@zope.interface.implementer(IReportsSuppressedEvent)
+class ReportsSuppressedEvent:
+
+    __slots__ = ('level', 'count', 'snapshot')
+
+    def __init__(self, level, count, snapshot=None):
+        self.level = level
+        self.count = count
+        self.snapshot = snapshot
+
+
+class IIncidentEvent(zope.interface.Interface):
+    """Something happened to an incident, long requests alike"""
+
+    incident = zope.interface.Attribute(
+        "The incidents.Incident, its id, start, end, count of requests, "
+        "URL templates and representative stack")
+
+    snapshot = zope.interface.Attribute(
+        "The snapshot of the thread pool of the tick")
+
+
+class IIncidentOpenedEvent(IIncidentEvent):
+    """A long request unlike the others opened an incident"""
+
+
+class IIncidentUpdatedEvent(IIncidentEvent):
+    """More long requests joined an incident"""
+
+
+class IIncidentClosedEvent(IIncidentEvent):
+    """An incident had no long requests running for a while"""
+
+
+class IncidentEvent:
+
+    __slots__ = ('incident', 'snapshot')
+
+    def __init__(self, incident, snapshot=None):
+        self.incident = incident
+        self.snapshot = snapshot
+
+
+@zope.interface.implementer(IIncidentOpenedEvent)
+class IncidentOpenedEvent(IncidentEvent):
+    __slots__ = ()
+
+
+@zope.interface.implementer(IIncidentUpdatedEvent)
+class IncidentUpdatedEvent(IncidentEvent):
+    __slots__ = ()
+
+
+@zope.interface.implementer(IIncidentClosedEvent)
+class IncidentClosedEvent(IncidentEvent):
+    __slots__ = ()
 
 
 class ILongRequestTickEvent(zope.interface.Interface):
@@ -117,9 +336,22 @@ class ILongRequestTickEvent(zope.interface.Interface):
 
     thread_pool = zope.interface.Attribute("Thread pool")
 
+    snapshot = zope.interface.Attribute(
+        "Consistent copy of the busy workers, taken once for this tick")
+
+    generation = zope.interface.Attribute(
+        "Number of the snapshot, increasing with every tick")
+
 
 @zope.interface.implementer(ILongRequestTickEvent)
 class LongRequestTickEvent:
 
-    def __init__(self, thread_pool):
+    __slots__ = ('thread_pool', 'snapshot')
+
+    def __init__(self, thread_pool, snapshot=None):
         self.thread_pool = thread_pool
+        self.snapshot = snapshot
+
+    @property
+    def generation(self):
+        return None if self.snapshot is None else self.snapshot.generation
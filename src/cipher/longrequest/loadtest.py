@@ -0,0 +1,233 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Load test measuring what the watchdog costs in request throughput
+
+Serves a synthetic application with paste.httpserver on localhost, drives
+it with a local load generator and compares throughput and latency
+percentiles with the filter absent, idle and firing heavily in verbose
+mode.
+"""
+import argparse
+import contextlib
+import http.client
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from paste import httpserver
+
+from cipher.longrequest import benchmark
+from cipher.longrequest import longrequest
+
+
+SCENARIOS = ('absent', 'idle', 'firing')
+
+# share of requests per application mode
+MIX = dict(fast=0.9, slow=0.05, cpu=0.05)
+SLOW_TIME = 1.2  # sec, long enough to cross a level
+CPU_TIME = 0.02  # sec of busy looping
+
+PERCENTILES = (50, 90, 99)
+
+
+class SyntheticApplication:
+    """A WSGI application, fast, slow or CPU bound depending on the query
+
+    ``?mode=slow`` sleeps `slowTime` seconds, ``?mode=cpu`` spins for
+    `cpuTime` seconds, anything else returns right away.
+    """
+
+    def __init__(self, slowTime=SLOW_TIME, cpuTime=CPU_TIME):
+        self.slowTime = slowTime
+        self.cpuTime = cpuTime
+
+    def __call__(self, environ, start_response):
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        mode = query.get('mode', ['fast'])[0]
+        if mode == 'slow':
+            time.sleep(self.slowTime)
+        elif mode == 'cpu':
+            until = time.perf_counter() + self.cpuTime
+            while time.perf_counter() < until:
+                pass
+        body = mode.encode()
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+
+def percentile(values, p):
+    """Return the `p` percentile of `values`, nearest rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+@contextlib.contextmanager
+def serving(app, workers):
+    """Serve `app` on a free localhost port, yield the port"""
+    server = httpserver.serve(app, host='127.0.0.1', port=0,
+                              start_loop=False, use_threadpool=True,
+                              threadpool_workers=workers,
+                              request_queue_size=workers * 4)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='cipher.longrequest load test server')
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.server_close()
+        thread.join()
+
+
+@contextlib.contextmanager
+def watchdog(scenario, tick):
+    """Set up longrequest for a scenario, yield the application wrapper"""
+    if scenario == 'absent':
+        yield lambda app: app
+        return
+
+    saved = (longrequest.CONFIG, longrequest.INITIAL_DELAY)
+    if scenario == 'idle':
+        levels = (3600, 7200, 10800)
+        verbose = False
+    else:
+        # durations count whole seconds, a slow request over a second is
+        # over all three levels at once, and reported as over the third
+        levels = (0.5, 0.6, 0.7)
+        verbose = True
+    with benchmark.logSubscribers():
+        longrequest.CONFIG = longrequest.CONFIG.replace(
+            durationLevels=levels, verbose=verbose, tick=tick)
+        longrequest.INITIAL_DELAY = 0
+        longrequest.startThread(None, None, None, None)
+        try:
+            yield longrequest.ThreadpoolCatcher
+        finally:
+            longrequest.stopThread()
+            longrequest.THREADPOOL = None
+            longrequest.CONFIG, longrequest.INITIAL_DELAY = saved
+
+
+def makePaths(count, mix=MIX, seed=42):
+    """Return `count` request paths, with modes picked according to `mix`"""
+    rnd = random.Random(seed)
+    modes = sorted(mix)
+    weights = [mix[mode] for mode in modes]
+    return ['/load?mode=%s&i=%s' % (mode, i)
+            for i, mode in enumerate(rnd.choices(modes, weights, k=count))]
+
+
+def runLoad(port, paths, concurrency):
+    """Request all `paths` with `concurrency` clients
+
+    Returns (wall clock seconds, latencies in seconds, number of errors).
+    """
+    latencies = []
+    errors = []
+    pending = iter(paths)
+    lock = threading.Lock()
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            while True:
+                with lock:
+                    path = next(pending, None)
+                if path is None:
+                    return
+                started = time.perf_counter()
+                try:
+                    conn.request('GET', path)
+                    response = conn.getresponse()
+                    response.read()
+                    if response.status != 200:
+                        errors.append(response.status)
+                except (OSError, http.client.HTTPException) as e:
+                    errors.append(e)
+                    conn.close()
+                    conn = http.client.HTTPConnection(
+                        '127.0.0.1', port, timeout=60)
+                    continue
+                latencies.append(time.perf_counter() - started)
+        finally:
+            conn.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for i in range(concurrency):
+            executor.submit(client)
+    return time.perf_counter() - started, latencies, len(errors)
+
+
+def runScenario(scenario, requests=1000, concurrency=10, workers=10,
+                mix=MIX, slowTime=SLOW_TIME, cpuTime=CPU_TIME, tick=0.1):
+    """Load test one scenario, return a dict of results"""
+    app = SyntheticApplication(slowTime, cpuTime)
+    paths = makePaths(requests, mix)
+    with watchdog(scenario, tick) as wrap:
+        with serving(wrap(app), workers) as port:
+            wall, latencies, errors = runLoad(port, paths, concurrency)
+    result = dict(scenario=scenario, requests=requests, errors=errors,
+                  throughput=len(latencies) / wall if wall else 0.0)
+    for p in PERCENTILES:
+        result['p%s' % p] = percentile(latencies, p)
+    return result
+
+
+def formatResult(result):
+    latencies = '  '.join(
+        'p%s %8.2f ms' % (p, (result['p%s' % p] or 0) * 1000)
+        for p in PERCENTILES)
+    return '%-8s %8.1f req/s  %s  errors %s' % (
+        result['scenario'], result['throughput'], latencies,
+        result['errors'])
+
+
+def parseMix(value):
+    mix = {}
+    for part in value.split(','):
+        mode, _, share = part.partition('=')
+        mix[mode.strip()] = float(share)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test the cipher.longrequest watchdog on localhost')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS,
+                        choices=SCENARIOS)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=10,
+                        help='server thread pool size')
+    parser.add_argument('--mix', type=parseMix,
+                        default=MIX, help='e.g. fast=0.9,slow=0.05,cpu=0.05')
+    parser.add_argument('--slow-time', type=float, default=SLOW_TIME)
+    parser.add_argument('--cpu-time', type=float, default=CPU_TIME)
+    parser.add_argument('--tick', type=float, default=0.1,
+                        help='checker tick when the watchdog runs')
+    args = parser.parse_args(argv)
+
+    for scenario in args.scenarios:
+        result = runScenario(scenario, args.requests, args.concurrency,
+                             args.workers, args.mix, args.slow_time,
+                             args.cpu_time, args.tick)
+        print(formatResult(result))
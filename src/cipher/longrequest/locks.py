@@ -0,0 +1,320 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Locks telling who holds them and who waits for them
+
+`TrackedLock` and `TrackedRLock` wrap the locks of the `_thread` module.
+`patch()` makes `threading.Lock` and `threading.RLock` create them, for
+the locks created from then on.
+"""
+import _thread
+import os
+import sys
+import threading
+import time
+
+
+# at most this many lock names get statistics
+MAX_LOCKS = 1000
+
+_originals = None
+
+
+class LockStats:
+    """Counters of the locks of one name"""
+
+    __slots__ = ('acquired', 'contended', 'waited', 'maxWaited', 'maxHeld')
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.waited = 0.0  # sec, in total
+        self.maxWaited = 0.0
+        self.maxHeld = 0.0
+
+    def __repr__(self):
+        return ('<LockStats acquired %s, contended %s, waited %.3f s,'
+                ' max wait %.3f s, max held %.3f s>' % (
+                    self.acquired, self.contended, self.waited,
+                    self.maxWaited, self.maxHeld))
+
+
+class LockTable:
+    """Who holds and who waits for tracked locks
+
+    `waiting` maps thread_id to (lock, since), `held` id(lock) to lock,
+    both change with every acquire and release, plain dict operations
+    which need no lock of their own.  `stats` maps lock names to
+    LockStats, for at most `maxSize` names, the others only get counted
+    in `dropped`.
+    """
+
+    def __init__(self, maxSize=MAX_LOCKS):
+        self.maxSize = maxSize
+        self.waiting = {}
+        self.held = {}
+        self.stats = {}
+        self.dropped = 0
+        self.lock = _thread.allocate_lock()
+
+    def getStats(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            with self.lock:
+                stats = self.stats.get(name)
+                if stats is None:
+                    if len(self.stats) >= self.maxSize:
+                        self.dropped += 1
+                        return None
+                    stats = self.stats[name] = LockStats()
+        return stats
+
+    def acquired(self, lock, waited):
+        self.held[id(lock)] = lock
+        stats = self.getStats(lock.name)
+        if stats is None:
+            return
+        stats.acquired += 1
+        if waited:
+            stats.contended += 1
+            stats.waited += waited
+            stats.maxWaited = max(stats.maxWaited, waited)
+
+    def released(self, lock, held):
+        self.held.pop(id(lock), None)
+        stats = self.getStats(lock.name)
+        if stats is not None:
+            stats.maxHeld = max(stats.maxHeld, held)
+
+    def getWait(self, thread_id):
+        """Return (lock, owner thread_id, seconds waited) or None"""
+        try:
+            lock, since = self.waiting[thread_id]
+        except KeyError:
+            return None
+        return lock, lock.owner, time.monotonic() - since
+
+    def getHeld(self):
+        """Return (lock, owner thread_id, seconds held) of the held locks"""
+        now = time.monotonic()
+        rv = []
+        for lock in list(self.held.values()):
+            owner, since = lock.owner, lock.since
+            if owner is not None:
+                rv.append((lock, owner, now - since))
+        return rv
+
+    def findCycle(self, thread_id):
+        """Return the threads waiting for each other in a circle
+
+        Starting with `thread_id` when it is part of the circle, as
+        [(thread_id, lock it waits for), ...], None if there is none.
+        """
+        path = []
+        seen = set()
+        current = thread_id
+        while current is not None and current not in seen:
+            try:
+                lock, since = self.waiting[current]
+            except KeyError:
+                return None
+            seen.add(current)
+            path.append((current, lock))
+            current = lock.owner
+        if current != thread_id:
+            # no circle, or a circle not including `thread_id`
+            return None
+        return path
+
+    def findDeadlocks(self):
+        """Return all circles of threads waiting for each other, once"""
+        cycles = []
+        found = set()
+        for thread_id in list(self.waiting):
+            if thread_id in found:
+                continue
+            cycle = self.findCycle(thread_id)
+            if cycle is not None:
+                found.update(waiter for waiter, lock in cycle)
+                cycles.append(cycle)
+        return cycles
+
+    def clear(self):
+        self.waiting.clear()
+        self.held.clear()
+        self.stats.clear()
+        self.dropped = 0
+
+
+TABLE = LockTable()
+
+
+class TrackedLock:
+    """A lock recording its owner, the threads waiting and the times
+
+    Works like `threading.Lock`, the wait for the lock and the time it
+    was held get recorded in `table`.
+    """
+
+    allocate = staticmethod(_thread.allocate_lock)
+
+    def __init__(self, name=None, table=None):
+        self._lock = self.allocate()
+        self.name = name or '%s at 0x%x' % (type(self).__name__, id(self))
+        self.table = TABLE if table is None else table
+        self.owner = None
+        self.since = None
+        self.count = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        me = _thread.get_ident()
+        if self._lock.acquire(False):
+            self._acquired(me, 0)
+            return True
+        if not blocking:
+            return False
+        return self._wait(me, self._lock.acquire, (True, timeout))
+
+    def _wait(self, me, acquire, args):
+        waiting = self.table.waiting
+        started = time.monotonic()
+        waiting[me] = (self, started)
+        try:
+            rv = acquire(*args)
+        finally:
+            del waiting[me]
+        if rv is not False:
+            self._acquired(me, time.monotonic() - started)
+        return rv
+
+    def _acquired(self, me, waited):
+        self.count = 1
+        self.owner = me
+        self.since = time.monotonic()
+        self.table.acquired(self, waited)
+
+    def release(self):
+        if not self.count:
+            raise RuntimeError("release unlocked lock")
+        self.count -= 1
+        if self.count:
+            self._lock.release()
+            return
+        held = time.monotonic() - self.since
+        self.owner = None
+        self.table.released(self, held)
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def _at_fork_reinit(self):
+        self._lock._at_fork_reinit()
+        self.owner = None
+        self.count = 0
+
+    def __repr__(self):
+        return '<%s %s owner=%s>' % (type(self).__name__, self.name,
+                                     self.owner)
+
+
+class TrackedRLock(TrackedLock):
+    """A re-entrant TrackedLock, works with `threading.Condition`"""
+
+    allocate = staticmethod(_thread.RLock)
+
+    def acquire(self, blocking=True, timeout=-1):
+        me = _thread.get_ident()
+        if self.owner == me:
+            self._lock.acquire()
+            self.count += 1
+            return True
+        if self._lock.acquire(False):
+            self._acquired(me, 0)
+            return True
+        if not blocking:
+            return False
+        return self._wait(me, self._lock.acquire, (True, timeout))
+
+    __enter__ = acquire
+
+    def release(self):
+        if self.owner != _thread.get_ident():
+            raise RuntimeError("cannot release un-acquired lock")
+        super().release()
+
+    def locked(self):
+        return self.owner is not None
+
+    # the protocol of threading.Condition
+
+    def _is_owned(self):
+        return self.owner == _thread.get_ident()
+
+    def _release_save(self):
+        count = self.count
+        held = time.monotonic() - self.since
+        self.owner = None
+        self.count = 0
+        self.table.released(self, held)
+        return self._lock._release_save(), count
+
+    def _acquire_restore(self, saved):
+        state, count = saved
+        me = _thread.get_ident()
+        self._wait(me, self._lock._acquire_restore, (state,))
+        self.count = count
+
+
+def getCreator(depth=2):
+    """Return filename:lineno of the code creating a lock"""
+    frame = sys._getframe(depth)
+    return '%s:%s' % (os.path.basename(frame.f_code.co_filename),
+                      frame.f_lineno)
+
+
+def makeLock():
+    return TrackedLock(getCreator())
+
+
+def makeRLock():
+    return TrackedRLock(getCreator())
+
+
+def patch():
+    """Make `threading.Lock` and `threading.RLock` create tracked locks
+
+    Only locks created afterwards get tracked, the locks get named after
+    the code creating them.
+    """
+    global _originals
+    if _originals is None:
+        _originals = (threading.Lock, threading.RLock)
+        threading.Lock = makeLock
+        threading.RLock = makeRLock
+
+
+def unpatch():
+    global _originals
+    if _originals is not None:
+        threading.Lock, threading.RLock = _originals
+        _originals = None
+
+
+def isPatched():
+    return _originals is not None
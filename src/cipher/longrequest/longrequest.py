@@ -11,52 +11,119 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import collections
 import copy
+import faulthandler
+import hmac
 import io
+import itertools
 import logging
-import pprint
+import os
 import re
+import signal
 import sys
 import threading
 import time
 import traceback
 from configparser import RawConfigParser
+from urllib.parse import parse_qsl
 
+import zope.event
 from paste.request import construct_url
-from paste.util.converters import asbool
+from paste.wsgilib import add_close
 from zope.component import adapter
+from zope.component import getSiteManager
+from zope.component.event import dispatch
 from zope.event import notify
+from zope.interface import providedBy
 
 from cipher.background.contextmanagers import ZopeInteraction
 from cipher.background.contextmanagers import ZopeTransaction
 from cipher.background.thread import BackgroundWorkerThread
+from cipher.longrequest import capture
+from cipher.longrequest import corunning
+from cipher.longrequest import health
+from cipher.longrequest import hitters
+from cipher.longrequest import incidents
 from cipher.longrequest import interfaces
+from cipher.longrequest import locks
+from cipher.longrequest import queuetime
+from cipher.longrequest import render
+from cipher.longrequest import spans
+from cipher.longrequest import stacks
+from cipher.longrequest import throttle
+from cipher.longrequest import tracing
+from cipher.longrequest.config import SECTION
+from cipher.longrequest.config import Config
+from cipher.longrequest.config import forSection
+from cipher.longrequest.config import fromOptions
+from cipher.longrequest.config import readFile
+from cipher.longrequest.thresholds import ThresholdLearner
+from cipher.longrequest.urls import URLNormalizer
+from cipher.longrequest.urls import getClientIP
+from cipher.longrequest.urls import reconstructURL
 
 
 LOG = logging.getLogger("cipher.longrequest")
 
 INITIAL_DELAY = 1  # sec
-TICK = 1  # sec
 
 THREAD = None
 THREADPOOL = None
 
-DURATION_LEVEL_1 = 2  # sec
-DURATION_LEVEL_2 = 10  # sec
-DURATION_LEVEL_3 = 30  # sec
-FINISHED_LOG_LEVEL = logging.INFO
-VERBOSE_LOG = False
-
+# duration levels, tick, verbose, finished log level, excluded URLs and
+# per-URL levels of the default monitor, replaced as a whole when they
+# change, read it once; the tick applies to all monitors
+CONFIG = Config()
+# writers of CONFIG take turns
+CONFIG_LOCK = threading.Lock()
+# ini file CONFIG gets reloaded from
+CONFIG_FILE = None
+# modification time of CONFIG_FILE when last read, None if not watched
+CONFIG_MTIME = None
+# set by the reload signal, the checker thread reloads on its next tick
+RELOAD_PENDING = False
+
+# URL showing the settings and changing them on POST, None if disabled,
+# requests need the ADMIN_TOKEN in an X-Longrequest-Token header
+ADMIN_URL = None
+ADMIN_TOKEN = None
+ADMIN_MAX_BODY = 64 * 1024  # bytes
+
+# thread_id -> zope request, maintained by the request threads themselves
 ZOPE_THREAD_REQUESTS = {}
 
-LOG_TEMPLATE = """Long running request detected
+# thread_id -> ThreadState of the request being served, maintained by the
+# checker thread, of the default monitor
+THREAD_STATES = {}
+
+# environment key of the monitor watching a request, if not the default
+MONITOR_KEY = 'cipher.longrequest.monitor'
+# WSGI environ key of the seconds a request waited for a thread
+QUEUE_DELAY_KEY = 'cipher.longrequest.queue_delay'
+# WSGI environ key of the id of a request
+REQUEST_ID_KEY = 'cipher.longrequest.request_id'
+# WSGI environ key set by the ThreadpoolCatcher doing the per request work
+CAUGHT_KEY = 'cipher.longrequest.caught'
+
+LOG_TEMPLATE = """Long running request detected%(where)s
 %(info)s
 %(others)s"""
 
-THREAD_TEMPLATE = """thread_id:%(thread_id)s
-duration:%(duration)s sec
+POOL_STATE_TEMPLATE = """Thread pool %(state)s, was %(old_state)s
+threads in use:%(threadsused)s of %(poolsize)s
+queued requests:%(queued)s%(diagnostics)s"""
+
+DIAGNOSTICS_TEMPLATE = """
+Lock owners:
+%(locks)s
+Threads:
+%(threads)s"""
+
+THREAD_TEMPLATE = """thread_id:%(thread_id)s%(requestid)s
+duration:%(duration)s sec%(queuewait)s
 URL:%(uri)s
-threads in use:%(threadsused)s
+threads in use:%(threadsused)s%(lockwait)s
 environment:%(worker_environ)s
 username:%(username)s
 form:%(form)s
@@ -64,10 +131,152 @@ Thread stack:
 %(traceback)s
 Top of stack"""
 
-IGNORE_URLS = []
+CORUNNING_TEMPLATE = """Co-running requests:
+%(requests)s"""
+
+LOCK_WAIT_TEMPLATE = """
+waiting %(waited).1f sec on lock %(lock)s held by thread %(owner)s%(holder)s"""
+
+INCIDENT_TEMPLATE = """Incident %(id)s opened, %(count)s requests
+URL templates:%(templates)s
+Stack:
+%(stack)s"""
+
+DEADLOCK_TEMPLATE = """Deadlock detected
+%(description)s
+%(threads)s"""
+
+# renders environments and forms for the reports
+RENDERER = render.Renderer()
+
+# 'traceback' to print stacks with the traceback module, 'fast' to capture
+# them with the stacks module
+STACK_CAPTURE = 'traceback'
+# number of innermost frames shown, None for all
+STACK_DEPTH = None
+
+# ticks the pool has to be saturated with no request finishing to be
+# stalled, and ticks it has to look better to leave a state
+STALL_TICKS = 5
+RECOVER_TICKS = 3
+
+# file faulthandler dumps the stacks of all threads to, None if disabled
+DUMP_FILE = None
+# seconds without a tick of the checker thread before faulthandler dumps
+# the stacks on its own, None if disabled, longer than the tick
+DUMP_TIMEOUT = None
+# generation of the snapshot of the tick the stacks were dumped in last
+DUMPED_GENERATION = None
+
+# ThresholdLearner learning levels from finished requests, None if disabled
+THRESHOLDS = None
+
+# hitters.SpaceSaving counting the long requests per principal, None if
+# disabled
+PRINCIPALS = None
+# the same per tenant, the value of TENANT_KEY in the WSGI environ
+TENANTS = None
+TENANT_KEY = None
+
+# corunning.CoRunning counting the URL templates busy together with long
+# requests, None if disabled
+CORUNNING = corunning.CoRunning()
+# whether verbose reports summarize the other requests, instead of
+# reporting them in full
+CORUNNING_SUMMARY = False
+
+# queuetime.Histogram of the seconds requests waited for a thread, None
+# if not measured
+QUEUE_TIMES = None
+# WSGI environ keys of the headers telling when proxies got the requests
+QUEUE_HEADERS = queuetime.HEADERS
+# sec, the pool counts as saturated when requests wait this long, None to
+# tell by the busy threads only
+QUEUE_SATURATION = None
+
+# whether requests get an id, from X-Request-ID or traceparent if they
+# have one
+REQUEST_IDS = False
+# response header telling the id of the request, None for none
+REQUEST_ID_RESPONSE_HEADER = None
+
+# spans.SpanExporter writing long requests as OTLP/JSON spans, None if
+# disabled
+SPAN_EXPORTER = None
+# thread_id -> spans.Span of the long request being served
+RUNNING_SPANS = {}
+
+# throttle.ReportThrottle rate limiting the long request reports, None for
+# no limit
+THROTTLE = None
+# more busy threads than this turn verbose reports into summaries, None
+# for no limit
+VERBOSE_MAX_THREADS = 20
+
+# incidents.IncidentTracker grouping long requests into incidents, None
+# if disabled
+INCIDENTS = None
+# innermost frames telling whether the stacks of requests are alike
+INCIDENT_STACK_DEPTH = 30
+
+# maps URLs to templates, for bounded per-URL data
+NORMALIZER = URLNormalizer()
+
+BULKHEADS = []
+BULKHEAD_WAIT = 0  # sec, how long an excess request may wait for a slot
+
+# directory to persist slow requests to, None disables capturing
+CAPTURE_DIR = None
+CAPTURE_LEVEL = 2  # capture requests over this duration level
+CAPTURE_MEMORY = 64 * 1024  # bytes, bigger request bodies go to a file
+CAPTURE_MAX_BODY = 10 * 1024 * 1024  # bytes, bigger bodies are not captured
+CAPTURE_REDACT = capture.REDACTED_HEADERS
+
+# (thread_id, request id) -> capture.Capture of the request being served
+CAPTURES = {}
+
+BULKHEAD_REJECT_STATUS = '503 Service Unavailable'
+BULKHEAD_REJECT_BODY = b'Too many concurrent requests, retry later.\n'
 
 NOW = time.time  # testing hook
 
+_generations = itertools.count(1)
+
+
+class PoolSnapshot:
+    """A consistent copy of the thread pool's worker_tracker
+
+    Taken once per tick and shared by everything looking at the workers
+    in that tick.  `workers` maps thread_id to (time_started, environ),
+    `generation` increases with every snapshot.
+    """
+
+    def __init__(self, worker_tracker, generation, now):
+        # dict.copy() runs no Python code, so it can't be interrupted by
+        # worker threads adding or removing themselves
+        workers = worker_tracker.copy()
+        self.workers = {thread_id: tuple(value)
+                        for thread_id, value in workers.items()}
+        self.generation = generation
+        self.now = now
+        # of the busy requests, computed once when needed, see getCorunning
+        self.corunning = None
+        self.templates = None
+        self.corunningLines = None
+
+    def __len__(self):
+        return len(self.workers)
+
+    def __repr__(self):
+        return '<PoolSnapshot generation %s, %s workers>' % (
+            self.generation, len(self.workers))
+
+
+def takeSnapshot(thread_pool, now=None):
+    if now is None:
+        now = NOW()
+    return PoolSnapshot(thread_pool.worker_tracker, next(_generations), now)
+
 
 class RequestCheckerThread(BackgroundWorkerThread):
 
@@ -82,8 +291,10 @@ class RequestCheckerThread(BackgroundWorkerThread):
 
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
-        self.notified = {}
-        self.lastDuration = {}
+        self.health = health.PoolHealth(STALL_TICKS, RECOVER_TICKS,
+                                        QUEUE_SATURATION)
+        # keys of the deadlocks notified, see checkDeadlocks
+        self.deadlocks = set()
 
     def run(self):
         if INITIAL_DELAY:
@@ -126,18 +337,33 @@ class RequestCheckerThread(BackgroundWorkerThread):
             self.log.exception("Exception in %s, thread terminated", self.name)
 
     def scheduleNextWork(self):
-        time.sleep(TICK)
+        time.sleep(CONFIG.tick)
         return self.running
 
-    def prevRequestFinished(self, thread_id):
-        # notify before the fact gets deleted
-        ld = self.lastDuration[thread_id]
+    def requestFinished(self, thread_id, state, finished, monitor=None):
+        if state.duration is None:
+            # was never a long request
+            return
+        if monitor is None:
+            monitor = MONITOR
+        if state.consumers:
+            finishConsumers(state)
         # collect stats
-        self.maxRequestTime = max(self.maxRequestTime, ld[0])
-        notify(interfaces.LongRequestFinishedEvent(thread_id, ld[0], ld[2]))
-        del self.lastDuration[thread_id]
+        self.maxRequestTime = max(self.maxRequestTime, state.duration)
+        monitor.maxRequestTime = max(monitor.maxRequestTime, state.duration)
+        event = interfaces.LongRequestFinishedEvent(
+            thread_id, state.duration, state.uri, template=state.template,
+            monitor=monitor, request_id=state.request_id)
+        DISPATCHER.notify(event)
+        finished.append(event)
 
     def doWork(self):
+        # the checker is alive, push the dump timer back
+        armDumpTimer()
+
+        if RELOAD_PENDING or CONFIG_MTIME is not None:
+            checkConfigFile()
+
         if THREADPOOL is None:
             # no threadpool yet, return ASAP
             return
@@ -146,111 +372,357 @@ class RequestCheckerThread(BackgroundWorkerThread):
 
         now = NOW()
 
-        #  allThreadIds = dict([(t.thread_id, 1) for t in THREADPOOL.workers])
-        workingThreadIds = {k: 1
-                            for k in THREADPOOL.worker_tracker.keys()}
+        # one view of the workers for the whole tick, and all monitors
+        snapshot = takeSnapshot(THREADPOOL, now)
+        workingThreadIds = snapshot.workers
         self.maxThreadsUsed = max(len(workingThreadIds), self.maxThreadsUsed)
 
+        queueDelay = None
+        if QUEUE_TIMES is not None:
+            queueDelay = QUEUE_TIMES.getPeak(clear=True)
+        change = self.health.update(
+            workingThreadIds, health.getPoolSize(THREADPOOL), queueDelay)
+        if change is not None:
+            self.poolStateChanged(change, snapshot)
+
+        if locks.TABLE.waiting:
+            self.checkDeadlocks(snapshot)
+
         # THREADPOOL.worker_tracker has ONLY the threads which are
         # doing some work!
 
-        # clean up notification dict, in case threads get killed
-        for thread_id in tuple(self.notified.keys()):
-            if thread_id not in workingThreadIds:
-                del self.notified[thread_id]
+        # events of this tick, for the batch event
+        crossings = []
+        finished = []
 
-        # clean up lastDuration dict, in case threads get killed
-        for thread_id in tuple(self.lastDuration.keys()):
-            if thread_id not in workingThreadIds:
-                self.prevRequestFinished(thread_id)
+        monitors = MONITORS
+        if len(monitors) == 1:
+            assigned = ((monitors[0], workingThreadIds),)
+        else:
+            assigned = assignWorkers(monitors, workingThreadIds).items()
+
+        for monitor, workers in assigned:
+            monitor.expire(self, workers, finished)
 
         # clean up ZOPE_THREAD_REQUESTS dict, in case threads get killed
-        for thread_id in tuple(ZOPE_THREAD_REQUESTS.keys()):
+        # request threads change it meanwhile, copy the keys at once
+        for thread_id in tuple(ZOPE_THREAD_REQUESTS):
             if thread_id not in workingThreadIds:
-                del ZOPE_THREAD_REQUESTS[thread_id]
+                ZOPE_THREAD_REQUESTS.pop(thread_id, None)
+
+        if DISPATCHER.hasSubscribers(interfaces.ILongRequestTickEvent):
+            notify(interfaces.LongRequestTickEvent(THREADPOOL, snapshot))
+
+        for monitor, workers in assigned:
+            monitor.check(self, snapshot, workers, crossings, finished)
+
+        if ((crossings or finished) and
+                DISPATCHER.hasSubscribers(interfaces.ILongRequestBatchEvent)):
+            notify(interfaces.LongRequestBatchEvent(
+                crossings, finished, snapshot))
+
+        if INCIDENTS is not None:
+            self.checkIncidents(snapshot)
+
+        if THROTTLE is not None:
+            for level, count in THROTTLE.takeSuppressed():
+                DISPATCHER.notify(interfaces.ReportsSuppressedEvent(
+                    level, count, snapshot))
+
+    def poolStateChanged(self, change, snapshot):
+        old_state, state = change
+        if state != health.STALLED:
+            DISPATCHER.notify(interfaces.PoolStateChangedEvent(
+                old_state, state, snapshot))
+        elif DISPATCHER.hasSubscribers(interfaces.IPoolStalledEvent):
+            # once per stall, it may take a while
+            notify(interfaces.PoolStalledEvent(
+                old_state, state, snapshot,
+                getPoolDiagnostics(THREADPOOL, snapshot)))
+
+    def checkDeadlocks(self, snapshot):
+        """Notify the circles of threads waiting for tracked locks, once"""
+        found = set()
+        for cycle in locks.TABLE.findDeadlocks():
+            key = frozenset((thread_id, id(lock)) for thread_id, lock in cycle)
+            found.add(key)
+            if key not in self.deadlocks:
+                DISPATCHER.notify(interfaces.DeadlockEvent(
+                    cycle, formatDeadlock(cycle), snapshot))
+        self.deadlocks = found
+
+    def checkIncidents(self, snapshot):
+        """Group the long requests of the tick into incidents, notify"""
+        tracker = INCIDENTS
+        running = {}
+        for monitor in MONITORS:
+            for thread_id, state in list(monitor.states.items()):
+                if state.duration is not None:
+                    running[(thread_id, state.time_started)] = state
+        new = []
+        frames = None
+        for key, state in running.items():
+            if tracker.isKnown(key):
+                continue
+            if frames is None:
+                # once per tick, only if needed
+                frames = sys._current_frames()
+            try:
+                frame = frames[key[0]]
+            except KeyError:
+                # finished meanwhile
+                continue
+            new.append((key, state.template,
+                        stacks.capture(frame, INCIDENT_STACK_DEPTH)))
+        opened, updated, closed = tracker.update(running, new, snapshot.now)
+        for eventClass, changed in (
+                (interfaces.IncidentOpenedEvent, opened),
+                (interfaces.IncidentUpdatedEvent, updated),
+                (interfaces.IncidentClosedEvent, closed)):
+            for incident in changed:
+                DISPATCHER.notify(eventClass(incident, snapshot))
+
+    def removeWSGIStuff(self, environ):
+        rv = {}
+        for k in tuple(environ.keys()):
+            if (k.startswith('wsgi.') or k.startswith('paste.')
+                    or k.startswith('weberror.')
+                    or k.startswith('cipher.longrequest.')):
+                continue
+            else:
+                rv[k] = environ[k]
+        return rv
+
+    def getMaxRequestTime(self, clear=False):
+        rv = self.maxRequestTime
+        if clear:
+            self.maxRequestTime = 0
+        return rv
+
+    def getMaxThreadsUsed(self, clear=False):
+        rv = self.maxThreadsUsed
+        if clear:
+            self.maxThreadsUsed = 0
+        return rv
+
+
+def startRequestHandler(event):
+    try:
+        thread = threading.currentThread()
+        ZOPE_THREAD_REQUESTS[thread.thread_id] = event.request
+    except:  # noqa: E722 do not use bare 'except'
+        pass
+
+
+def endRequestHandler(event):
+    try:
+        thread = threading.currentThread()
+        ZOPE_THREAD_REQUESTS.pop(thread.thread_id, None)
+    except:  # noqa: E722 do not use bare 'except'
+        pass
+
+
+def getURI(worker_environ):
+    # worker_environ can go away anytime, protect against that
+    try:
+        uri = reconstructURL(worker_environ)
+    except:  # noqa: E722 do not use bare 'except'
+        uri = 'n/a'
+    return uri
+
+
+def getServerURL(environ):
+    """Return the URL as the server got it, ignoring any proxy headers
 
-        notify(interfaces.LongRequestTickEvent(THREADPOOL))
-        workers = THREADPOOL.worker_tracker.items()
-        for thread_id, (time_started, worker_environ) in workers:
+    Clients can send those headers, so what limits them must not trust them.
+    """
+    try:
+        uri = construct_url(environ)
+    except:  # noqa: E722 do not use bare 'except'
+        uri = 'n/a'
+    return uri
+
+
+class ThreadState:
+    """What the checker thread knows about the request a thread serves
+
+    `duration` is the last duration over a level, None while the request
+    is not a long one, `notified` the event class notified last.
+    `consumers` are the (hitters.SpaceSaving, key) counting the request,
+    None until it is a long one, `accounted` the seconds added to them.
+    """
+
+    __slots__ = ('time_started', 'uri', 'client_ip', 'template',
+                 'zope_request', 'duration', 'notified', 'consumers',
+                 'accounted', 'request_id')
+
+    def __init__(self, time_started):
+        self.time_started = time_started
+        self.uri = None
+        self.client_ip = None
+        self.template = None
+        self.zope_request = None
+        self.duration = None
+        self.notified = None
+        self.consumers = None
+        self.accounted = 0
+        self.request_id = None
+
+    def getURI(self, worker_environ):
+        """Return (uri, client_ip) of the request, computed once"""
+        if self.uri is None:
+            self.uri = getURI(worker_environ)
+            try:
+                self.client_ip = getClientIP(worker_environ)
+            except:  # noqa: E722 do not use bare 'except'
+                self.client_ip = None
+        return self.uri, self.client_ip
+
+    def __repr__(self):
+        return '<ThreadState %s started %s>' % (self.uri, self.time_started)
+
+
+def getRequestURI(thread_id, time_started, worker_environ):
+    """Return (uri, client_ip) of the request served by a thread
+
+    Computed once per request, time_started is a sort of ID for the request.
+    """
+    states = getMonitor(worker_environ).states
+    state = states.get(thread_id)
+    if state is None:
+        state = states[thread_id] = ThreadState(time_started)
+    elif state.time_started != time_started:
+        # leave replacing the state of a finished request to the checker
+        # thread, it has to notify about it
+        state = ThreadState(time_started)
+    return state.getURI(worker_environ)
+
+
+class Monitor:
+    """The settings and the state of watching the requests of an application
+
+    The one checker thread serves all monitors, sampling the thread pool
+    once per tick for all of them.  The requests get watched by the
+    monitor of the innermost ThreadpoolCatcher they pass, the others by
+    the default monitor, MONITOR.
+    """
+
+    maxRequestTime = 0
+
+    def __init__(self, name, config=None, section=SECTION, states=None):
+        self.name = name
+        # of the ini file, for reloading
+        self.section = section
+        self.config = Config() if config is None else config
+        # thread_id -> ThreadState of the request being served
+        self.states = {} if states is None else states
+
+    def expire(self, checker, workers, finished):
+        """Notify the requests gone since the last tick
+
+        Finished or killed, only the threads having a state get looked at.
+        """
+        states = self.states
+        for thread_id in states.keys() - workers.keys():
+            state = states.pop(thread_id, None)
+            if state is not None:
+                checker.requestFinished(thread_id, state, finished, self)
+
+    def check(self, checker, snapshot, workers, crossings, finished):
+        """Notify the requests of `workers` crossing a level"""
+        # the same settings for the whole tick
+        config = self.config
+        states = self.states
+        now = snapshot.now
+        for thread_id, (time_started, worker_environ) in workers.items():
             # make a duplicate of worker_environ ASAP
             worker_environ = copy.copy(worker_environ)
 
             duration = int(now - time_started)
 
-            # check whether there was a previous request on this thread
-            try:
-                ld = self.lastDuration[thread_id]
-                if ld[0] > duration or worker_environ is None:
-                    # there was a previous request that finished
-                    self.prevRequestFinished(thread_id)
-            except KeyError:
-                pass
+            # check whether there was a previous request on this thread,
+            # time_started is a sort of ID for the request
+            state = states.get(thread_id)
+            if state is not None and (state.time_started != time_started
+                                      or worker_environ is None):
+                # there was a previous request that finished
+                del states[thread_id]
+                checker.requestFinished(thread_id, state, finished, self)
+                state = None
 
             if not worker_environ:
                 # ignore requests without a worker_environ
                 continue
 
-            # check duration against levels
-            if DURATION_LEVEL_3 and duration > DURATION_LEVEL_3:
-                event = interfaces.LongRequestEventOver3
-            elif DURATION_LEVEL_2 and duration > DURATION_LEVEL_2:
-                event = interfaces.LongRequestEventOver2
-            elif DURATION_LEVEL_1 and duration > DURATION_LEVEL_1:
-                event = interfaces.LongRequestEventOver1
+            if config.urlThresholds or THRESHOLDS is not None:
+                # levels depend on the URL
+                if state is None:
+                    state = states[thread_id] = ThreadState(time_started)
+                uri, client_ip = state.getURI(worker_environ)
+                levels = getDurationLevels(uri, config)
             else:
+                levels = config.durationLevels
+
+            # check duration against levels
+            event = getLevelEvent(duration, levels)
+            if event is None:
                 # duration is under any limits
                 continue
 
-            # construct a URL from the request
-            uri = getURI(worker_environ)
+            if state is None:
+                state = states[thread_id] = ThreadState(time_started)
+            # construct a URL from the request, once
+            uri, client_ip = state.getURI(worker_environ)
 
             # check ignored URLs
             bail = False
-            for ignore in IGNORE_URLS:
+            for ignore in config.ignoreURLs:
                 if ignore.match(uri):
                     bail = True
                     break
             if bail:
                 continue
 
-            worker_environ = self.removeWSGIStuff(worker_environ)
+            queue_delay = worker_environ.get(QUEUE_DELAY_KEY)
+            if state.request_id is None:
+                state.request_id = worker_environ.get(REQUEST_ID_KEY)
+            worker_environ = checker.removeWSGIStuff(worker_environ)
 
             # mmm, this does not work, I guess wsgi.input is consumed
             # form = parse_formvars(worker_environ)
 
-            try:
-                zope_request = ZOPE_THREAD_REQUESTS[thread_id]
-            except KeyError:
-                zope_request = None
-
-            # remember current duration and URL
-            self.lastDuration[thread_id] = (duration, time_started, uri)
+            if state.zope_request is None:
+                state.zope_request = ZOPE_THREAD_REQUESTS.get(thread_id)
 
-            try:
-                notifiedEvent, notifiedTime = self.notified[thread_id]
-                if event == notifiedEvent and time_started == notifiedTime:
-                    # the request / timeout level we just detected was already
-                    # notified, be quiet until something else happens
-                    continue
-            except KeyError:
-                pass
+            if state.template is None:
+                state.template = getURLTemplate(uri)
 
-            # shoot the event
-            notify(event(
-                thread_id, duration, uri, worker_environ, zope_request))
+            # remember current duration
+            state.duration = duration
 
-            # remember the event, time_started is a sort of ID for the request
-            self.notified[thread_id] = (event, time_started)
+            if PRINCIPALS is not None or TENANTS is not None:
+                accountConsumers(state, worker_environ)
 
-    def removeWSGIStuff(self, environ):
-        rv = {}
-        for k in tuple(environ.keys()):
-            if (k.startswith('wsgi.') or k.startswith('paste.')
-                    or k.startswith('weberror.')):
+            if event is state.notified:
+                # the timeout level we just detected was already notified,
+                # be quiet until something else happens
                 continue
-            else:
-                rv[k] = environ[k]
-        return rv
+
+            if state.notified is None and CORUNNING is not None:
+                # once per long request
+                CORUNNING.record(state.template, getTemplateCounts(snapshot))
+
+            # shoot the event
+            notified = event(
+                thread_id, duration, uri, worker_environ, state.zope_request,
+                template=state.template, client_ip=client_ip,
+                snapshot=snapshot, monitor=self, queue_delay=queue_delay,
+                request_id=state.request_id)
+            DISPATCHER.notify(notified)
+            crossings.append(notified)
+
+            # remember the event
+            state.notified = event
 
     def getMaxRequestTime(self, clear=False):
         rv = self.maxRequestTime
@@ -258,115 +730,468 @@ class RequestCheckerThread(BackgroundWorkerThread):
             self.maxRequestTime = 0
         return rv
 
-    def getMaxThreadsUsed(self, clear=False):
-        rv = self.maxThreadsUsed
-        if clear:
-            self.maxThreadsUsed = 0
-        return rv
+    def __repr__(self):
+        return '<Monitor %s>' % self.name
 
 
-def startRequestHandler(event):
-    try:
-        thread = threading.currentThread()
-        ZOPE_THREAD_REQUESTS[thread.thread_id] = event.request
-    except:  # noqa: E722 do not use bare 'except'
-        pass
+class DefaultMonitor(Monitor):
+    """The monitor of the requests passing no other, its settings are CONFIG
+    """
 
+    def __init__(self):
+        super().__init__('', states=THREAD_STATES)
 
-def endRequestHandler(event):
-    try:
-        thread = threading.currentThread()
-        del ZOPE_THREAD_REQUESTS[thread.thread_id]
-    except:  # noqa: E722 do not use bare 'except'
-        pass
+    @property
+    def config(self):
+        return CONFIG
 
+    @config.setter
+    def config(self, config):
+        global CONFIG
+        CONFIG = config
 
-def getURI(worker_environ):
-    # worker_environ can go away anytime, protect against that
+    def __repr__(self):
+        return '<DefaultMonitor>'
+
+
+MONITOR = DefaultMonitor()
+# all monitors, the default one first, replaced as a whole to add one
+MONITORS = (MONITOR,)
+
+
+def registerMonitor(monitor):
+    global MONITORS
+    if monitor not in MONITORS:
+        MONITORS += (monitor,)
+
+
+def findMonitor(section):
+    """Return the monitor configured by `section`, None if there is none"""
+    for monitor in MONITORS:
+        if monitor.section == section:
+            return monitor
+    return None
+
+
+def getMonitor(worker_environ):
+    """Return the monitor watching a request"""
     try:
-        uri = worker_environ['HTTP_X_FORWARDED_FOR']
-    except:  # noqa: E722 do not use bare 'except'
+        monitor = worker_environ.get(MONITOR_KEY)
+    except AttributeError:
+        monitor = None
+    return MONITOR if monitor is None else monitor
+
+
+def assignWorkers(monitors, workers):
+    """Return {monitor: {thread_id: (time_started, environ)}} of `workers`"""
+    assigned = {monitor: {} for monitor in monitors}
+    default = assigned[MONITOR]
+    for thread_id, value in workers.items():
+        environ = value[1]
+        monitor = environ.get(MONITOR_KEY) if environ else None
+        assigned.get(monitor, default)[thread_id] = value
+    return assigned
+
+
+def getURLTemplate(uri):
+    """Return the template of `uri`, to aggregate data per URL"""
+    return NORMALIZER.normalize(uri)
+
+
+def getDurationLevels(uri, config=None):
+    """Return the (level 1, level 2, level 3) durations applying to `uri`
+
+    Explicitly configured URL thresholds win over learned ones, which win
+    over the global duration levels of `config`, CONFIG by default.
+    """
+    if config is None:
+        config = CONFIG
+    for pattern, levels in config.urlThresholds:
+        if pattern.match(uri):
+            return levels
+    if THRESHOLDS is not None:
+        levels = THRESHOLDS.getLevels(getURLTemplate(uri))
+        if levels is not None:
+            return levels
+    return config.durationLevels
+
+
+def getLevelEvent(duration, levels):
+    """Return the event class for the highest level `duration` exceeds"""
+    level1, level2, level3 = levels
+    if level3 and duration > level3:
+        return interfaces.LongRequestEventOver3
+    elif level2 and duration > level2:
+        return interfaces.LongRequestEventOver2
+    elif level1 and duration > level1:
+        return interfaces.LongRequestEventOver1
+    return None
+
+
+def recordDuration(uri, time_started):
+    """Feed the duration of a finished request to the threshold learner"""
+    learner = THRESHOLDS
+    if learner is not None:
+        learner.record(getURLTemplate(uri), NOW() - time_started)
+
+
+def getPrincipal(zope_request, worker_environ):
+    """Return the id of the principal of a request, None if not known"""
+    if zope_request is not None:
         try:
-            uri = construct_url(worker_environ)
+            return zope_request.principal.id
         except:  # noqa: E722 do not use bare 'except'
-            uri = 'n/a'
-    return uri
+            pass
+    return worker_environ.get('REMOTE_USER') or None
 
 
-def getAllThreadInfo(omitThreads=()):
-    now = NOW()
+def accountConsumers(state, worker_environ):
+    """Add the seconds of a long request to its principal and tenant
+
+    The whole duration, counted since the request started.
+    """
+    if state.consumers is None:
+        consumers = []
+        principal = getPrincipal(state.zope_request, worker_environ)
+        tenant = worker_environ.get(TENANT_KEY) if TENANT_KEY else None
+        for counter, key in ((PRINCIPALS, principal), (TENANTS, tenant)):
+            if (counter is not None and key is not None
+                    and counter.started(key)):
+                consumers.append((counter, key))
+        state.consumers = consumers
+    seconds = state.duration - state.accounted
+    if seconds > 0:
+        state.accounted = state.duration
+        for counter, key in state.consumers:
+            counter.add(key, seconds)
+
+
+def finishConsumers(state):
+    for counter, key in state.consumers:
+        counter.finished(key)
+    state.consumers = None
+
+
+def getTopPrincipals(n=10):
+    """Return [(principal id, HitterStats), ...], most long seconds first
+
+    The stats are those of the long requests, the ones still running
+    count with the duration seen last.
+    """
+    if PRINCIPALS is None:
+        raise ValueError("Not counting principals")
+    return PRINCIPALS.top(n)
+
+
+def getTopTenants(n=10):
+    """Return [(tenant, HitterStats), ...], most long seconds first"""
+    if TENANTS is None:
+        raise ValueError("Not counting tenants")
+    return TENANTS.top(n)
+
+
+def getAllThreadInfo(omitThreads=(), snapshot=None):
+    if snapshot is None:
+        snapshot = takeSnapshot(THREADPOOL)
+    now = snapshot.now
 
     infos = []
-    workers = THREADPOOL.worker_tracker.items()
-    for thread_id, (time_started, worker_environ) in workers:
+    for thread_id, (time_started, worker_environ) in snapshot.workers.items():
         if thread_id in omitThreads or not worker_environ:
             continue
 
         duration = int(now - time_started)
-        uri = getURI(worker_environ)
+        uri, client_ip = getRequestURI(thread_id, time_started, worker_environ)
+        zope_request = ZOPE_THREAD_REQUESTS.get(thread_id)
 
+        infos.append(formatThreadInfo(
+            thread_id, duration, uri, worker_environ, zope_request, snapshot,
+            worker_environ.get(QUEUE_DELAY_KEY),
+            worker_environ.get(REQUEST_ID_KEY)))
+
+    return infos
+
+
+def hasSubscribers(iface):
+    """Whether notifying an event providing `iface` reaches any subscriber
+
+    The lookup in the component registry is cached by the registry.
+    """
+    for subscriber in zope.event.subscribers:
+        if subscriber is not dispatch:
+            # somebody listens to all events
+            return True
+    return bool(getSiteManager().adapters.subscriptions((iface,), None))
+
+
+class Dispatcher:
+    """Notify events, skipping the ones nobody subscribes to
+
+    Whether there are subscribers gets cached per interface, until the
+    component registry or the zope.event subscribers change.
+    """
+
+    def __init__(self):
+        # (registry key, {interface: has subscribers}), replaced as a whole
+        self.cache = (None, {})
+
+    def getRegistryKey(self):
+        adapters = getSiteManager().adapters
+        # the registry counts its changes, including those of its bases
+        return (adapters, adapters._generation, tuple(zope.event.subscribers))
+
+    def hasSubscribers(self, iface):
+        key = self.getRegistryKey()
+        cachedKey, cache = self.cache
+        if cachedKey != key:
+            cache = {}
+            self.cache = (key, cache)
         try:
-            zope_request = ZOPE_THREAD_REQUESTS[thread_id]
+            return cache[iface]
         except KeyError:
-            zope_request = None
+            rv = cache[iface] = hasSubscribers(iface)
+            return rv
 
-        dummyevent = interfaces.LongRequestEvent(thread_id, duration, uri,
-                                                 worker_environ, zope_request)
+    def notify(self, event):
+        """Notify `event` if anybody listens, return whether it was"""
+        if not self.hasSubscribers(providedBy(event)):
+            return False
+        notify(event)
+        return True
 
-        infos.append(getFormattedThreadinfo(dummyevent))
 
-    return infos
+DISPATCHER = Dispatcher()
 
 
 def getThreadTraceback(thread_id):
     try:
         frame = sys._current_frames()[thread_id]
-        buf = io.StringIO()
-        traceback.print_stack(frame, file=buf)
-        return buf.getvalue()
     except KeyError:
         # if thread is already finished
         return '  ???'
+    if STACK_CAPTURE == 'fast':
+        return stacks.capture(frame, STACK_DEPTH).format()
+    buf = io.StringIO()
+    if STACK_DEPTH is None:
+        traceback.print_stack(frame, file=buf)
+    else:
+        traceback.print_stack(frame, limit=STACK_DEPTH, file=buf)
+    return buf.getvalue()
+
+
+def getLockWait(thread_id, snapshot=None):
+    """Return the tracked lock `thread_id` waits for as text, '' if none"""
+    table = locks.TABLE
+    if not table.waiting:
+        return ''
+    wait = table.getWait(thread_id)
+    if wait is None:
+        return ''
+    lock, owner, waited = wait
+    if snapshot is None and THREADPOOL is not None:
+        snapshot = takeSnapshot(THREADPOOL)
+    holder = ''
+    if snapshot is not None and snapshot.workers.get(owner, (0, None))[1]:
+        time_started, worker_environ = snapshot.workers[owner]
+        uri, client_ip = getRequestURI(owner, time_started, worker_environ)
+        holder = ' (itself running %s for %s sec)' % (
+            RENDERER.truncate(uri), int(snapshot.now - time_started))
+    rv = LOCK_WAIT_TEMPLATE % dict(
+        waited=waited, lock=lock.name, owner=owner, holder=holder)
+    cycle = table.findCycle(thread_id)
+    if cycle is not None:
+        rv += '\n' + formatDeadlock(cycle)
+    return rv
+
+
+def formatDeadlock(cycle):
+    return 'deadlock: ' + ', '.join(
+        'thread %s waits on lock %s held by thread %s' % (
+            thread_id, lock.name, lock.owner)
+        for thread_id, lock in cycle)
+
+
+def getCorunning(snapshot):
+    """Return the busy requests of `snapshot`, longest first
+
+    As [(thread_id, URL template, duration), ...].  Computed once per
+    snapshot, all long requests of a tick share it.
+    """
+    rv = snapshot.corunning
+    if rv is not None:
+        return rv
+    now = snapshot.now
+    rv = []
+    for thread_id, (time_started, worker_environ) in snapshot.workers.items():
+        if not worker_environ:
+            continue
+        # no state gets added, only long requests need one
+        state = getMonitor(worker_environ).states.get(thread_id)
+        if (state is not None and state.time_started == time_started
+                and state.uri is not None):
+            uri = state.uri
+        else:
+            uri = getURI(worker_environ)
+        rv.append((thread_id, getURLTemplate(uri), int(now - time_started)))
+    rv.sort(key=lambda item: -item[2])
+    snapshot.corunning = rv
+    return rv
+
+
+def getTemplateCounts(snapshot):
+    """Return {URL template: number of requests} busy in `snapshot`"""
+    rv = snapshot.templates
+    if rv is None:
+        rv = snapshot.templates = collections.Counter(
+            template for thread_id, template, duration
+            in getCorunning(snapshot))
+    return rv
+
+
+def getTopFrame(frames, thread_id):
+    """Return file:line in function, where a thread is"""
+    try:
+        frame = frames[thread_id]
+    except KeyError:
+        return 'n/a'
+    code = frame.f_code
+    return '%s:%s in %s' % (os.path.basename(code.co_filename),
+                            frame.f_lineno, code.co_name)
+
+
+def formatCorunning(thread_id, snapshot=None):
+    """Return a line per other request of `snapshot`, '' if there are none
+
+    The lines get formatted once per snapshot, with where the threads are
+    then.
+    """
+    if snapshot is None:
+        if THREADPOOL is None:
+            return ''
+        snapshot = takeSnapshot(THREADPOOL)
+    lines = snapshot.corunningLines
+    if lines is None:
+        frames = sys._current_frames()
+        lines = snapshot.corunningLines = [
+            (other, '  thread_id:%s duration:%s sec %s at %s' % (
+                other, duration, RENDERER.truncate(template),
+                getTopFrame(frames, other)))
+            for other, template, duration in getCorunning(snapshot)]
+    others = [line for other, line in lines if other != thread_id]
+    if not others:
+        return ''
+    return CORUNNING_TEMPLATE % dict(requests='\n'.join(others))
+
+
+def getCorunningPairs(n=10, template=None):
+    """Return [((template, template), count), ...], most counted first
+
+    How often requests of the two URL templates were busy together when
+    one of them became a long request, only the pairs including
+    `template`, if given.
+    """
+    if CORUNNING is None:
+        raise ValueError("Not counting co-running requests")
+    return CORUNNING.top(n, template)
 
 
 def getFormattedThreadinfo(event):
+    return formatThreadInfo(event.thread_id, event.duration, event.uri,
+                            event.worker_environ, event.zope_request,
+                            event.snapshot,
+                            getattr(event, 'queue_delay', None),
+                            getattr(event, 'request_id', None))
+
+
+def formatThreadInfo(thread_id, duration, uri, worker_environ, zope_request,
+                     snapshot=None, queue_delay=None, request_id=None):
+    renderer = RENDERER
     username = ''
     form = ''
-    if event.zope_request is not None:
+    if zope_request is not None:
         try:
-            username = event.zope_request.principal.id
+            username = zope_request.principal.id
         except:  # noqa: E722 do not use bare 'except'
             pass
         try:
-            form = event.zope_request.form
-            form = pprint.pformat(form)
+            form = zope_request.form
+            form = renderer.render(form)
         except:  # noqa: E722 do not use bare 'except'
             pass
     try:
-        worker_environ = pprint.pformat(event.worker_environ)
+        environ = renderer.render(worker_environ)
     except:  # noqa: E722 do not use bare 'except'
-        worker_environ = event.worker_environ
-    data = dict(thread_id=event.thread_id,
-                duration=event.duration,
-                uri=event.uri,
-                worker_environ=worker_environ,
+        # never dump it unbounded
+        environ = 'n/a'
+    queuewait = ''
+    if queue_delay is not None:
+        queuewait = '\nqueue wait:%.3f sec' % queue_delay
+    requestid = ''
+    if request_id is not None:
+        requestid = '\nrequest_id:%s' % request_id
+    data = dict(thread_id=thread_id,
+                requestid=requestid,
+                duration=duration,
+                queuewait=queuewait,
+                uri=renderer.truncate(uri),
+                worker_environ=environ,
                 username=username,
                 form=form,
-                traceback=getThreadTraceback(event.thread_id),
-                threadsused=getThreadsUsed())
+                traceback=getThreadTraceback(thread_id),
+                threadsused=getThreadsUsed(snapshot),
+                lockwait=getLockWait(thread_id, snapshot))
     threadinfo = THREAD_TEMPLATE % data
     return threadinfo
 
 
+def getEventMonitor(event):
+    monitor = getattr(event, 'monitor', None)
+    return MONITOR if monitor is None else monitor
+
+
+def getWhere(monitor):
+    """Return ' in <monitor name>' for the reports, '' for the default one"""
+    return ' in %s' % monitor.name if monitor.name else ''
+
+
+def isThrottled(event):
+    """Whether the report of a long request event is over the rate limits
+    """
+    limits = THROTTLE
+    if limits is None:
+        return False
+    now = NOW() if event.snapshot is None else event.snapshot.now
+    return not limits.allow(getEventLevel(event), event.template or event.uri,
+                            now)
+
+
+def isVerbose(monitor, snapshot):
+    """Whether to report all other threads in full, not too many of them
+
+    Verbose reports summarize them otherwise.
+    """
+    if not monitor.config.verbose or CORUNNING_SUMMARY:
+        return False
+    return (VERBOSE_MAX_THREADS is None or snapshot is None
+            or len(snapshot) <= VERBOSE_MAX_THREADS)
+
+
 def addLogEntry(event, level):
+    if isThrottled(event):
+        return
     threadinfo = getFormattedThreadinfo(event)
-    if VERBOSE_LOG:
+    monitor = getEventMonitor(event)
+    if not monitor.config.verbose:
+        others = ''
+    elif isVerbose(monitor, event.snapshot):
         others = '\n--\n'.join(
             ['', 'Other threads:'] +  # spacing an header
-            getAllThreadInfo(omitThreads=(event.thread_id,)))
+            getAllThreadInfo(omitThreads=(event.thread_id,),
+                             snapshot=event.snapshot))
     else:
-        others = ''
-    LOG.log(level, LOG_TEMPLATE % dict(info=threadinfo, others=others))
+        others = formatCorunning(event.thread_id, event.snapshot)
+    LOG.log(level, LOG_TEMPLATE % dict(
+        where=getWhere(monitor), info=threadinfo, others=others))
 
 
 @adapter(interfaces.ILongRequestEvent)
@@ -386,13 +1211,329 @@ def addLogEntryError(event):
 
 @adapter(interfaces.ILongRequestFinishedEvent)
 def addLogEntryFinishedInfo(event):
-    LOG.log(FINISHED_LOG_LEVEL,
-            "Long running request finished thread_id:%s duration:%s sec\n%s",
-            event.thread_id, event.duration, event.uri)
+    monitor = getEventMonitor(event)
+    request_id = getattr(event, 'request_id', None)
+    LOG.log(monitor.config.finishedLogLevel,
+            "Long running request finished%s thread_id:%s%s duration:%s sec"
+            "\n%s", getWhere(monitor), event.thread_id,
+            '' if request_id is None else ' request_id:%s' % request_id,
+            event.duration, event.uri)
+
+
+@adapter(interfaces.IPoolStateChangedEvent)
+def addLogEntryPoolState(event):
+    if event.state == health.STALLED:
+        level = logging.ERROR
+    elif event.state == health.SATURATED:
+        level = logging.WARN
+    else:
+        level = logging.INFO
+    LOG.log(level, POOL_STATE_TEMPLATE % dict(
+        state=event.state,
+        old_state=event.old_state,
+        threadsused=getThreadsUsed(event.snapshot),
+        poolsize=health.getPoolSize(THREADPOOL),
+        queued=health.getQueueDepth(THREADPOOL),
+        diagnostics=getattr(event, 'diagnostics', '')))
+
+
+@adapter(interfaces.IReportsSuppressedEvent)
+def addLogEntrySuppressed(event):
+    LOG.warning("%s more requests over level %s suppressed",
+                event.count, event.level)
+
+
+def formatTemplates(incident):
+    return ''.join('\n  %s requests %s' % (count, RENDERER.truncate(template))
+                   for template, count in incident.getTemplates())
+
+
+@adapter(interfaces.IIncidentOpenedEvent)
+def addLogEntryIncidentOpened(event):
+    incident = event.incident
+    LOG.warning(INCIDENT_TEMPLATE % dict(
+        id=incident.id,
+        count=incident.count,
+        templates=formatTemplates(incident),
+        stack=incident.stack.format()))
+
+
+@adapter(interfaces.IIncidentUpdatedEvent)
+def addLogEntryIncidentUpdated(event):
+    incident = event.incident
+    LOG.info("Incident %s now has %s requests, %s running",
+             incident.id, incident.count, len(incident.active))
+
+
+@adapter(interfaces.IIncidentClosedEvent)
+def addLogEntryIncidentClosed(event):
+    incident = event.incident
+    LOG.info("Incident %s closed, %s requests in %.0f sec%s",
+             incident.id, incident.count, incident.end - incident.start,
+             formatTemplates(incident))
+
+
+@adapter(interfaces.IDeadlockEvent)
+def addLogEntryDeadlock(event):
+    threads = ['thread_id:%s\n%s' % (thread_id, getThreadTraceback(thread_id))
+               for thread_id, lock in event.cycle]
+    LOG.error(DEADLOCK_TEMPLATE % dict(
+        description=event.description, threads='\n--\n'.join(threads)))
+
+
+def getPoolDiagnostics(thread_pool, snapshot):
+    """Return the stacks of all threads and the lock owners, as text"""
+    owners = ['  %s held by thread %s, count %s' % owner
+              for owner in health.getLockOwners()]
+    owners.extend('  %s held by thread %s for %.1f sec' % (
+        lock.name, owner, held) for lock, owner, held in locks.TABLE.getHeld())
+    threads = getAllThreadInfo(snapshot=snapshot)
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for thread_id in sorted(sys._current_frames()):
+        if thread_id not in snapshot.workers:
+            threads.append('thread_id:%s %s\n%s' % (
+                thread_id, names.get(thread_id, ''),
+                getThreadTraceback(thread_id)))
+    return DIAGNOSTICS_TEMPLATE % dict(
+        locks='\n'.join(owners) or '  none found',
+        threads='\n--\n'.join(threads))
+
+
+def getEventLevel(event):
+    """Return the duration level of a long request event"""
+    if interfaces.ILongRequestEventOver3.providedBy(event):
+        return 3
+    elif interfaces.ILongRequestEventOver2.providedBy(event):
+        return 2
+    elif interfaces.ILongRequestEventOver1.providedBy(event):
+        return 1
+    return 0
+
+
+@adapter(interfaces.ILongRequestEvent)
+def captureRequest(event):
+    """Persist a request over CAPTURE_LEVEL for replaying it offline"""
+    directory = CAPTURE_DIR
+    level = getEventLevel(event)
+    if directory is None or level < CAPTURE_LEVEL:
+        return
+    body = None
+    key = (event.thread_id, getattr(event, 'request_id', None))
+    record = CAPTURES.get(key)
+    if record is not None:
+        if record.captured:
+            # once per request is enough
+            return
+        record.captured = True
+        body = record.body
+    try:
+        filename = capture.writeCapture(
+            directory, event, body, level, CAPTURE_REDACT)
+    except OSError:
+        LOG.exception("Capturing request of thread %s failed",
+                      event.thread_id)
+        return
+    LOG.info("Long running request captured to %s", filename)
+
+
+def getEventStart(event, now):
+    """Return when the request of a long request event started"""
+    try:
+        return event.snapshot.workers[event.thread_id][0]
+    except (AttributeError, KeyError):
+        return now - event.duration
+
+
+def makeSpan(event, start):
+    """Return a spans.Span for the request of a long request event"""
+    environ = event.worker_environ or {}
+    context = None
+    traceparent = environ.get(tracing.TRACEPARENT_HEADER)
+    if traceparent:
+        context = tracing.parseTraceparent(traceparent)
+    trace_id, parent_id = context if context is not None else (None, None)
+    return spans.Span(
+        event.template or event.uri, start, trace_id, parent_id, {
+            'http.route': event.template,
+            'http.request.method': environ.get('REQUEST_METHOD'),
+            'url.full': event.uri,
+            'client.address': event.client_ip,
+            'enduser.id': getPrincipal(event.zope_request, environ),
+            'thread.id': event.thread_id,
+            'cipher.longrequest.request_id': getattr(
+                event, 'request_id', None),
+        })
+
+
+@adapter(interfaces.ILongRequestBatchEvent)
+def exportSpans(event):
+    """Export the long requests finished in a tick as spans, in one batch
+
+    With an event per level crossed, with the stack at that time.
+    """
+    exporter = SPAN_EXPORTER
+    if exporter is None:
+        return
+    now = NOW() if event.snapshot is None else event.snapshot.now
+    running = RUNNING_SPANS
+    # finished first, the thread may be serving the next long request
+    finished = []
+    for done in event.finished:
+        span = running.pop(done.thread_id, None)
+        if span is not None:
+            span.attributes['cipher.longrequest.duration'] = done.duration
+            finished.append(span.encode(now))
+    for crossing in event.events:
+        start = getEventStart(crossing, now)
+        span = running.get(crossing.thread_id)
+        if span is None or span.start != start:
+            span = running[crossing.thread_id] = makeSpan(crossing, start)
+        span.addEvent('level %s crossed' % getEventLevel(crossing), now, {
+            'cipher.longrequest.duration': crossing.duration,
+            'code.stacktrace': RENDERER.truncate(
+                getThreadTraceback(crossing.thread_id)),
+        })
+    if finished:
+        # written by the thread of the exporter
+        exporter.export(finished)
+
+
+@adapter(interfaces.ILongRequestEventOver3)
+def dumpAllThreads(event):
+    """Dump the stacks of all threads to DUMP_FILE with faulthandler
+
+    faulthandler writes straight to the file descriptor, formatting
+    nothing in Python.  The stacks get dumped once per tick, the other
+    requests crossing the level in the same tick only get a line.
+    """
+    global DUMPED_GENERATION
+    dumpFile = DUMP_FILE
+    if dumpFile is None:
+        return
+    generation = getattr(event.snapshot, 'generation', None)
+    dump = generation is None or generation != DUMPED_GENERATION
+    try:
+        dumpFile.write(
+            '%s Long running request thread_id:%s duration:%s sec URL:%s%s\n'
+            % (time.strftime('%Y-%m-%d %H:%M:%S'), event.thread_id,
+               event.duration, event.uri,
+               '' if dump else ' (stacks dumped above)'))
+        dumpFile.flush()
+        if dump:
+            DUMPED_GENERATION = generation
+            faulthandler.dump_traceback(file=dumpFile, all_threads=True)
+    except (OSError, ValueError):
+        LOG.exception("Dumping the threads to %s failed",
+                      getattr(dumpFile, 'name', dumpFile))
+
+
+def armDumpTimer():
+    """(Re)start the faulthandler timer dumping the stacks of all threads
+
+    The timer runs in a C thread, needing no GIL.  It fires when the
+    checker thread does not come around to restart it in DUMP_TIMEOUT
+    seconds, e.g. because the whole process hangs.  There is one such
+    timer per process.
+    """
+    if DUMP_FILE is None or not DUMP_TIMEOUT:
+        return
+    faulthandler.dump_traceback_later(DUMP_TIMEOUT, file=DUMP_FILE)
+
+
+def checkDumpTimeout(tick):
+    """Raise ValueError if the dump timer would not outlast a tick
+
+    The checker thread pushes it back every tick, it would fire at every
+    tick otherwise.
+    """
+    if DUMP_TIMEOUT is not None and DUMP_TIMEOUT <= tick:
+        raise ValueError('dump-timeout %s is not longer than the tick %s'
+                         % (DUMP_TIMEOUT, tick))
+
+
+def disarmDumpTimer():
+    if DUMP_TIMEOUT:
+        faulthandler.cancel_dump_traceback_later()
+
+
+def registerDumpSignal(name):
+    """Dump the stacks of all threads to DUMP_FILE on signal `name`"""
+    signum = getattr(signal, 'SIG' + name.upper().replace('SIG', '', 1))
+    # no chaining, the default action of most signals is to terminate
+    faulthandler.register(signum, file=DUMP_FILE, all_threads=True)
+
+
+def setConfig(config, monitor=None):
+    """Replace the settings of `monitor`, the default one if None
+
+    The readers see either the old or the new ones.
+    """
+    if monitor is None:
+        monitor = MONITOR
+    monitor.config = config
+    LOG.info("Configuration%s changed:\n%s",
+             ' of %s' % monitor.name if monitor.name else '', config.format())
+
+
+def reloadConfig():
+    """Read the settings of all monitors from CONFIG_FILE again
+
+    Returns whether it worked, failing, the current settings stay.
+    """
+    with CONFIG_LOCK:
+        try:
+            parser = readFile(CONFIG_FILE)
+            configs = [(monitor, forSection(parser, monitor.section))
+                       for monitor in MONITORS]
+            for monitor, config in configs:
+                if monitor is MONITOR:
+                    checkDumpTimeout(config.tick)
+        except Exception:
+            LOG.exception("Reloading the configuration from %s failed",
+                          CONFIG_FILE)
+            return False
+        for monitor, config in configs:
+            setConfig(config, monitor)
+        return True
+
+
+def checkConfigFile():
+    """Reload CONFIG if asked to or if CONFIG_FILE changed since read"""
+    global CONFIG_MTIME, RELOAD_PENDING
+    reload = RELOAD_PENDING
+    RELOAD_PENDING = False
+    if CONFIG_MTIME is not None:
+        try:
+            mtime = os.stat(CONFIG_FILE).st_mtime
+        except OSError:
+            mtime = CONFIG_MTIME
+        if mtime != CONFIG_MTIME:
+            CONFIG_MTIME = mtime
+            reload = True
+    if reload:
+        reloadConfig()
+
+
+def requestReload(signum=None, frame=None):
+    """Have the checker thread reload CONFIG, a signal handler"""
+    global RELOAD_PENDING
+    RELOAD_PENDING = True
+
+
+def registerReloadSignal(name):
+    """Reload CONFIG on signal `name`, on the next tick"""
+    signum = getattr(signal, 'SIG' + name.upper().replace('SIG', '', 1))
+    signal.signal(signum, requestReload)
 
 
 def startThread(site_db, site_oid, siteName, user):
     global THREAD
+    if THREAD is not None and THREAD.is_alive():
+        # one checker thread serves all monitors
+        return
+    for monitor in MONITORS:
+        monitor.states.clear()
+    RUNNING_SPANS.clear()
     THREAD = RequestCheckerThread(site_db, site_oid, siteName, user)
     THREAD.start()
 
@@ -402,6 +1543,7 @@ def stopThread():
     THREAD.running = False
     THREAD.join()
     THREAD = None
+    disarmDumpTimer()
 
 
 def getMaxRequestTime(clear=False):
@@ -422,13 +1564,122 @@ def getMaxThreadsUsed(clear=False):
         return THREAD.getMaxThreadsUsed(clear)
 
 
-def getThreadsUsed():
-    """Return the current number of working threads"""
+def getPoolState():
+    """Return the health of the thread pool, healthy, saturated or stalled"""
+    global THREAD
+    if THREAD is None:
+        raise ValueError("No thread running")
+    else:
+        return THREAD.health.state
+
+
+def getThreadsUsed(snapshot=None):
+    """Return the current number of working threads
+
+    or the number of working threads in `snapshot`.
+    """
     global THREADPOOL
+    if snapshot is not None:
+        return len(snapshot)
     if THREADPOOL is None:
         raise ValueError("No threadpool yet!")
     else:
-        return len(THREADPOOL.worker_tracker.keys())
+        return len(THREADPOOL.worker_tracker)
+
+
+class Bulkhead:
+    """Limit the number of in-flight requests to URLs matching a pattern.
+
+    Keeps a single endpoint class from taking every worker thread.
+    """
+
+    def __init__(self, pattern, limit):
+        self.pattern = pattern
+        self.limit = limit
+        self.current = 0
+        self.peak = 0
+        self.rejected = 0
+        self.condition = threading.Condition()
+
+    def match(self, uri):
+        return self.pattern.match(uri) is not None
+
+    def _hasRoom(self):
+        return self.current < self.limit
+
+    def acquire(self, timeout=0):
+        """Take a slot, waiting at most `timeout` seconds for one
+
+        Returns False if no slot got free in time.
+        """
+        with self.condition:
+            if not self._hasRoom():
+                if (not timeout
+                        or not self.condition.wait_for(self._hasRoom,
+                                                       timeout)):
+                    self.rejected += 1
+                    return False
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+            return True
+
+    def release(self):
+        with self.condition:
+            self.current -= 1
+            self.condition.notify()
+
+    def getPeak(self, clear=False):
+        rv = self.peak
+        if clear:
+            self.peak = self.current
+        return rv
+
+    def __repr__(self):
+        return '<Bulkhead %s %s/%s>' % (
+            self.pattern.pattern, self.current, self.limit)
+
+
+def findBulkhead(uri):
+    """Return the first bulkhead matching the request URL, or None
+
+    `uri` is the URL as the server got it, see `getServerURL`.
+    """
+    for bulkhead in BULKHEADS:
+        if bulkhead.match(uri):
+            return bulkhead
+    return None
+
+
+def recordQueueDelay(environ):
+    """Record how long a request waited for a thread, if known"""
+    delay = queuetime.getQueueDelay(environ, NOW(), QUEUE_HEADERS)
+    if delay is not None:
+        environ[QUEUE_DELAY_KEY] = delay
+        QUEUE_TIMES.add(delay)
+
+
+def getQueueStats():
+    """Return the count, mean, median, 99th percentile and max queue wait
+
+    And the histogram, as [(bucket bound, count), ...].
+    """
+    histogram = QUEUE_TIMES
+    if histogram is None:
+        raise ValueError("Not measuring queue wait")
+    count = histogram.count
+    return dict(count=count,
+                mean=histogram.total / count if count else None,
+                median=histogram.quantile(0.5),
+                p99=histogram.quantile(0.99),
+                max=histogram.max if count else None,
+                buckets=histogram.getBuckets())
+
+
+def getBulkheadStats():
+    """Return the current and peak concurrency of all bulkheads"""
+    return [dict(pattern=b.pattern.pattern, limit=b.limit,
+                 current=b.current, peak=b.peak, rejected=b.rejected)
+            for b in BULKHEADS]
 
 
 # we need to grab the request --> threadpool from somewhere
@@ -438,10 +1689,13 @@ def getThreadsUsed():
 class ThreadpoolCatcher:
     """
     This middleware will catch the paster threadpool from the first request.
+
+    Its requests get watched by `monitor`, the default monitor if None.
     """
 
-    def __init__(self, application):
+    def __init__(self, application, monitor=None):
         self.application = application
+        self.monitor = MONITOR if monitor is None else monitor
 
     def __call__(self, environ, start_response):
         global THREADPOOL
@@ -450,61 +1704,441 @@ class ThreadpoolCatcher:
             if THREADPOOL is not None:
                 LOG.info("got thread_pool from a request")
 
-        return self.application(environ, start_response)
+        # the innermost filter of a pipeline wins
+        if self.monitor is not MONITOR:
+            environ[MONITOR_KEY] = self.monitor
+        else:
+            environ.pop(MONITOR_KEY, None)
+
+        # the outermost filter of a pipeline does the per request work
+        outermost = CAUGHT_KEY not in environ
+        environ[CAUGHT_KEY] = True
+
+        if outermost and QUEUE_TIMES is not None:
+            recordQueueDelay(environ)
+
+        if REQUEST_IDS and REQUEST_ID_KEY not in environ:
+            # the outermost filter of a pipeline does it
+            request_id = environ[REQUEST_ID_KEY] = tracing.getRequestId(
+                environ)
+            if REQUEST_ID_RESPONSE_HEADER is not None:
+                start_response = addResponseHeader(
+                    start_response, REQUEST_ID_RESPONSE_HEADER, request_id)
+
+        if ADMIN_URL is not None and environ.get('PATH_INFO') == ADMIN_URL:
+            return self.admin(environ, start_response)
+
+        if not outermost or (not BULKHEADS and THRESHOLDS is None
+                             and CAPTURE_DIR is None):
+            # nothing (more) to do per request
+            return self.application(environ, start_response)
+
+        uri = getURI(environ)
+        server_url = getServerURL(environ)
+        bulkhead = findBulkhead(server_url)
+        if bulkhead is not None and not bulkhead.acquire(BULKHEAD_WAIT):
+            LOG.info("Request rejected, bulkhead %s is full:\n%s",
+                     bulkhead.pattern.pattern, server_url)
+            start_response(BULKHEAD_REJECT_STATUS,
+                           [('Content-Type', 'text/plain'),
+                            ('Retry-After', '1')])
+            return [BULKHEAD_REJECT_BODY]
+
+        record = None
+        if CAPTURE_DIR is not None:
+            if REQUEST_ID_KEY not in environ:
+                # the events tell which request to capture by its id
+                environ[REQUEST_ID_KEY] = tracing.getRequestId(environ)
+            try:
+                record = capture.Capture(capture.spoolBody(
+                    environ, CAPTURE_MEMORY, CAPTURE_MAX_BODY))
+            except:  # noqa: E722 do not use bare 'except'
+                if bulkhead is not None:
+                    bulkhead.release()
+                raise
+
+        finish = self.getFinisher(uri, bulkhead, record,
+                                  environ.get(REQUEST_ID_KEY))
+        if finish is None:
+            return self.application(environ, start_response)
+
+        try:
+            return add_close(self.application(environ, start_response),
+                             finish)
+        except:  # noqa: E722 do not use bare 'except'
+            finish()
+            raise
+
+    def admin(self, environ, start_response):
+        """Show the settings of the monitor, POST options to change them
+
+        POSTing no options reloads the settings of all monitors from the
+        ini file.
+        """
+        monitor = self.monitor
+        token = environ.get('HTTP_X_LONGREQUEST_TOKEN', '')
+        if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return respond(start_response, '403 Forbidden', 'Forbidden\n')
+        if environ.get('REQUEST_METHOD') == 'POST':
+            try:
+                length = min(int(environ.get('CONTENT_LENGTH') or 0),
+                             ADMIN_MAX_BODY)
+            except ValueError:
+                length = 0
+            body = environ['wsgi.input'].read(length).decode('utf-8')
+            # empty values unset levels and clear patterns
+            options = dict(parse_qsl(body, keep_blank_values=True))
+            if not options:
+                if not reloadConfig():
+                    return respond(start_response,
+                                   '500 Internal Server Error',
+                                   'Reloading %s failed\n' % CONFIG_FILE)
+            else:
+                with CONFIG_LOCK:
+                    try:
+                        config = fromOptions(options, monitor.config,
+                                             monitor.section)
+                        if monitor is MONITOR:
+                            checkDumpTimeout(config.tick)
+                    except Exception as e:
+                        return respond(start_response, '400 Bad Request',
+                                       '%s: %s\n' % (type(e).__name__, e))
+                    setConfig(config, monitor)
+        return respond(start_response, '200 OK', monitor.config.format())
+
+    def getFinisher(self, uri, bulkhead, record, request_id=None):
+        """Return a callable to run when the request is done, or None"""
+        learn = THRESHOLDS is not None
+        if bulkhead is None and not learn and record is None:
+            return None
+        time_started = NOW()
+        key = (threading.get_ident(), request_id)
+        if record is not None:
+            CAPTURES[key] = record
+
+        def finish():
+            if bulkhead is not None:
+                bulkhead.release()
+            if learn:
+                recordDuration(uri, time_started)
+            if record is not None:
+                if CAPTURES.get(key) is record:
+                    del CAPTURES[key]
+                record.close()
+        return finish
 
     def __repr__(self):
         return '<ThreadpoolCatcher>'
 
 
-def make_filter(app, global_conf, forceStart=False):
+def addResponseHeader(start_response, name, value):
+    """Return a start_response adding a header, unless the app sets it"""
+    lowered = name.lower()
+
+    def start_response_with_header(status, headers, exc_info=None):
+        if not any(header.lower() == lowered for header, v in headers):
+            headers = list(headers) + [(name, value)]
+        return start_response(status, headers, exc_info)
+    return start_response_with_header
+
+
+def respond(start_response, status, text):
+    body = text.encode('utf-8')
+    start_response(status, [('Content-Type', 'text/plain; charset=utf-8'),
+                            ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def makeThresholdLearner(config):
+    kw = {}
+    if config.has_option('cipher.longrequest', 'adaptive-quantile'):
+        kw['quantile'] = config.getfloat(
+            'cipher.longrequest', 'adaptive-quantile')
+    if config.has_option('cipher.longrequest', 'adaptive-factors'):
+        factors = config.get('cipher.longrequest', 'adaptive-factors')
+        kw['factors'] = tuple(float(factor) for factor in factors.split())
+    if config.has_option('cipher.longrequest', 'adaptive-min-samples'):
+        kw['minSamples'] = config.getint(
+            'cipher.longrequest', 'adaptive-min-samples')
+    if config.has_option('cipher.longrequest', 'adaptive-max-urls'):
+        kw['maxKeys'] = config.getint(
+            'cipher.longrequest', 'adaptive-max-urls')
+    return ThresholdLearner(**kw)
+
+
+def makeCounter(counter, capacity):
+    """Return a SpaceSaving of `capacity`, `counter` if it is one"""
+    if not capacity:
+        return None
+    if counter is not None and counter.capacity == capacity:
+        return counter
+    return hitters.SpaceSaving(capacity)
+
+
+def make_filter(app, global_conf, forceStart=False, section=SECTION):
+    """Watch the requests of `app`
+
+    With a `section` of its own, the duration levels, verbose mode,
+    finished log level, excluded URLs and per-URL levels of the requests
+    of `app` are those of this section of the ini file, with defaults
+    from the main one, watched by a monitor of its own.  The settings
+    of the whole process come from the main section.
+    """
     config = RawConfigParser()
     config.optionxform = str
     config.read(global_conf['__file__'])
 
-    if config.has_option('cipher.longrequest', 'duration-level-1'):
-        global DURATION_LEVEL_1
-        DURATION_LEVEL_1 = config.getint(
-            'cipher.longrequest', 'duration-level-1')
-
-    if config.has_option('cipher.longrequest', 'duration-level-2'):
-        global DURATION_LEVEL_2
-        DURATION_LEVEL_2 = config.getint(
-            'cipher.longrequest', 'duration-level-2')
-
-    if config.has_option('cipher.longrequest', 'duration-level-3'):
-        global DURATION_LEVEL_3
-        DURATION_LEVEL_3 = config.getint(
-            'cipher.longrequest', 'duration-level-3')
-
-    if config.has_option('cipher.longrequest', 'tick'):
-        global TICK
-        TICK = config.getint('cipher.longrequest', 'tick')
+    # duration levels, tick, verbose, finished log level, excluded URLs
+    # and per-URL levels, these can be reloaded
+    global CONFIG, CONFIG_FILE, CONFIG_MTIME
+    CONFIG = forSection(config)
+    monitor = MONITOR
+    if section != SECTION:
+        monitor = findMonitor(section)
+        if monitor is None:
+            monitor = Monitor(section, section=section)
+            registerMonitor(monitor)
+        monitor.config = forSection(config, section)
+    CONFIG_FILE = global_conf['__file__']
+    CONFIG_MTIME = None
+    if config.has_option('cipher.longrequest', 'reload-on-change'):
+        if config.getboolean('cipher.longrequest', 'reload-on-change'):
+            CONFIG_MTIME = os.stat(CONFIG_FILE).st_mtime
+
+    if config.has_option('cipher.longrequest', 'reload-signal'):
+        registerReloadSignal(
+            config.get('cipher.longrequest', 'reload-signal'))
+
+    global ADMIN_URL, ADMIN_TOKEN
+    ADMIN_URL = ADMIN_TOKEN = None
+    if config.has_option('cipher.longrequest', 'admin-url'):
+        if not config.get('cipher.longrequest', 'admin-token', fallback=''):
+            raise ValueError('admin-url needs an admin-token')
+        ADMIN_URL = config.get('cipher.longrequest', 'admin-url') or None
+        ADMIN_TOKEN = config.get('cipher.longrequest', 'admin-token')
 
     if config.has_option('cipher.longrequest', 'initial-delay'):
         global INITIAL_DELAY
         INITIAL_DELAY = config.getint('cipher.longrequest', 'initial-delay')
 
-    if config.has_option('cipher.longrequest', 'finished-log-level'):
-        global FINISHED_LOG_LEVEL
-        value = config.get('cipher.longrequest', 'finished-log-level').lower()
-        if value == 'info':
-            FINISHED_LOG_LEVEL = logging.INFO
-        elif value == 'warn':
-            FINISHED_LOG_LEVEL = logging.WARN
-        if value == 'error':
-            FINISHED_LOG_LEVEL = logging.ERROR
-
-    if config.has_option('cipher.longrequest', 'verbose'):
-        global VERBOSE_LOG
-        VERBOSE_LOG = asbool(config.get('cipher.longrequest', 'verbose'))
-
-    global IGNORE_URLS
+    global BULKHEADS
+    bulkheads = []
     i = 1
-    while config.has_option('cipher.longrequest', 'exclude-url-%i' % i):
-        url = config.get('cipher.longrequest', 'exclude-url-%i' % i)
-        patt = re.compile(url)  # no flags, use `(?iLmsux)`
-        IGNORE_URLS.append(patt)
+    while config.has_option('cipher.longrequest', 'bulkhead-url-%i' % i):
+        url = config.get('cipher.longrequest', 'bulkhead-url-%i' % i)
+        limit = config.getint('cipher.longrequest', 'bulkhead-limit-%i' % i)
+        bulkheads.append(Bulkhead(re.compile(url), limit))
         i += 1
+    BULKHEADS = bulkheads
+
+    if config.has_option('cipher.longrequest', 'adaptive-thresholds'):
+        global THRESHOLDS
+        THRESHOLDS = None
+        if config.getboolean('cipher.longrequest', 'adaptive-thresholds'):
+            THRESHOLDS = makeThresholdLearner(config)
+
+    global NORMALIZER
+    templates = []
+    i = 1
+    while config.has_option('cipher.longrequest', 'template-url-%i' % i):
+        url = config.get('cipher.longrequest', 'template-url-%i' % i)
+        template = config.get('cipher.longrequest', 'template-%i' % i)
+        templates.append((url, template))
+        i += 1
+    kw = {}
+    if config.has_option('cipher.longrequest', 'template-cache-size'):
+        kw['maxSize'] = config.getint(
+            'cipher.longrequest', 'template-cache-size')
+    NORMALIZER = URLNormalizer(templates, **kw)
+
+    # every filter of a pipeline reads these, keep what got counted
+    global PRINCIPALS, TENANTS, TENANT_KEY
+    if config.has_option('cipher.longrequest', 'top-principals'):
+        capacity = config.getint('cipher.longrequest', 'top-principals')
+        PRINCIPALS = makeCounter(PRINCIPALS, capacity)
+    if config.has_option('cipher.longrequest', 'tenant-key'):
+        TENANT_KEY = config.get('cipher.longrequest', 'tenant-key') or None
+    if config.has_option('cipher.longrequest', 'top-tenants'):
+        capacity = config.getint('cipher.longrequest', 'top-tenants')
+        TENANTS = makeCounter(TENANTS, capacity)
+    if TENANTS is not None and TENANT_KEY is None:
+        raise ValueError('top-tenants needs a tenant-key')
+
+    if config.has_option('cipher.longrequest', 'corunning-summary'):
+        global CORUNNING_SUMMARY
+        CORUNNING_SUMMARY = config.getboolean(
+            'cipher.longrequest', 'corunning-summary')
+
+    if config.has_option('cipher.longrequest', 'corunning-pairs'):
+        global CORUNNING
+        maxPairs = config.getint('cipher.longrequest', 'corunning-pairs')
+        if not maxPairs:
+            CORUNNING = None
+        elif CORUNNING is None or CORUNNING.maxPairs != maxPairs:
+            CORUNNING = corunning.CoRunning(maxPairs)
+
+    global QUEUE_TIMES, QUEUE_HEADERS
+    if config.has_option('cipher.longrequest', 'queue-headers'):
+        headers = config.get('cipher.longrequest', 'queue-headers').split()
+        QUEUE_HEADERS = tuple('HTTP_' + header.upper().replace('-', '_')
+                              for header in headers)
+        if not QUEUE_HEADERS:
+            QUEUE_TIMES = None
+        elif QUEUE_TIMES is None:
+            QUEUE_TIMES = queuetime.Histogram()
+
+    if config.has_option('cipher.longrequest', 'queue-saturation'):
+        global QUEUE_SATURATION
+        QUEUE_SATURATION = config.getfloat(
+            'cipher.longrequest', 'queue-saturation') or None
+
+    if config.has_option('cipher.longrequest', 'request-ids'):
+        global REQUEST_IDS
+        REQUEST_IDS = config.getboolean('cipher.longrequest', 'request-ids')
+
+    if config.has_option('cipher.longrequest', 'request-id-header'):
+        global REQUEST_ID_RESPONSE_HEADER
+        REQUEST_ID_RESPONSE_HEADER = config.get(
+            'cipher.longrequest', 'request-id-header') or None
+
+    if config.has_option('cipher.longrequest', 'span-target'):
+        global SPAN_EXPORTER
+        target = config.get('cipher.longrequest', 'span-target') or None
+        if SPAN_EXPORTER is not None and SPAN_EXPORTER.target != target:
+            SPAN_EXPORTER.close()
+            SPAN_EXPORTER = None
+            RUNNING_SPANS.clear()
+        if target is not None and SPAN_EXPORTER is None:
+            resource = {'service.name': config.get(
+                'cipher.longrequest', 'span-service-name',
+                fallback=spans.SERVICE_NAME)}
+            SPAN_EXPORTER = spans.SpanExporter(target, resource)
+
+    global THROTTLE
+    rates = {}
+    for option, name in (('report-rate', 'levelRate'),
+                         ('report-rate-per-url', 'urlRate')):
+        if config.has_option('cipher.longrequest', option):
+            rates[name] = config.getfloat('cipher.longrequest', option)
+    for option, name in (('report-burst', 'levelBurst'),
+                         ('report-burst-per-url', 'urlBurst')):
+        if config.has_option('cipher.longrequest', option):
+            rates[name] = config.getint('cipher.longrequest', option)
+    if rates:
+        THROTTLE = throttle.ReportThrottle(**rates)
+
+    if config.has_option('cipher.longrequest', 'verbose-max-threads'):
+        global VERBOSE_MAX_THREADS
+        VERBOSE_MAX_THREADS = config.getint(
+            'cipher.longrequest', 'verbose-max-threads') or None
+
+    if config.has_option('cipher.longrequest', 'incidents'):
+        global INCIDENTS
+        INCIDENTS = None
+        if config.getboolean('cipher.longrequest', 'incidents'):
+            kw = {}
+            if config.has_option('cipher.longrequest', 'incident-similarity'):
+                kw['threshold'] = config.getfloat(
+                    'cipher.longrequest', 'incident-similarity')
+            if config.has_option('cipher.longrequest',
+                                 'incident-close-after'):
+                kw['closeAfter'] = config.getfloat(
+                    'cipher.longrequest', 'incident-close-after')
+            if config.has_option('cipher.longrequest', 'incident-max-open'):
+                kw['maxOpen'] = config.getint(
+                    'cipher.longrequest', 'incident-max-open')
+            INCIDENTS = incidents.IncidentTracker(**kw)
+
+    if config.has_option('cipher.longrequest', 'capture-dir'):
+        global CAPTURE_DIR
+        CAPTURE_DIR = config.get('cipher.longrequest', 'capture-dir') or None
+
+    if config.has_option('cipher.longrequest', 'capture-level'):
+        global CAPTURE_LEVEL
+        CAPTURE_LEVEL = config.getint('cipher.longrequest', 'capture-level')
+
+    if config.has_option('cipher.longrequest', 'capture-memory'):
+        global CAPTURE_MEMORY
+        CAPTURE_MEMORY = config.getint('cipher.longrequest', 'capture-memory')
+
+    if config.has_option('cipher.longrequest', 'capture-max-body'):
+        global CAPTURE_MAX_BODY
+        CAPTURE_MAX_BODY = config.getint(
+            'cipher.longrequest', 'capture-max-body')
+
+    if config.has_option('cipher.longrequest', 'capture-redact-headers'):
+        global CAPTURE_REDACT
+        headers = config.get('cipher.longrequest', 'capture-redact-headers')
+        CAPTURE_REDACT = tuple(
+            'HTTP_' + header.upper().replace('-', '_')
+            for header in headers.split())
+
+    global RENDERER
+    kw = {}
+    for option, name in (('report-max-size', 'maxSize'),
+                         ('report-max-depth', 'maxDepth'),
+                         ('report-max-items', 'maxItems')):
+        if config.has_option('cipher.longrequest', option):
+            kw[name] = config.getint('cipher.longrequest', option)
+    if config.has_option('cipher.longrequest', 'report-redact'):
+        kw['redact'] = config.get(
+            'cipher.longrequest', 'report-redact').split()
+    RENDERER = render.Renderer(**kw)
+
+    if config.has_option('cipher.longrequest', 'stack-capture'):
+        global STACK_CAPTURE
+        value = config.get('cipher.longrequest', 'stack-capture').lower()
+        if value not in ('traceback', 'fast'):
+            raise ValueError('stack-capture must be traceback or fast')
+        STACK_CAPTURE = value
+
+    if config.has_option('cipher.longrequest', 'stack-depth'):
+        global STACK_DEPTH
+        STACK_DEPTH = config.getint(
+            'cipher.longrequest', 'stack-depth') or None
+
+    if config.has_option('cipher.longrequest', 'stall-ticks'):
+        global STALL_TICKS
+        STALL_TICKS = config.getint('cipher.longrequest', 'stall-ticks')
+
+    if config.has_option('cipher.longrequest', 'recover-ticks'):
+        global RECOVER_TICKS
+        RECOVER_TICKS = config.getint('cipher.longrequest', 'recover-ticks')
+
+    if config.has_option('cipher.longrequest', 'dump-file'):
+        global DUMP_FILE
+        filename = config.get('cipher.longrequest', 'dump-file')
+        # stays open, faulthandler writes to its file descriptor, every
+        # filter of a pipeline reads this
+        if not filename:
+            DUMP_FILE = None
+        elif DUMP_FILE is None or DUMP_FILE.name != filename:
+            DUMP_FILE = open(filename, 'a')
+
+    if config.has_option('cipher.longrequest', 'dump-timeout'):
+        global DUMP_TIMEOUT
+        DUMP_TIMEOUT = config.getfloat(
+            'cipher.longrequest', 'dump-timeout') or None
+    checkDumpTimeout(CONFIG.tick)
+
+    if config.has_option('cipher.longrequest', 'dump-signal'):
+        if DUMP_FILE is None:
+            raise ValueError('dump-signal needs a dump-file')
+        registerDumpSignal(config.get('cipher.longrequest', 'dump-signal'))
+
+    if config.has_option('cipher.longrequest', 'lock-table-size'):
+        locks.TABLE.maxSize = config.getint(
+            'cipher.longrequest', 'lock-table-size')
+
+    if config.has_option('cipher.longrequest', 'lock-tracking'):
+        if config.getboolean('cipher.longrequest', 'lock-tracking'):
+            locks.patch()
+        else:
+            locks.unpatch()
+
+    if config.has_option('cipher.longrequest', 'bulkhead-wait'):
+        global BULKHEAD_WAIT
+        BULKHEAD_WAIT = config.getfloat('cipher.longrequest', 'bulkhead-wait')
 
     start = forceStart
     if not forceStart:
@@ -512,4 +2146,4 @@ def make_filter(app, global_conf, forceStart=False):
             start = config.getboolean('cipher.longrequest', 'start-thread')
     if start:
         startThread(None, None, None, None)
-    return ThreadpoolCatcher(app)
+    return ThreadpoolCatcher(app, monitor)
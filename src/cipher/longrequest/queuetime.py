@@ -0,0 +1,125 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""How long requests waited before a thread picked them up
+
+Proxies tell when they got a request in an `X-Request-Start` or
+`X-Queue-Start` header, as `t=<time>` in seconds, milliseconds or
+microseconds since the epoch.
+"""
+import bisect
+import threading
+
+
+# WSGI environ keys of the headers telling when a request arrived
+HEADERS = ('HTTP_X_REQUEST_START', 'HTTP_X_QUEUE_START')
+
+# upper bounds of the histogram buckets, in seconds
+BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def parseRequestStart(value):
+    """Return the time in an X-Request-Start header, None if there is none
+
+    In seconds since the epoch, whatever unit the header uses.
+    """
+    value = value.strip()
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        start = float(value)
+    except ValueError:
+        return None
+    if start > 1e14:
+        return start / 1e6  # microseconds
+    if start > 1e11:
+        return start / 1e3  # milliseconds
+    return start
+
+
+def getQueueDelay(environ, now, headers=HEADERS):
+    """Return the seconds a request waited before `now`, None if not known
+
+    Taken from the first of `headers` present.  Clocks of proxies and
+    servers differ a little, negative delays count as 0.
+    """
+    for header in headers:
+        value = environ.get(header)
+        if value:
+            start = parseRequestStart(value)
+            if start is not None:
+                return max(now - start, 0.0)
+    return None
+
+
+class Histogram:
+    """Counts of values in buckets with fixed `bounds`
+
+    The bucket of a value is the first with a bound not below it, the
+    values over the last bound get a bucket of their own.
+    """
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = tuple(bounds)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def add(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+            if self.peak is None or value > self.peak:
+                self.peak = value
+
+    def getPeak(self, clear=False):
+        """Return the highest value since the last clear, None if none"""
+        with self.lock:
+            rv = self.peak
+            if clear:
+                self.peak = None
+        return rv
+
+    def quantile(self, p):
+        """Return the bound of the bucket holding the `p` quantile
+
+        The highest value for the open ended bucket, None without values.
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            rank = p * self.count
+            seen = 0
+            for bound, count in zip(self.bounds, self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(bound, self.max)
+            return self.max
+
+    def getBuckets(self):
+        """Return [(bound, count), ...], None is the bound of the last"""
+        with self.lock:
+            return list(zip(self.bounds + (None,), self.counts))
+
+    def clear(self):
+        with self.lock:
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+            self.peak = None
+
+    def __repr__(self):
+        return '<Histogram %s values>' % self.count
@@ -0,0 +1,189 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Rendering of request data for reports, with bounded size and cost
+"""
+import itertools
+import pprint
+import re
+import reprlib
+
+
+MAX_SIZE = 10000  # characters per rendered field
+MAX_DEPTH = 4
+MAX_ITEMS = 100
+
+# keys whose values never get rendered, case insensitive regexes
+REDACTED_KEYS = ('passw', 'secret', 'token', 'authorization', 'cookie',
+                 'api_?key')
+
+
+class Marker:
+    """Stands in for data left out, its repr is its text"""
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+    # sorts after anything else, so that pprint puts it last
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+REDACTED = Marker('<redacted>')
+MORE = Marker('...')
+
+
+class Renderer:
+    """Render data for reports, with about `maxSize` characters of data
+
+    Containers get cut after `maxItems` items and `maxDepth` levels,
+    strings and reprs at the remaining size.  The data gets walked once
+    into a bounded copy, stopping as soon as the size is used up, only
+    that copy gets pretty printed.  Other objects get rendered by a
+    BoundedRepr.  The formatting adds quotes,
+    separators and indentation, the result gets cut hard at twice
+    `maxSize`.  Values of keys matching one of the `redact` regexes are
+    left out.
+    """
+
+    def __init__(self, maxSize=MAX_SIZE, maxDepth=MAX_DEPTH,
+                 maxItems=MAX_ITEMS, redact=REDACTED_KEYS):
+        self.maxSize = maxSize
+        self.maxDepth = maxDepth
+        self.maxItems = maxItems
+        if redact:
+            self.redact = re.compile('|'.join(redact), re.IGNORECASE).search
+        else:
+            self.redact = None
+
+    def render(self, value):
+        budget = Budget(self.maxSize)
+        text = pprint.pformat(self.limit(value, 0, budget))
+        # in case the formatting added too much
+        return self.truncate(text, 2 * self.maxSize)
+
+    def truncate(self, text, size=None):
+        """Return `text` cut at `size` characters, `maxSize` by default"""
+        if size is None:
+            size = self.maxSize
+        if len(text) <= size:
+            return text
+        return text[:size] + '...'
+
+    def limit(self, value, depth, budget):
+        """Return a copy of `value` small enough to render"""
+        if isinstance(value, (str, bytes)):
+            return self.limitText(value, budget)
+        if isinstance(value, (int, float, type(None))):
+            budget.remaining -= 8
+            return value
+        if isinstance(value, dict):
+            if depth >= self.maxDepth:
+                return self.summarize(value, budget)
+            return self.limitDict(value, depth + 1, budget)
+        if isinstance(value, (list, tuple, set, frozenset)):
+            if depth >= self.maxDepth:
+                return self.summarize(value, budget)
+            return self.limitSequence(value, depth + 1, budget)
+        size = max(budget.remaining, 0)
+        try:
+            text = BoundedRepr(size, self.maxItems,
+                               self.maxDepth - depth).repr(value)
+        except Exception as e:
+            text = '<unrepresentable %s: %s>' % (type(value).__name__, e)
+        return Marker(self.limitText(text, budget))
+
+    def limitText(self, text, budget):
+        size = max(budget.remaining, 0)
+        budget.remaining -= len(text) + 4
+        if len(text) <= size:
+            return text
+        return text[:size] + (b'...' if isinstance(text, bytes) else '...')
+
+    def limitDict(self, value, depth, budget):
+        rv = {}
+        for key, item in itertools.islice(value.items(), self.maxItems):
+            if budget.remaining <= 0:
+                break
+            redacted = (self.redact is not None and isinstance(key, str)
+                        and self.redact(key))
+            if not isinstance(key, int):
+                key = self.limit(key, depth, budget)
+            if redacted:
+                rv[key] = REDACTED
+            else:
+                rv[key] = self.limit(item, depth, budget)
+        if len(rv) < len(value):
+            rv[MORE] = Marker('<%s more>' % (len(value) - len(rv)))
+        return rv
+
+    def limitSequence(self, value, depth, budget):
+        rv = []
+        for item in itertools.islice(value, self.maxItems):
+            if budget.remaining <= 0:
+                break
+            rv.append(self.limit(item, depth, budget))
+        if len(rv) < len(value):
+            rv.append(Marker('<%s more>' % (len(value) - len(rv))))
+        if type(value) in (tuple, set, frozenset):
+            return type(value)(rv)
+        return rv
+
+    def summarize(self, value, budget):
+        budget.remaining -= 20
+        return Marker('<%s of %s items>' % (type(value).__name__, len(value)))
+
+
+class BoundedRepr(reprlib.Repr):
+    """A reprlib.Repr of at most about `size` characters
+
+    The containers reprlib knows, as deques and arrays, and byte arrays
+    get cut before they are formatted, after `items` items and `levels`
+    levels.  Objects with a repr of their own still make it, it gets cut
+    afterwards.
+    """
+
+    def __init__(self, size, items, levels):
+        super().__init__()
+        self.maxlevel = max(levels, 1)
+        self.maxtuple = self.maxlist = self.maxarray = items
+        self.maxdict = self.maxset = self.maxfrozenset = items
+        self.maxdeque = items
+        self.maxstring = self.maxlong = self.maxother = size
+
+    def repr_instance(self, x, level):
+        # its own repr, it can only get cut afterwards
+        return repr(x)
+
+    def repr_bytearray(self, x, level):
+        # slicing copies only what gets shown
+        rv = 'bytearray(%r)' % bytes(x[:self.maxstring])
+        if len(x) > self.maxstring:
+            rv = rv[:-1] + '...)'
+        return rv
+
+
+class Budget:
+    """The characters left while limiting one value"""
+
+    __slots__ = ('remaining',)
+
+    def __init__(self, remaining):
+        self.remaining = remaining
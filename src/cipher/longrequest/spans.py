@@ -0,0 +1,228 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Long requests as OpenTelemetry spans, exported as OTLP/JSON
+
+Written as a line of JSON per batch, the format of the OpenTelemetry
+collector's file exporter and receiver, to a file or a Unix socket.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+
+
+SCOPE = 'cipher.longrequest'
+SERVICE_NAME = 'cipher.longrequest'
+
+SPAN_KIND_SERVER = 2
+
+MAX_BATCH = 512  # spans per line
+MAX_QUEUE = 64  # batches waiting to be written
+TIMEOUT = 5  # sec, for connecting and sending to a socket
+
+LOG = logging.getLogger('cipher.longrequest')
+
+
+def newTraceId():
+    return os.urandom(16).hex()
+
+
+def newSpanId():
+    return os.urandom(8).hex()
+
+
+def toNano(seconds):
+    """Return a time in seconds as the nanoseconds string of OTLP/JSON"""
+    return str(int(seconds * 1e9))
+
+
+def attribute(key, value):
+    """Return an OTLP/JSON KeyValue"""
+    if isinstance(value, bool):
+        value = {'boolValue': value}
+    elif isinstance(value, int):
+        value = {'intValue': str(value)}
+    elif isinstance(value, float):
+        value = {'doubleValue': value}
+    else:
+        value = {'stringValue': str(value)}
+    return {'key': key, 'value': value}
+
+
+def attributes(values):
+    return [attribute(key, value) for key, value in values.items()
+            if value is not None]
+
+
+class Span:
+    """A long request, a span once it finished
+
+    Part of the trace of `trace_id`, a child of the span `parent_id` if
+    the request came with a trace context, a new trace otherwise.
+    """
+
+    __slots__ = ('name', 'start', 'trace_id', 'span_id', 'parent_id',
+                 'attributes', 'events')
+
+    def __init__(self, name, start, trace_id=None, parent_id=None,
+                 attributes=None):
+        self.name = name
+        self.start = start
+        self.trace_id = newTraceId() if trace_id is None else trace_id
+        self.span_id = newSpanId()
+        self.parent_id = parent_id
+        self.attributes = {} if attributes is None else attributes
+        self.events = []
+
+    def addEvent(self, name, time, attributes=None):
+        self.events.append((name, time, attributes or {}))
+
+    def encode(self, end):
+        """Return the span as OTLP/JSON, ending at `end`"""
+        rv = {'traceId': self.trace_id,
+              'spanId': self.span_id,
+              'name': self.name,
+              'kind': SPAN_KIND_SERVER,
+              'startTimeUnixNano': toNano(self.start),
+              'endTimeUnixNano': toNano(end),
+              'attributes': attributes(self.attributes),
+              'events': [{'timeUnixNano': toNano(time),
+                          'name': name,
+                          'attributes': attributes(values)}
+                         for name, time, values in self.events]}
+        if self.parent_id is not None:
+            rv['parentSpanId'] = self.parent_id
+        return rv
+
+    def __repr__(self):
+        return '<Span %s %s>' % (self.name, self.span_id)
+
+
+def encodeRequest(spans, resource):
+    """Return an OTLP/JSON ExportTraceServiceRequest of encoded spans"""
+    return {'resourceSpans': [{
+        'resource': {'attributes': attributes(resource)},
+        'scopeSpans': [{'scope': {'name': SCOPE}, 'spans': spans}]}]}
+
+
+class SpanExporter:
+    """Write encoded spans to `target` in batches, from a thread of its own
+
+    A file name, or unix:<path> for a Unix socket taking newline
+    delimited JSON.  Each batch is a line, of at most `maxBatch` spans.
+
+    `export` only queues the spans, so that a slow target does not hold up
+    the checker thread.  Batches not fitting in the queue, at most
+    `maxQueue` of them, are dropped.  Failing writes are logged, the next
+    batch opens `target` anew.
+    """
+
+    def __init__(self, target, resource=None, maxBatch=MAX_BATCH,
+                 maxQueue=MAX_QUEUE):
+        self.target = target
+        if resource is None:
+            resource = {'service.name': SERVICE_NAME}
+        self.resource = resource
+        self.maxBatch = maxBatch
+        self.file = None
+        self.sock = None
+        self.exported = 0
+        self.failed = 0
+        self.dropped = 0
+        self.queue = queue.Queue(maxQueue)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        """Queue encoded spans for writing, drop them if the queue is full"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, daemon=True,
+                    name='cipher.longrequest span exporter')
+                self.thread.start()
+        for i in range(0, len(spans), self.maxBatch):
+            batch = spans[i:i + self.maxBatch]
+            try:
+                self.queue.put_nowait(batch)
+            except queue.Full:
+                self.dropped += len(batch)
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                self.write(batch)
+            finally:
+                self.queue.task_done()
+
+    def write(self, batch):
+        line = json.dumps(encodeRequest(batch, self.resource),
+                          separators=(',', ':')) + '\n'
+        try:
+            self._write(line.encode('utf-8'))
+        except OSError:
+            self.failed += len(batch)
+            self._close()
+            LOG.exception("Exporting %s spans to %s failed", len(batch),
+                          self.target)
+        else:
+            self.exported += len(batch)
+
+    def flush(self):
+        """Wait until the queued spans are written"""
+        self.queue.join()
+
+    def _write(self, data):
+        if self.target.startswith('unix:'):
+            if self.sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(TIMEOUT)
+                try:
+                    sock.connect(self.target[len('unix:'):])
+                except OSError:
+                    sock.close()
+                    raise
+                self.sock = sock
+            self.sock.sendall(data)
+        else:
+            if self.file is None:
+                self.file = open(self.target, 'ab')
+            self.file.write(data)
+            self.file.flush()
+
+    def _close(self):
+        for stream in (self.file, self.sock):
+            if stream is not None:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        self.file = self.sock = None
+
+    def close(self):
+        """Write the queued spans, stop the thread and close `target`"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+        self._close()
+
+    def __repr__(self):
+        return '<SpanExporter %s>' % self.target
@@ -0,0 +1,81 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Cheap capture of thread stacks, formatted only when needed
+"""
+import linecache
+import threading
+
+
+# at most this many formatted stack entries get cached
+CACHE_SIZE = 10000
+
+# (id(code), lineno) -> (code, formatted entry), code objects compare by
+# value, equal functions in different files would get mixed up
+_entries = {}
+_lock = threading.Lock()
+
+
+class Stack:
+    """The (code, lineno) pairs of a stack, innermost first
+
+    Keeps neither frames, so their locals can go away, nor text, which
+    gets made only by `format()`.
+    """
+
+    __slots__ = ('entries',)
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def format(self):
+        """Return the stack as `traceback.print_stack()` prints it"""
+        return ''.join(formatEntry(code, lineno)
+                       for code, lineno in reversed(self.entries))
+
+
+def capture(frame, limit=None):
+    """Capture the stack of `frame`, at most its `limit` innermost frames
+
+    Walks `f_back` only, no source gets read.
+    """
+    entries = []
+    append = entries.append
+    while frame is not None:
+        if limit is not None and len(entries) >= limit:
+            break
+        append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return Stack(entries)
+
+
+def formatEntry(code, lineno):
+    """Return the traceback entry of a line of code, cached"""
+    key = (id(code), lineno)
+    cached = _entries.get(key)
+    # keeping the code object, its id can't be reused
+    if cached is not None and cached[0] is code:
+        return cached[1]
+    filename = code.co_filename
+    entry = '  File "%s", line %s, in %s\n' % (filename, lineno, code.co_name)
+    line = linecache.getline(filename, lineno).strip()
+    if line:
+        entry += '    %s\n' % line
+    with _lock:
+        if len(_entries) >= CACHE_SIZE:
+            _entries.clear()
+        _entries[key] = (code, entry)
+    return entry
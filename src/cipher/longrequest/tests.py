@@ -1,6 +1,8 @@
 import collections
 import doctest
+import faulthandler
 import sys
+import threading
 import time
 import traceback
 from unittest import mock
@@ -11,8 +13,25 @@ import zope.component.event
 from zope.testing import loggingsupport
 from zope.testing.cleanup import CleanUp as PlacelessSetup
 
+from cipher.longrequest import benchmark
+from cipher.longrequest import capture
+from cipher.longrequest import config
+from cipher.longrequest import corunning
+from cipher.longrequest import health
+from cipher.longrequest import hitters
+from cipher.longrequest import incidents
 from cipher.longrequest import interfaces
+from cipher.longrequest import loadtest
+from cipher.longrequest import locks
 from cipher.longrequest import longrequest
+from cipher.longrequest import queuetime
+from cipher.longrequest import render
+from cipher.longrequest import spans
+from cipher.longrequest import stacks
+from cipher.longrequest import thresholds
+from cipher.longrequest import throttle
+from cipher.longrequest import tracing
+from cipher.longrequest import urls
 
 
 class DummyRequest:
@@ -56,6 +75,39 @@ class DummyApplication:
         pass
 
 
+class DummyFailingApplication:
+    def __call__(self, environ, start_response):
+        raise ValueError('Boom')
+
+
+class DummyEchoApplication:
+    def __call__(self, environ, start_response):
+        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'].encode(), b' ', body]
+
+
+echo_app = DummyEchoApplication()
+
+
+class DummyStreamingApplication:
+    def __call__(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'Hello']
+
+
+def start_response(status, headers, exc_info=None):
+    print(status)
+    print(headers)
+
+
+def collectEvents(*ifaces):
+    events = []
+    for iface in ifaces:
+        zope.component.provideHandler(events.append, adapts=(iface,))
+    return events
+
+
 def addSubscribers():
     zope.component.provideHandler(
         longrequest.addLogEntryError,
@@ -119,6 +171,523 @@ def doctest_ThreadpoolCatcher():
     """
 
 
+def doctest_ThreadpoolCatcher_admin():
+    r"""Test for the admin URL of ThreadpoolCatcher
+
+        >>> import io
+        >>> longrequest.ADMIN_URL = '/++longrequest++'
+        >>> longrequest.ADMIN_TOKEN = 's3cret'
+        >>> tc = longrequest.ThreadpoolCatcher(DummyApplication())
+        >>> logger = loggingsupport.InstalledHandler('cipher.longrequest')
+
+        >>> def admin(body=None, token='s3cret'):
+        ...     kw = {'PATH_INFO': '/++longrequest++',
+        ...           'REQUEST_METHOD': 'GET' if body is None else 'POST',
+        ...           'HTTP_X_LONGREQUEST_TOKEN': token}
+        ...     if body is not None:
+        ...         kw['CONTENT_LENGTH'] = str(len(body))
+        ...         kw['wsgi.input'] = io.BytesIO(body)
+        ...     req = makeRequest(kw)
+        ...     print(b''.join(tc(req.environ, start_response)).decode())
+
+    Without the token nothing happens:
+
+        >>> admin(b'verbose=true', token='guess')
+        403 Forbidden
+        [('Content-Type', 'text/plain; charset=utf-8'),
+         ('Content-Length', '10')]
+        Forbidden
+
+    With it, the settings are shown:
+
+        >>> admin()
+        200 OK
+        [('Content-Type', 'text/plain; charset=utf-8'), ...]
+        duration-level-1 = 2
+        duration-level-2 = 10
+        duration-level-3 = 30
+        tick = 1
+        verbose = false
+        finished-log-level = info
+
+    and POSTed options change them:
+
+        >>> before = longrequest.CONFIG
+        >>> admin(b'duration-level-1=1&verbose=true&exclude-url-1=.*/rest/.*')
+        200 OK
+        [...]
+        duration-level-1 = 1
+        duration-level-2 = 10
+        duration-level-3 = 30
+        tick = 1
+        verbose = true
+        finished-log-level = info
+        exclude-url-1 = .*/rest/.*
+        >>> before.verbose, longrequest.CONFIG.verbose
+        (False, True)
+        >>> print(logger)
+        cipher.longrequest INFO
+          Configuration changed:
+        duration-level-1 = 1
+        ...
+
+        >>> admin(b'duration-level-2=soon')
+        400 Bad Request
+        [...]
+        ValueError: invalid literal for int() with base 10: 'soon'
+        >>> longrequest.CONFIG.durationLevels
+        (1, 10, 30)
+
+    Empty values clear the exclusions:
+
+        >>> admin(b'exclude-url-1=')
+        200 OK
+        [...]
+        duration-level-1 = 1
+        duration-level-2 = 10
+        duration-level-3 = 30
+        tick = 1
+        verbose = true
+        finished-log-level = info
+        >>> longrequest.CONFIG.ignoreURLs
+        ()
+
+    The tick can't outlast the dump timer:
+
+        >>> longrequest.DUMP_TIMEOUT = 10
+        >>> admin(b'tick=10')
+        400 Bad Request
+        [...]
+        ValueError: dump-timeout 10 is not longer than the tick 10
+        >>> longrequest.CONFIG.tick
+        1
+        >>> longrequest.DUMP_TIMEOUT = None
+
+    Nor stop the checker thread or make it spin:
+
+        >>> admin(b'tick=-1')
+        400 Bad Request
+        [...]
+        ValueError: tick -1 is not positive
+        >>> admin(b'tick=0')
+        400 Bad Request
+        [...]
+        ValueError: tick 0 is not positive
+        >>> longrequest.CONFIG.tick
+        1
+
+    POSTing nothing reloads the ini file:
+
+        >>> import os.path
+        >>> longrequest.CONFIG_FILE = os.path.join(
+        ...     os.path.dirname(__file__), 'testing', 'paster.ini')
+        >>> admin(b'')
+        200 OK
+        [...]
+        duration-level-1 = 3
+        duration-level-2 = 7
+        duration-level-3 = 42
+        ...
+
+    Other URLs go to the application:
+
+        >>> req = makeRequest({'PATH_INFO': '/foo'})
+        >>> tc(req.environ, start_response)
+
+        >>> logger.uninstall()
+    """
+
+
+def doctest_Bulkhead():
+    """Test for Bulkhead
+
+        >>> import re
+        >>> bulkhead = longrequest.Bulkhead(re.compile('.*/reports/.*'), 2)
+        >>> bulkhead
+        <Bulkhead .*/reports/.* 0/2>
+
+        >>> bulkhead.match('http://localhost/reports/monthly')
+        True
+        >>> bulkhead.match('http://localhost/dashboard')
+        False
+
+    Slots get taken up to the limit:
+
+        >>> bulkhead.acquire()
+        True
+        >>> bulkhead.acquire()
+        True
+        >>> bulkhead.acquire()
+        False
+        >>> bulkhead.current, bulkhead.peak, bulkhead.rejected
+        (2, 2, 1)
+
+    An excess request may wait for a slot to get free:
+
+        >>> import threading
+        >>> timer = threading.Timer(0.05, bulkhead.release)
+        >>> timer.start()
+        >>> bulkhead.acquire(timeout=5)
+        True
+        >>> timer.join()
+
+    Or give up after the timeout:
+
+        >>> bulkhead.acquire(timeout=0.01)
+        False
+        >>> bulkhead.rejected
+        2
+
+        >>> bulkhead.release()
+        >>> bulkhead.release()
+        >>> bulkhead
+        <Bulkhead .*/reports/.* 0/2>
+
+    The peak stays until cleared:
+
+        >>> bulkhead.getPeak(clear=True)
+        2
+        >>> bulkhead.getPeak()
+        0
+
+    """
+
+
+def doctest_ThreadpoolCatcher_bulkhead():
+    """Test for ThreadpoolCatcher limiting concurrent requests
+
+        >>> import re
+        >>> bulkhead = longrequest.Bulkhead(re.compile('.*/reports/.*'), 1)
+        >>> longrequest.BULKHEADS = [bulkhead]
+
+        >>> tc = longrequest.ThreadpoolCatcher(DummyStreamingApplication())
+
+    Requests to other URLs pass unaffected:
+
+        >>> req = makeRequest({'PATH_INFO': '/dashboard'})
+        >>> tc(req.environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain')]
+        [b'Hello']
+
+    The first report request takes the only slot until its response is
+    closed:
+
+        >>> req = makeRequest({'PATH_INFO': '/reports/monthly'})
+        >>> app_iter = tc(req.environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain')]
+        >>> list(app_iter)
+        [b'Hello']
+        >>> bulkhead.current
+        1
+
+    So the second one gets rejected:
+
+        >>> logger = addSubscribers()
+        >>> req = makeRequest({'PATH_INFO': '/reports/monthly'})
+        >>> tc(req.environ, start_response)
+        503 Service Unavailable
+        [('Content-Type', 'text/plain'), ('Retry-After', '1')]
+        [b'Too many concurrent requests, retry later.\\n']
+
+        >>> print(logger)
+        cipher.longrequest INFO
+          Request rejected, bulkhead .*/reports/.* is full:
+        http://localhost/reports/monthly
+        >>> logger.uninstall()
+
+    Bulkheads match the URL the server got, proxy headers clients can set
+    do not get a request past them:
+
+        >>> req = makeRequest({'PATH_INFO': '/reports/monthly',
+        ...                    'HTTP_X_ORIGINAL_URL': 'http://x/other'})
+        >>> tc(req.environ, start_response)
+        503 Service Unavailable
+        [('Content-Type', 'text/plain'), ('Retry-After', '1')]
+        [b'Too many concurrent requests, retry later.\\n']
+
+        >>> app_iter.close()
+        >>> bulkhead.current
+        0
+
+        >>> longrequest.getBulkheadStats()
+        [{'pattern': '.*/reports/.*', 'limit': 1, 'current': 0, 'peak': 1,
+          'rejected': 2}]
+
+    The slot is freed when the application fails, too:
+
+        >>> tc = longrequest.ThreadpoolCatcher(DummyFailingApplication())
+        >>> req = makeRequest({'PATH_INFO': '/reports/monthly'})
+        >>> tc(req.environ, start_response)
+        Traceback (most recent call last):
+          ...
+        ValueError: Boom
+        >>> bulkhead.current
+        0
+
+    """
+
+
+def doctest_ThreadpoolCatcher_nested():
+    """Test for nested ThreadpoolCatchers doing the per request work once
+
+        >>> import re
+        >>> bulkhead = longrequest.Bulkhead(re.compile('.*/reports/.*'), 1)
+        >>> longrequest.BULKHEADS = [bulkhead]
+        >>> longrequest.QUEUE_TIMES = queuetime.Histogram()
+        >>> longrequest.THRESHOLDS = thresholds.ThresholdLearner(
+        ...     minSamples=1)
+        >>> saveNOW = longrequest.NOW
+        >>> longrequest.NOW = lambda: 1700000002.0
+
+        >>> tc = longrequest.ThreadpoolCatcher(
+        ...     longrequest.ThreadpoolCatcher(DummyStreamingApplication()))
+
+    The request takes a single slot of the bulkhead, its queue wait and
+    duration are recorded once:
+
+        >>> req = makeRequest({'PATH_INFO': '/reports/monthly',
+        ...                    'HTTP_X_REQUEST_START': 't=1700000000.5'})
+        >>> app_iter = tc(req.environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain')]
+        >>> bulkhead.current
+        1
+        >>> app_iter.close()
+        >>> bulkhead.current, bulkhead.rejected
+        (0, 0)
+
+        >>> longrequest.getQueueStats()['count']
+        1
+        >>> longrequest.THRESHOLDS.estimators['/reports/monthly'].count
+        1
+
+        >>> longrequest.NOW = saveNOW
+
+    """
+
+
+def doctest_RequestBody():
+    """Test for RequestBody
+
+    Small bodies are kept in memory:
+
+        >>> import io
+        >>> body = capture.RequestBody(io.BytesIO(b'abcdef'), 4, 10)
+        >>> body.size, body.filename
+        (4, None)
+        >>> body.open().read()
+        b'abcd'
+
+    Big ones go to a temporary file, every stream is independent:
+
+        >>> body = capture.RequestBody(io.BytesIO(b'x' * 100), 100, 10)
+        >>> body.size
+        100
+        >>> filename = body.filename
+        >>> f1 = body.open()
+        >>> f2 = body.open()
+        >>> len(f1.read(60)), len(f2.read()), len(f1.read())
+        (60, 100, 40)
+        >>> f1.close(); f2.close()
+
+        >>> body.close()
+        >>> import os.path
+        >>> os.path.exists(filename)
+        False
+
+    A truncated stream gives a shorter body:
+
+        >>> body = capture.RequestBody(io.BytesIO(b'x' * 5), 100, 10)
+        >>> body.size
+        5
+        >>> body.close()
+
+    """
+
+
+def doctest_spoolBody():
+    """Test for spoolBody
+
+        >>> import io
+        >>> req = makeRequest({'CONTENT_LENGTH': '5',
+        ...                    'wsgi.input': io.BytesIO(b'hello world')})
+        >>> body = capture.spoolBody(req.environ, 1024, 4096)
+        >>> body.size
+        5
+        >>> req.environ['wsgi.input'].read()
+        b'hello'
+
+    Bodies too big or of unknown size are left alone:
+
+        >>> req = makeRequest({'CONTENT_LENGTH': '5000'})
+        >>> print(capture.spoolBody(req.environ, 1024, 4096))
+        None
+        >>> req = makeRequest({'CONTENT_LENGTH': 'chunked'})
+        >>> print(capture.spoolBody(req.environ, 1024, 4096))
+        None
+
+    Without a Content-Length, as for chunked uploads, the application
+    still gets the body:
+
+        >>> stream = io.BytesIO(b'hello world')
+        >>> req = makeRequest({'wsgi.input': stream})
+        >>> print(capture.spoolBody(req.environ, 1024, 4096))
+        None
+        >>> req.environ['wsgi.input'] is stream
+        True
+        >>> req = makeRequest({'CONTENT_LENGTH': '', 'wsgi.input': stream})
+        >>> print(capture.spoolBody(req.environ, 1024, 4096))
+        None
+        >>> req.environ['wsgi.input'].read()
+        b'hello world'
+
+    An empty body is fine:
+
+        >>> req = makeRequest({'CONTENT_LENGTH': '0'})
+        >>> capture.spoolBody(req.environ, 1024, 4096).size
+        0
+
+    """
+
+
+def doctest_ThreadpoolCatcher_capture():
+    """Test for ThreadpoolCatcher capturing slow requests
+
+        >>> import io, os, tempfile, shutil, threading
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> longrequest.CAPTURE_DIR = tmpdir
+
+        >>> tc = longrequest.ThreadpoolCatcher(DummyEchoApplication())
+        >>> req = makeRequest({'PATH_INFO': '/import',
+        ...                    'REQUEST_METHOD': 'POST',
+        ...                    'CONTENT_LENGTH': '11',
+        ...                    'HTTP_COOKIE': 'secret',
+        ...                    'wsgi.input': io.BytesIO(b'hello world')})
+        >>> app_iter = tc(req.environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain')]
+
+    The application still gets the body, and it is kept for capturing,
+    found by the thread and the id the request got:
+
+        >>> list(app_iter)
+        [b'/import', b' ', b'hello world']
+        >>> thread_id = threading.get_ident()
+        >>> request_id = req.environ['cipher.longrequest.request_id']
+        >>> longrequest.CAPTURES[thread_id, request_id]
+        <Capture 11 bytes>
+
+    Request over level 2 get captured, just once:
+
+        >>> logger = addSubscribers()
+        >>> zope.component.provideHandler(longrequest.captureRequest)
+        >>> environ = longrequest.RequestCheckerThread.removeWSGIStuff(
+        ...     None, req.environ)
+        >>> def makeEvent(eventClass, duration, request_id=request_id):
+        ...     return eventClass(
+        ...         thread_id, duration, 'http://localhost/import', environ,
+        ...         None, request_id=request_id)
+        >>> longrequest.captureRequest(
+        ...     makeEvent(interfaces.LongRequestEventOver1, 5))
+        >>> os.listdir(tmpdir)
+        []
+
+        >>> longrequest.captureRequest(
+        ...     makeEvent(interfaces.LongRequestEventOver2, 15))
+        >>> longrequest.captureRequest(
+        ...     makeEvent(interfaces.LongRequestEventOver3, 35))
+        >>> names = sorted(os.listdir(tmpdir))
+        >>> len(names)
+        2
+        >>> print(logger)
+        cipher.longrequest INFO
+          Long running request captured to ...json
+        >>> logger.clear()
+
+        >>> import json
+        >>> filename = os.path.join(tmpdir, names[1])
+        >>> with open(filename) as f:
+        ...     data = json.load(f)
+        >>> data['uri'], data['level'], data['duration'], data['body_size']
+        ('http://localhost/import', 2, 15, 11)
+        >>> data['request_id'] == request_id
+        True
+        >>> 'HTTP_COOKIE' in data['environ']
+        False
+
+        >>> app_iter.close()
+        >>> longrequest.CAPTURES
+        {}
+
+    The next request of the thread does not get the body of this one,
+    nor does a capture of the same second overwrite the other:
+
+        >>> req = makeRequest({'PATH_INFO': '/import',
+        ...                    'REQUEST_METHOD': 'POST',
+        ...                    'CONTENT_LENGTH': '20000000',
+        ...                    'wsgi.input': io.BytesIO(b'too big')})
+        >>> app_iter = tc(req.environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain')]
+        >>> longrequest.CAPTURES
+        {(..., '...'): <Capture no body>}
+        >>> longrequest.captureRequest(
+        ...     makeEvent(interfaces.LongRequestEventOver2, 15,
+        ...               req.environ['cipher.longrequest.request_id']))
+
+    Requests with a body too big to spool get captured once too:
+
+        >>> longrequest.captureRequest(
+        ...     makeEvent(interfaces.LongRequestEventOver3, 35,
+        ...               req.environ['cipher.longrequest.request_id']))
+        >>> print(logger)
+        cipher.longrequest INFO
+          Long running request captured to ...json
+        >>> len(os.listdir(tmpdir))
+        3
+        >>> app_iter.close()
+
+    The captured request can be replayed:
+
+        >>> status, duration, size = capture.replay(
+        ...     DummyEchoApplication(), filename)
+        >>> status, size
+        ('200 OK', 19)
+
+        >>> capture.main([__name__ + ':echo_app', filename])
+        /.../...json 200 OK 0.0... sec 19 bytes
+
+        >>> logger.uninstall()
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+
+def doctest_loadCapture():
+    """Test for loadCapture
+
+        >>> import json, os, tempfile, shutil
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> filename = os.path.join(tmpdir, 'request.json')
+        >>> with open(filename, 'w') as f:
+        ...     json.dump(dict(uri='https://example.com/x', body=None,
+        ...                    environ={'PATH_INFO': '/x'}), f)
+
+        >>> environ, body = capture.loadCapture(filename)
+        >>> body
+        b''
+        >>> environ['wsgi.url_scheme'], environ['REQUEST_METHOD']
+        ('https', 'GET')
+        >>> environ['PATH_INFO'], environ['CONTENT_LENGTH']
+        ('/x', '0')
+
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+
 def doctest_RequestCheckerThread_nowork():
     """Test for RequestCheckerThread, no threadpool available
 
@@ -148,7 +717,7 @@ def doctest_RequestCheckerThread_nowork():
 
 
 def doctest_RequestCheckerThread_over3():
-    """Test for RequestCheckerThread, duration over DURATION_LEVEL_3
+    """Test for RequestCheckerThread, duration over the third level
 
     >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
 
@@ -181,9 +750,10 @@ def doctest_RequestCheckerThread_over3():
     Top of stack
     >>> logger.clear()
 
-    Well unless DURATION_LEVEL_3 is None, it falls back to level 2
+    Well unless the third level is None, it falls back to level 2
 
-    >>> longrequest.DURATION_LEVEL_3 = None
+    >>> longrequest.CONFIG = longrequest.CONFIG.replace(
+    ...     durationLevels=(2, 10, None))
 
     >>> rct.doWork()
 
@@ -213,7 +783,7 @@ def doctest_RequestCheckerThread_over3():
 
 
 def doctest_RequestCheckerThread_over2():
-    """Test for RequestCheckerThread, duration over DURATION_LEVEL_2
+    """Test for RequestCheckerThread, duration over the second level
 
     >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
 
@@ -252,7 +822,7 @@ def doctest_RequestCheckerThread_over2():
 
 
 def doctest_RequestCheckerThread_over1():
-    """Test for RequestCheckerThread, duration over DURATION_LEVEL_1
+    """Test for RequestCheckerThread, duration over the first level
 
     >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
 
@@ -616,9 +1186,8 @@ def doctest_RequestCheckerThread_all_levels_none():
     >>> req = makeRequest()
     >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 7, req.environ)
 
-    >>> longrequest.DURATION_LEVEL_1 = None
-    >>> longrequest.DURATION_LEVEL_2 = None
-    >>> longrequest.DURATION_LEVEL_3 = None
+    >>> longrequest.CONFIG = longrequest.CONFIG.replace(
+    ...     durationLevels=(None, None, None))
 
     >>> rct.doWork()
 
@@ -696,11 +1265,17 @@ def doctest_RequestCheckerThread_uri():
     Top of stack
     >>> logger.clear()
 
-    Check now HTTP_X_FORWARDED_FOR:
-
-    >>> kw = {'wsgi.url_scheme': 'https', 'PATH_INFO': '/foobar',
-    ...     'QUERY_STRING': 'bar=42', 'SERVER_PORT': '443',
-    ...     'HTTP_X_FORWARDED_FOR': 'https://foo.bar.com/bar'}
+    Check now the forwarding headers of a proxy, HTTP_X_FORWARDED_FOR is
+    the client address, not part of the URL.  It is a new request on the
+    same thread, the previous one finished:
+
+    >>> events = collectEvents(interfaces.ILongRequestEvent)
+    >>> kw = {'wsgi.url_scheme': 'http', 'PATH_INFO': '/foobar',
+    ...     'QUERY_STRING': 'bar=42', 'SERVER_PORT': '8080',
+    ...     'HTTP_X_FORWARDED_FOR': '10.0.0.1, 192.168.0.1',
+    ...     'HTTP_X_FORWARDED_PROTO': 'https',
+    ...     'HTTP_X_FORWARDED_HOST': 'foo.bar.com',
+    ...     'HTTP_X_FORWARDED_PREFIX': '/bar'}
     >>> req = makeRequest(kw)
     >>> now = time.time()
     >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 15, req.environ)
@@ -710,18 +1285,24 @@ def doctest_RequestCheckerThread_uri():
     >>> print(logger)
     cipher.longrequest DEBUG
       checking request threads
+    cipher.longrequest INFO
+      Long running request finished thread_id:142 duration:15 sec
+    https://localhost/foobar?bar=42
     cipher.longrequest WARNING
       Long running request detected
     thread_id:142
     duration:15 sec
-    URL:https://foo.bar.com/bar
+    URL:https://foo.bar.com/bar/foobar?bar=42
     threads in use:1
-    environment:{'HTTP_X_FORWARDED_FOR': 'https://foo.bar.com/bar',
+    environment:{'HTTP_X_FORWARDED_FOR': '10.0.0.1, 192.168.0.1',
+     'HTTP_X_FORWARDED_HOST': 'foo.bar.com',
+     'HTTP_X_FORWARDED_PREFIX': '/bar',
+     'HTTP_X_FORWARDED_PROTO': 'https',
      'PATH_INFO': '/foobar',
      'QUERY_STRING': 'bar=42',
      'REMOTE_ADDR': '1.1.1.1',
      'SERVER_NAME': 'localhost',
-     'SERVER_PORT': '443'}
+     'SERVER_PORT': '8080'}
     username:
     form:
     Thread stack:
@@ -731,6 +1312,8 @@ def doctest_RequestCheckerThread_uri():
         endless_loop()
     Top of stack
 
+    >>> events[-1].client_ip
+    '10.0.0.1'
 
     >>> logger.uninstall()
     >>> longrequest.THREADPOOL = None
@@ -775,6 +1358,9 @@ def doctest_RequestCheckerThread_zope_request():
     >>> logger.clear()
 
 
+    A fresh start, the checker thread forgets what it knew:
+
+    >>> longrequest.THREAD_STATES.clear()
     >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
     >>> zope_request = DummyZopeRequest(username='foo.admin', form={'foobar':'42'})
 
@@ -813,9 +1399,8 @@ def doctest_RequestCheckerThread_zope_request():
 def doctest_RequestCheckerThread_ignore_urls():
     """Test for RequestCheckerThread, check ignore URLs
 
-    >>> import re
-    >>> longrequest.IGNORE_URLS = [re.compile('.*/rest/.*'),
-    ...     re.compile('.*/admin/.*')]
+    >>> longrequest.CONFIG = longrequest.CONFIG.replace(
+    ...     ignoreURLs=['.*/rest/.*', '.*/admin/.*'])
 
     >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
 
@@ -943,133 +1528,2452 @@ def doctest_getMaxThreadsUsed_getThreadsUsed():
     """
 
 
-def doctest_make_filter():
-    """Test for make_filter
+def doctest_PoolSnapshot():
+    """Test for PoolSnapshot, a consistent copy of the busy workers
 
-    >>> import os.path
-    >>> here = os.path.dirname(__file__)
-    >>> cfg = os.path.join(here, 'testing', 'paster.ini')
+    >>> pool = DummyThreadPool()
+    >>> req = makeRequest()
+    >>> pool.worker_tracker[142] = [100, req.environ]
+
+    >>> snapshot = longrequest.takeSnapshot(pool, now=110)
+    >>> snapshot
+    <PoolSnapshot generation ..., 1 workers>
+    >>> snapshot.now
+    110
+    >>> snapshot.workers[142] == (100, req.environ)
+    True
+
+    Workers coming and going don't change it:
+
+    >>> pool.worker_tracker[143] = [105, req.environ]
+    >>> del pool.worker_tracker[142]
+    >>> sorted(snapshot.workers)
+    [142]
+    >>> longrequest.getThreadsUsed(snapshot)
+    1
 
-    >>> global_conf = {'__file__': cfg, 'here': here}
+    Every snapshot gets a new generation:
 
-    >>> longrequest.make_filter(None, global_conf)
-    <ThreadpoolCatcher>
+    >>> longrequest.takeSnapshot(pool).generation > snapshot.generation
+    True
 
-    >>> print(longrequest.DURATION_LEVEL_1)
-    3
-    >>> print(longrequest.DURATION_LEVEL_2)
-    7
-    >>> print(longrequest.DURATION_LEVEL_3)
-    42
+    The checker thread takes one snapshot per tick, a subscriber changing
+    the thread pool during the tick doesn't disturb it:
 
-    >>> print(longrequest.INITIAL_DELAY)
-    11
-    >>> print(longrequest.TICK)
-    5
+    >>> longrequest.THREADPOOL = pool
+    >>> pool.worker_tracker.clear()
+    >>> pool.worker_tracker[142] = (time.time() - 15, req.environ)
+    >>> pool.worker_tracker[143] = (time.time(), req.environ)
 
-    >>> [p.pattern for p in longrequest.IGNORE_URLS]
-    ['.*/rest/.*', '.*/admin/.*']
+    >>> def onTick(event):
+    ...     pool.worker_tracker.clear()
+    ...     pool.worker_tracker[144] = (time.time(), req.environ)
+    >>> zope.component.provideHandler(
+    ...     onTick, adapts=(interfaces.ILongRequestTickEvent,))
+    >>> events = collectEvents(interfaces.ILongRequestTickEvent,
+    ...                        interfaces.ILongRequestEvent)
+
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> rct.doWork()
+
+    >>> tick, event = events
+    >>> sorted(tick.snapshot.workers)
+    [142, 143]
+    >>> event.thread_id, event.duration
+    (142, 15)
+    >>> event.snapshot is tick.snapshot
+    True
+
+    >>> del events[:]
+    >>> rct.doWork()
+    >>> events[0].generation == tick.generation + 1
+    True
+    >>> sorted(events[0].snapshot.workers)
+    [144]
 
+    >>> longrequest.THREADPOOL = None
     """
 
 
-def doctest_getAllThreadInfo():
-    r"""Test for getAllThreadInfo
+def doctest_RequestCheckerThread_thread_states():
+    """Test for the per thread state of the checker thread
+
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> events = collectEvents(interfaces.ILongRequestEvent,
+    ...                        interfaces.ILongRequestFinishedEvent)
 
     >>> longrequest.THREADPOOL = DummyThreadPool()
     >>> now = time.time()
-    >>> kw = {'wsgi.url_scheme': 'https', 'PATH_INFO': '/rest/update-it',
-    ...     'QUERY_STRING': 'bar=42', 'SERVER_PORT': '443'}
-    >>> req = makeRequest(kw)
-    >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 7, req.environ)
+    >>> req = makeRequest({'PATH_INFO': '/slow'})
+    >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 5, req.environ)
+    >>> longrequest.THREADPOOL.worker_tracker[143] = (now, req.environ)
+    >>> zope_request = DummyZopeRequest(username='foo.admin')
+    >>> longrequest.ZOPE_THREAD_REQUESTS[142] = zope_request
 
-    >>> kw = {'wsgi.url_scheme': 'https', 'PATH_INFO': '/customer/dashboard',
-    ...     'SERVER_PORT': '443'}
-    >>> req = makeRequest(kw)
-    >>> longrequest.THREADPOOL.worker_tracker[143] = (now - 7, req.environ)
+    Only requests over a level get a state:
 
-    >>> info = longrequest.getAllThreadInfo()
-    >>> print('\n--\n'.join(info))
-    thread_id:142
-    duration:7 sec
-    URL:https://localhost/rest/update-it?bar=42
-    threads in use:2
-    environment:{'PATH_INFO': '/rest/update-it',
-     'QUERY_STRING': 'bar=42',
-     'REMOTE_ADDR': '1.1.1.1',
-     'SERVER_NAME': 'localhost',
-     'SERVER_PORT': '443',
-     'wsgi.url_scheme': 'https',
-     'wsgi.version': (1, 0)}
-    username:foo.admin
-    form:{'foobar': '42'}
-    Thread stack:
-      File "module.py", line 69, in main
-        do_stuff()
-      File "submodule.py", line 42, in helper
-        endless_loop()
-    Top of stack
-    --
-    thread_id:143
-    duration:7 sec
-    URL:https://localhost/customer/dashboard
-    threads in use:2
-    environment:{'PATH_INFO': '/customer/dashboard',
-     'REMOTE_ADDR': '1.1.1.1',
-     'SERVER_NAME': 'localhost',
-     'SERVER_PORT': '443',
-     'wsgi.url_scheme': 'https',
-     'wsgi.version': (1, 0)}
-    username:
-    form:
-    Thread stack:
-      File "module.py", line 69, in main
-        do_stuff()
-      File "submodule.py", line 42, in helper
-        endless_loop()
-    Top of stack
+    >>> rct.doWork()
+    >>> longrequest.THREAD_STATES
+    {142: <ThreadState http://localhost/slow started ...>}
+    >>> state = longrequest.THREAD_STATES[142]
+    >>> state.duration, state.notified.__name__, state.template
+    (5, 'LongRequestEventOver1', '/slow')
+    >>> state.zope_request is zope_request
+    True
+    >>> state.foo = 1
+    Traceback (most recent call last):
+    ...
+    AttributeError: 'ThreadState' object has no attribute 'foo'
 
-    >>> info = longrequest.getAllThreadInfo(omitThreads=(143,))
-    >>> print('\n--\n'.join(info))
-    thread_id:142
-    duration:7 sec
-    URL:https://localhost/rest/update-it?bar=42
-    threads in use:2
-    environment:{'PATH_INFO': '/rest/update-it',
-     'QUERY_STRING': 'bar=42',
-     'REMOTE_ADDR': '1.1.1.1',
-     'SERVER_NAME': 'localhost',
-     'SERVER_PORT': '443',
-     'wsgi.url_scheme': 'https',
-     'wsgi.version': (1, 0)}
-    username:foo.admin
-    form:{'foobar': '42'}
-    Thread stack:
-      File "module.py", line 69, in main
-        do_stuff()
-      File "submodule.py", line 42, in helper
-        endless_loop()
-    Top of stack
+    The request finishes, the state goes away.  So does the zope request,
+    in case the thread got killed, or did not clean it up:
+
+    >>> del longrequest.THREADPOOL.worker_tracker[142]
+    >>> rct.doWork()
+    >>> longrequest.THREAD_STATES
+    {}
+    >>> [(e.__class__.__name__, e.thread_id, e.duration) for e in events]
+    [('LongRequestEventOver1', 142, 5), ('LongRequestFinishedEvent', 142, 5)]
+    >>> longrequest.ZOPE_THREAD_REQUESTS
+    {}
 
     >>> longrequest.THREADPOOL = None
     """
 
 
-def doctest_getThreadTraceback():
-    """Test getThreadTraceback
+def doctest_events():
+    """Test for the event classes, they are slotted
 
-    Normally, getThreadTraceback returns the traceback for the frame:
+    >>> from zope.interface.verify import verifyObject
+    >>> event = interfaces.LongRequestEventOver2(
+    ...     142, 15, 'http://localhost/foo', {}, None, template='/foo')
+    >>> verifyObject(interfaces.ILongRequestEventOver2, event)
+    True
+    >>> interfaces.ILongRequestEvent.providedBy(event)
+    True
+    >>> event.snapshot is None
+    True
+    >>> event.foo = 1
+    Traceback (most recent call last):
+    ...
+    AttributeError: 'LongRequestEventOver2' object has no attribute 'foo'
+
+    >>> event = interfaces.LongRequestFinishedEvent(142, 15, 'http://x')
+    >>> verifyObject(interfaces.ILongRequestFinishedEvent, event)
+    True
+    >>> hasattr(event, '__dict__')
+    False
+
+    >>> event = interfaces.LongRequestTickEvent(DummyThreadPool())
+    >>> verifyObject(interfaces.ILongRequestTickEvent, event)
+    True
+    >>> hasattr(event, '__dict__')
+    False
+    """
 
-        >>> print(longrequest.getThreadTraceback(142))
-          File "module.py", line 69, in main
-            do_stuff()
-          File "submodule.py", line 42, in helper
-            endless_loop()
 
-    However, when the thread_id parameter does not match any existing
-    thread:
+def doctest_hasSubscribers():
+    """Test for hasSubscribers
 
-        >>> sys._current_frames.return_value = ret = mock.MagicMock()
+    The tick event gets dispatched only when somebody listens to it:
+
+    >>> longrequest.hasSubscribers(interfaces.ILongRequestTickEvent)
+    False
+
+    >>> longrequest.THREADPOOL = DummyThreadPool()
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> with mock.patch.object(interfaces, 'LongRequestTickEvent') as tick:
+    ...     rct.doWork()
+    >>> tick.called
+    False
+
+    >>> events = collectEvents(interfaces.ILongRequestTickEvent)
+    >>> longrequest.hasSubscribers(interfaces.ILongRequestTickEvent)
+    True
+    >>> rct.doWork()
+    >>> len(events)
+    1
+
+    Subscribers of a base interface count too:
+
+    >>> longrequest.hasSubscribers(interfaces.ILongRequestEventOver1)
+    False
+    >>> events = collectEvents(interfaces.ILongRequestEvent)
+    >>> longrequest.hasSubscribers(interfaces.ILongRequestEventOver1)
+    True
+
+    So do subscribers of all events:
+
+    >>> import zope.event
+    >>> zope.event.subscribers.append(print)
+    >>> longrequest.hasSubscribers(interfaces.ILongRequestFinishedEvent)
+    True
+    >>> zope.event.subscribers.remove(print)
+
+    >>> longrequest.THREADPOOL = None
+    """
+
+
+def doctest_Dispatcher():
+    """Test for Dispatcher, notifying only events somebody listens to
+
+    >>> dispatcher = longrequest.Dispatcher()
+    >>> event = interfaces.LongRequestFinishedEvent(142, 15, 'http://x')
+    >>> dispatcher.notify(event)
+    False
+
+    The answer is cached per interface:
+
+    >>> with mock.patch.object(longrequest, 'hasSubscribers',
+    ...                        return_value=False) as lookup:
+    ...     dispatcher.notify(event)
+    ...     dispatcher.hasSubscribers(interfaces.ILongRequestEventOver1)
+    ...     dispatcher.hasSubscribers(interfaces.ILongRequestEventOver1)
+    False
+    False
+    False
+    >>> lookup.call_args_list
+    [call(<InterfaceClass ...ILongRequestEventOver1>)]
+
+    Until the registry changes:
+
+    >>> dispatcher = longrequest.Dispatcher()
+    >>> dispatcher.hasSubscribers(interfaces.ILongRequestFinishedEvent)
+    False
+    >>> events = collectEvents(interfaces.ILongRequestFinishedEvent)
+    >>> dispatcher.notify(event)
+    True
+    >>> events == [event]
+    True
+
+    >>> zope.component.getGlobalSiteManager().unregisterHandler(
+    ...     events.append, (interfaces.ILongRequestFinishedEvent,))
+    True
+    >>> dispatcher.notify(event)
+    False
+
+    or somebody subscribes to all events:
+
+    >>> import zope.event
+    >>> zope.event.subscribers.append(events.append)
+    >>> dispatcher.notify(event)
+    True
+    >>> zope.event.subscribers.remove(events.append)
+    >>> dispatcher.notify(event)
+    False
+    """
+
+
+def doctest_RequestCheckerThread_batch_event():
+    """Test for LongRequestBatchEvent, all events of a tick at once
+
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> longrequest.THREADPOOL = DummyThreadPool()
+    >>> now = time.time()
+    >>> req = makeRequest()
+    >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 5, req.environ)
+    >>> longrequest.THREADPOOL.worker_tracker[143] = (now - 15, req.environ)
+    >>> longrequest.THREADPOOL.worker_tracker[144] = (now, req.environ)
+
+    Nobody listens, nothing gets notified:
+
+    >>> with mock.patch.object(longrequest, 'notify') as notify:
+    ...     rct.doWork()
+    >>> notify.called
+    False
+
+    >>> batches = collectEvents(interfaces.ILongRequestBatchEvent)
+    >>> longrequest.THREAD_STATES.clear()
+    >>> rct.doWork()
+    >>> batch, = batches
+    >>> [(e.__class__.__name__, e.thread_id) for e in batch.events]
+    [('LongRequestEventOver1', 142), ('LongRequestEventOver2', 143)]
+    >>> batch.finished
+    []
+    >>> len(batch.snapshot)
+    3
+
+    No batch when nothing happens:
+
+    >>> rct.doWork()
+    >>> len(batches)
+    1
+
+    >>> del longrequest.THREADPOOL.worker_tracker[142]
+    >>> rct.doWork()
+    >>> batch = batches[-1]
+    >>> batch.events
+    []
+    >>> [(e.thread_id, e.duration) for e in batch.finished]
+    [(142, 5)]
+
+    >>> longrequest.THREADPOOL = None
+    """
+
+
+def doctest_Renderer():
+    """Test for Renderer, rendering report data within limits
+
+    Small data renders as pprint does:
+
+    >>> renderer = render.Renderer()
+    >>> print(renderer.render({'PATH_INFO': '/foo', 'QUERY_STRING': 'a=1',
+    ...                        'SERVER_NAME': 'localhost', 'n': [1, 2.5, None],
+    ...                        'SERVER_PORT': '80', 'x': (b'y',)}))
+    {'PATH_INFO': '/foo',
+     'QUERY_STRING': 'a=1',
+     'SERVER_NAME': 'localhost',
+     'SERVER_PORT': '80',
+     'n': [1, 2.5, None],
+     'x': (b'y',)}
+
+    Secrets are left out, the regexes are compiled once:
+
+    >>> print(renderer.render({'HTTP_COOKIE': 'session=42',
+    ...                        'HTTP_AUTHORIZATION': 'Basic Zm9v',
+    ...                        'new_password': 'foo', 'csrf_token': 'bar'}))
+    {'HTTP_AUTHORIZATION': <redacted>,
+     'HTTP_COOKIE': <redacted>,
+     'csrf_token': <redacted>,
+     'new_password': <redacted>}
+    >>> render.Renderer(redact=()).render({'HTTP_COOKIE': 'session=42'})
+    "{'HTTP_COOKIE': 'session=42'}"
+
+    Big strings are cut without being copied as a whole:
+
+    >>> renderer = render.Renderer(maxSize=50, maxItems=3, maxDepth=2)
+    >>> print(renderer.render({'upload': 'x' * 20 * 1024 * 1024}))
+    {'upload': 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx...'}
+
+    So are long containers, deep ones, and the rest once the size is
+    used up:
+
+    >>> renderer.render(list(range(1000)))
+    '[0, 1, 2, <997 more>]'
+    >>> renderer.render({'a': {'b': {'c': 1}}})
+    "{'a': {'b': <dict of 1 items>}}"
+    >>> print(renderer.render({'a': 'x' * 35, 'b': 'y', 'c': 'z'}))
+    {'a': 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx', 'b': 'y', ...: <1 more>}
+
+    Other objects render as their repr, cut as well:
+
+    >>> class Huge:
+    ...     def __repr__(self):
+    ...         return '<Huge %s>' % ('h' * 100)
+    >>> print(renderer.render([Huge()]))
+    [<Huge hhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhh...]
+    >>> class Broken:
+    ...     def __repr__(self):
+    ...         raise ValueError('oops')
+    >>> renderer.render(Broken())
+    '<unrepresentable Broken: oops>'
+
+    Huge objects of the types reprlib knows, and byte arrays, are not
+    formatted as a whole to be cut then:
+
+    >>> import array, collections
+    >>> huge = [bytearray(b'b' * 1024 * 1024),
+    ...         collections.deque(range(1024 * 1024)),
+    ...         array.array('b', b'a' * 1024 * 1024)]
+    >>> with mock.patch.object(render.BoundedRepr, 'repr_instance',
+    ...                        side_effect=AssertionError('full repr')):
+    ...     for value in huge:
+    ...         print(renderer.render(value))
+    bytearray(b'bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb...
+    deque([0, 1, 2, ...])
+    array('b', [97, 97, 97, ...])
+    >>> print(renderer.render(collections.deque([[[1]]])))
+    deque([[[...]]])
+
+    The formatting never makes it longer than twice the maximum size:
+
+    >>> len(renderer.render([['x' * 10] * 3] * 3)) <= 103
+    True
+    """
+
+
+def doctest_PoolHealth():
+    """Test for PoolHealth, the state machine of the pool's health
+
+    >>> pool = health.PoolHealth(stallTicks=3, recoverTicks=2)
+    >>> pool.state
+    'healthy'
+
+    >>> busy = {1: (100, {}), 2: (100, {})}
+    >>> pool.update({1: (100, {})}, 2)
+
+    All threads busy, the pool is saturated at once:
+
+    >>> pool.update(busy, 2)
+    ('healthy', 'saturated')
+    >>> pool.update(busy, 2)
+
+    No request finished for 3 ticks, it's stalled:
+
+    >>> pool.update(busy, 2)
+    ('saturated', 'stalled')
+    >>> pool.update(busy, 2)
+
+    A request finishing doesn't change the state right away, it has to
+    look better for 2 ticks in a row:
+
+    >>> busy = {1: (101, {}), 2: (100, {})}
+    >>> pool.update(busy, 2)
+    >>> pool.state
+    'stalled'
+    >>> pool.update(busy, 2)
+    ('stalled', 'saturated')
+
+    >>> pool.update({1: (101, {})}, 2)
+    >>> pool.update(busy, 2)
+    >>> pool.update({}, 2)
+    >>> pool.update({}, 2)
+    ('saturated', 'healthy')
+
+    Without knowing the pool size, the pool stays healthy:
+
+    >>> pool.update(busy, None)
+    >>> pool.update(busy, None)
+    >>> pool.update(busy, None)
+    >>> pool.state
+    'healthy'
+
+    Requests waiting long for a thread tell that it is saturated, until a
+    thread gets free and no request waited for it:
+
+    >>> pool = health.PoolHealth(stallTicks=2, recoverTicks=1,
+    ...                          queueThreshold=1.0)
+    >>> pool.update(busy, None, 0.2)
+    >>> pool.update(busy, None, 1.5)
+    ('healthy', 'saturated')
+    >>> pool.update(busy, None)
+    ('saturated', 'stalled')
+    >>> pool.update({1: (150,)}, None)
+    ('stalled', 'healthy')
+
+    >>> import queue
+    >>> class Pool:
+    ...     workers = [1, 2, 3]
+    ...     queue = queue.Queue()
+    >>> Pool.queue.put(1)
+    >>> health.getPoolSize(Pool), health.getQueueDepth(Pool)
+    (3, 1)
+    >>> health.getPoolSize(DummyThreadPool())
+    >>> health.getQueueDepth(DummyThreadPool())
+
+    Owners of re-entrant locks in module globals are detectable:
+
+    >>> import threading
+    >>> lock = threading.RLock()
+    >>> with mock.patch.object(health, 'LOCK', lock, create=True), lock:
+    ...     owners = health.getLockOwners()
+    >>> ('cipher.longrequest.health.LOCK', threading.get_ident(), 1) in owners
+    True
+
+    Also once threading.RLock makes tracked locks, for the locks created
+    before and after:
+
+    >>> locks.patch()
+    >>> tracked = threading.RLock()
+    >>> tracked
+    <TrackedRLock <doctest ...>:1 owner=None>
+    >>> with mock.patch.multiple(health, LOCK=lock, TRACKED=tracked,
+    ...                          create=True):
+    ...     with lock, tracked, tracked:
+    ...         owners = health.getLockOwners()
+    >>> me = threading.get_ident()
+    >>> ('cipher.longrequest.health.LOCK', me, 1) in owners
+    True
+    >>> ('cipher.longrequest.health.TRACKED', me, 2) in owners
+    True
+    >>> locks.unpatch()
+    """
+
+
+def doctest_RequestCheckerThread_pool_health():
+    """Test for the pool health events of RequestCheckerThread
+
+    >>> longrequest.STALL_TICKS = 2
+    >>> longrequest.RECOVER_TICKS = 1
+    >>> zope.component.provideHandler(
+    ...     longrequest.addLogEntryPoolState,
+    ...     adapts=(interfaces.IPoolStateChangedEvent,))
+    >>> logger = loggingsupport.InstalledHandler('cipher.longrequest')
+
+    >>> pool = longrequest.THREADPOOL = DummyThreadPool()
+    >>> pool.workers = [142, 143]
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> longrequest.THREAD = rct
+    >>> longrequest.getPoolState()
+    'healthy'
+
+    >>> now = time.time()
+    >>> req = makeRequest()
+    >>> pool.worker_tracker[142] = (now, req.environ)
+    >>> pool.worker_tracker[143] = (now, req.environ)
+    >>> rct.doWork()
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+    cipher.longrequest WARNING
+      Thread pool saturated, was healthy
+      threads in use:2 of 2
+      queued requests:None
+    >>> logger.clear()
+
+    On stalling the diagnostics show all threads and the lock owners:
+
+    >>> rct.doWork()
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+    cipher.longrequest ERROR
+      Thread pool stalled, was saturated
+      threads in use:2 of 2
+      queued requests:None
+      Lock owners:
+      ...
+      Threads:
+      thread_id:142
+      ...
+      thread_id:143
+      ...
+    >>> longrequest.getPoolState()
+    'stalled'
+    >>> logger.clear()
+
+    >>> del pool.worker_tracker[142]
+    >>> rct.doWork()
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+    cipher.longrequest INFO
+      Thread pool healthy, was stalled
+      threads in use:1 of 2
+      queued requests:None
+
+    >>> logger.uninstall()
+    >>> longrequest.THREAD = None
+    >>> longrequest.THREADPOOL = None
+    """
+
+
+def doctest_TrackedLock():
+    """Test for TrackedLock and TrackedRLock
+
+    >>> table = locks.LockTable()
+    >>> lock = locks.TrackedLock('db', table)
+    >>> with lock:
+    ...     lock.owner == threading.get_ident(), len(table.held)
+    (True, 1)
+    >>> lock.owner, table.held
+    (None, {})
+    >>> table.stats
+    {'db': <LockStats acquired 1, contended 0, waited 0.000 s, ...>}
+    >>> lock.acquire(False), lock.acquire(False), lock.locked()
+    (True, False, True)
+    >>> lock.release()
+    >>> lock.release()
+    Traceback (most recent call last):
+    ...
+    RuntimeError: release unlocked lock
+
+    A thread waiting for the lock shows up in the table, with the owner:
+
+    >>> lock.acquire()
+    True
+    >>> waiter = threading.Thread(target=lock.acquire)
+    >>> waiter.start()
+    >>> while not table.waiting:
+    ...     time.sleep(0.001)
+    >>> waited, owner, seconds = table.getWait(waiter.ident)
+    >>> waited is lock, owner == threading.get_ident()
+    (True, True)
+    >>> lock.release()
+    >>> waiter.join()
+    >>> table.waiting, lock.owner == waiter.ident
+    ({}, True)
+    >>> table.stats['db'].contended
+    1
+    >>> lock.release()
+
+    Re-entrant locks work with conditions:
+
+    >>> rlock = locks.TrackedRLock('cache', table)
+    >>> with rlock:
+    ...     with rlock:
+    ...         rlock.count
+    2
+    >>> rlock.locked(), rlock.count
+    (False, 0)
+    >>> rlock.release()
+    Traceback (most recent call last):
+    ...
+    RuntimeError: cannot release un-acquired lock
+
+    >>> condition = threading.Condition(rlock)
+    >>> with condition:
+    ...     condition.wait(0.001)
+    ...     rlock.owner == threading.get_ident()
+    False
+    True
+    >>> table.stats['cache'].acquired
+    3
+
+    The statistics are kept for a limited number of names:
+
+    >>> table = locks.LockTable(maxSize=1)
+    >>> for name in 'ab':
+    ...     with locks.TrackedLock(name, table):
+    ...         pass
+    >>> sorted(table.stats), table.dropped
+    (['a'], 2)
+
+    """
+
+
+def doctest_LockTable_findDeadlocks():
+    """Test for LockTable.findDeadlocks
+
+    >>> table = locks.LockTable()
+    >>> a = locks.TrackedLock('a', table)
+    >>> b = locks.TrackedLock('b', table)
+    >>> c = locks.TrackedLock('c', table)
+
+    Thread 1 holds a and waits for b, thread 2 holds b and waits for a,
+    thread 3 waits for a too, without being part of the circle:
+
+    >>> a.owner, b.owner = 1, 2
+    >>> table.waiting.update({1: (b, 0), 2: (a, 0), 3: (a, 0)})
+    >>> table.findDeadlocks()
+    [[(1, <TrackedLock b owner=2>), (2, <TrackedLock a owner=1>)]]
+    >>> print(table.findCycle(3))
+    None
+
+    >>> c.owner = 4
+    >>> table.waiting = {4: (c, 0)}
+    >>> table.findDeadlocks()
+    [[(4, <TrackedLock c owner=4>)]]
+
+    """
+
+
+def doctest_getLockWait():
+    r"""Test for the tracked locks in the thread reports
+
+    >>> longrequest.THREADPOOL = DummyThreadPool()
+    >>> now = time.time()
+    >>> kw = {'PATH_INFO': '/reports/monthly'}
+    >>> longrequest.THREADPOOL.worker_tracker[142] = (
+    ...     now - 7, makeRequest(kw).environ)
+    >>> longrequest.THREADPOOL.worker_tracker[143] = (
+    ...     now - 3, makeRequest().environ)
+
+    >>> print(longrequest.getLockWait(143))
+    <BLANKLINE>
+
+    >>> lock = locks.TrackedLock('reports')
+    >>> lock.owner = 142
+    >>> locks.TABLE.waiting[143] = (lock, time.monotonic())
+    >>> print(longrequest.getLockWait(143))
+    <BLANKLINE>
+    waiting 0.0 sec on lock reports held by thread 142
+      (itself running http://localhost/reports/monthly for 7 sec)
+
+    >>> info = longrequest.formatThreadInfo(
+    ...     143, 3, 'http://localhost/foo', {}, None)
+    >>> print(info)
+    thread_id:143
+    duration:3 sec
+    URL:http://localhost/foo
+    threads in use:2
+    waiting 0.0 sec on lock reports held by thread 142
+      (itself running http://localhost/reports/monthly for 7 sec)
+    environment:{}
+    ...
+
+    Waiting in a circle is a deadlock:
+
+    >>> other = locks.TrackedLock('customers')
+    >>> other.owner = 143
+    >>> locks.TABLE.waiting[142] = (other, time.monotonic())
+    >>> print(longrequest.getLockWait(143))
+    <BLANKLINE>
+    waiting 0.0 sec on lock reports held by thread 142
+      (itself running http://localhost/reports/monthly for 7 sec)
+    deadlock: thread 143 waits on lock reports held by thread 142,
+      thread 142 waits on lock customers held by thread 143
+
+    The checker notifies the deadlock once:
+
+    >>> zope.component.provideHandler(
+    ...     longrequest.addLogEntryDeadlock,
+    ...     adapts=(interfaces.IDeadlockEvent,))
+    >>> logger = loggingsupport.InstalledHandler('cipher.longrequest')
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> rct.doWork()
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+    cipher.longrequest ERROR
+      Deadlock detected
+      deadlock: thread 143 waits on lock reports held by thread 142,
+        thread 142 waits on lock customers held by thread 143
+      thread_id:143
+        File "module.py", line 69, in main
+      ...
+      --
+      thread_id:142
+        File "module.py", line 69, in main
+        ...
+    >>> logger.clear()
+    >>> rct.doWork()
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+
+    >>> logger.uninstall()
+    >>> longrequest.THREADPOOL = None
+    """
+
+
+def doctest_Config():
+    r"""Test for Config
+
+        >>> settings = config.Config()
+        >>> settings
+        <Config levels (2, 10, 30), tick 1, verbose False>
+        >>> settings.verbose = True
+        Traceback (most recent call last):
+        ...
+        AttributeError: Config is immutable, use replace()
+
+        >>> changed = settings.replace(verbose=True, ignoreURLs=['.*/rest/.*'])
+        >>> changed, settings
+        (<Config levels (2, 10, 30), tick 1, verbose True>,
+         <Config levels (2, 10, 30), tick 1, verbose False>)
+        >>> changed.ignoreURLs
+        (re.compile('.*/rest/.*'),)
+
+    Options change the settings they name, the others stay:
+
+        >>> changed = config.fromOptions(
+        ...     {'duration-level-3': '60', 'finished-log-level': 'warn',
+        ...      'threshold-url-1': '.*/export/.*',
+        ...      'threshold-levels-1': '30 60 120'}, changed)
+        >>> print(changed.format())
+        duration-level-1 = 2
+        duration-level-2 = 10
+        duration-level-3 = 60
+        tick = 1
+        verbose = true
+        finished-log-level = warn
+        exclude-url-1 = .*/rest/.*
+        threshold-url-1 = .*/export/.*
+        threshold-levels-1 = 30 60 120
+
+    Its format is read back the same:
+
+        >>> import configparser
+        >>> parser = configparser.RawConfigParser()
+        >>> parser.read_string('[cipher.longrequest]\n' + changed.format())
+        >>> config.fromParser(parser).format() == changed.format()
+        True
+
+    Levels can be unset, exclusions and thresholds removed, by empty
+    values, which the format reads back too:
+
+        >>> changed = config.fromOptions(
+        ...     {'duration-level-1': '', 'exclude-url-1': '',
+        ...      'threshold-url-1': ''}, changed)
+        >>> changed.durationLevels, changed.ignoreURLs, changed.urlThresholds
+        ((None, 10, 60), (), ())
+        >>> print(changed.format())
+        duration-level-1 =
+        duration-level-2 = 10
+        duration-level-3 = 60
+        tick = 1
+        verbose = true
+        finished-log-level = warn
+        >>> parser = configparser.RawConfigParser()
+        >>> parser.read_string('[cipher.longrequest]\n' + changed.format())
+        >>> config.fromParser(parser).durationLevels
+        (None, 10, 60)
+
+    The tick is the same for all applications, only the main section can
+    have it:
+
+        >>> parser.read_string('[cipher.longrequest.reports]\ntick = 5\n')
+        >>> config.forSection(parser, 'cipher.longrequest.reports')
+        Traceback (most recent call last):
+        ...
+        ValueError: tick is the same for all applications, set it in
+        [cipher.longrequest], not in [cipher.longrequest.reports]
+        >>> config.fromOptions({'tick': '5'}, changed,
+        ...                    'cipher.longrequest.reports')
+        Traceback (most recent call last):
+        ...
+        ValueError: tick is the same for all applications, set it in
+        [cipher.longrequest], not in [cipher.longrequest.reports]
+        >>> config.fromOptions({'verbose': 'off'}, changed,
+        ...                    'cipher.longrequest.reports')
+        <Config levels (None, 10, 60), tick 1, verbose False>
+
+    The checker thread sleeps a tick, which has to be positive:
+
+        >>> config.fromOptions({'tick': '0'}, changed)
+        Traceback (most recent call last):
+        ...
+        ValueError: tick 0 is not positive
+
+    """
+
+
+def doctest_reloadConfig():
+    r"""Test for reloading the settings
+
+        >>> import os
+        >>> import tempfile
+        >>> tmpdir = tempfile.TemporaryDirectory()
+        >>> filename = os.path.join(tmpdir.name, 'paster.ini')
+        >>> def write(text, mtime):
+        ...     with open(filename, 'w') as f:
+        ...         _ = f.write('[cipher.longrequest]\n' + text)
+        ...     os.utime(filename, (mtime, mtime))
+        >>> write('duration-level-1 = 5\nreload-on-change = true\n', 1000)
+
+        >>> longrequest.make_filter(None, {'__file__': filename})
+        <ThreadpoolCatcher>
+        >>> longrequest.CONFIG
+        <Config levels (5, 10, 30), tick 1, verbose False>
+        >>> longrequest.CONFIG_MTIME
+        1000.0
+
+        >>> logger = loggingsupport.InstalledHandler('cipher.longrequest')
+        >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+        >>> rct.doWork()
+        >>> longrequest.CONFIG
+        <Config levels (5, 10, 30), tick 1, verbose False>
+
+    The checker thread notices the file changing:
+
+        >>> write('duration-level-1 = 1\nverbose = on\n', 2000)
+        >>> rct.doWork()
+        >>> longrequest.CONFIG
+        <Config levels (1, 10, 30), tick 1, verbose True>
+        >>> print(logger)
+        cipher.longrequest INFO
+          Configuration changed:
+        duration-level-1 = 1
+        ...
+
+    A broken file leaves the settings alone:
+
+        >>> logger.clear()
+        >>> write('duration-level-1 = never\n', 3000)
+        >>> rct.doWork()
+        >>> longrequest.CONFIG
+        <Config levels (1, 10, 30), tick 1, verbose True>
+        >>> print(logger)
+        cipher.longrequest ERROR
+          Reloading the configuration from .../paster.ini failed
+
+    Without watching the file, the reload signal asks for a reload on the
+    next tick:
+
+        >>> import signal
+        >>> longrequest.CONFIG_MTIME = None
+        >>> write('duration-level-1 = 4\n', 4000)
+        >>> rct.doWork()
+        >>> longrequest.CONFIG
+        <Config levels (1, 10, 30), tick 1, verbose True>
+
+        >>> saved = signal.getsignal(signal.SIGUSR2)
+        >>> longrequest.registerReloadSignal('usr2')
+        >>> os.kill(os.getpid(), signal.SIGUSR2)
+        >>> longrequest.RELOAD_PENDING
+        True
+        >>> rct.doWork()
+        >>> longrequest.CONFIG
+        <Config levels (4, 10, 30), tick 1, verbose False>
+        >>> longrequest.RELOAD_PENDING
+        False
+
+    Running make_filter again doesn't pile up exclusion patterns:
+
+        >>> write('exclude-url-1 = .*/rest/.*\n', 5000)
+        >>> _ = longrequest.make_filter(None, {'__file__': filename})
+        >>> _ = longrequest.make_filter(None, {'__file__': filename})
+        >>> longrequest.CONFIG.ignoreURLs
+        (re.compile('.*/rest/.*'),)
+
+        >>> _ = signal.signal(signal.SIGUSR2, saved)
+        >>> logger.uninstall()
+        >>> tmpdir.cleanup()
+    """
+
+
+def doctest_Monitor():
+    r"""Test for watching several applications with settings of their own
+
+    >>> import os
+    >>> import tempfile
+    >>> tmpdir = tempfile.TemporaryDirectory()
+    >>> filename = os.path.join(tmpdir.name, 'paster.ini')
+    >>> with open(filename, 'w') as f:
+    ...     _ = f.write('[cipher.longrequest]\n'
+    ...                 'duration-level-1 = 5\n'
+    ...                 'exclude-url-1 = .*/rest/.*\n'
+    ...                 '[cipher.longrequest.reports]\n'
+    ...                 'duration-level-1 = 60\n'
+    ...                 'duration-level-2 = 120\n'
+    ...                 'duration-level-3 = 300\n'
+    ...                 'verbose = true\n')
+
+    >>> main = longrequest.make_filter(
+    ...     DummyApplication(), {'__file__': filename})
+    >>> reports = longrequest.make_filter(
+    ...     DummyApplication(), {'__file__': filename},
+    ...     section='cipher.longrequest.reports')
+    >>> main.monitor, reports.monitor
+    (<DefaultMonitor>, <Monitor cipher.longrequest.reports>)
+    >>> longrequest.MONITORS
+    (<DefaultMonitor>, <Monitor cipher.longrequest.reports>)
+
+    The settings missing in the section of the application are those of
+    the main section:
+
+    >>> main.monitor.config, reports.monitor.config
+    (<Config levels (5, 10, 30), tick 1, verbose False>,
+     <Config levels (60, 120, 300), tick 1, verbose True>)
+    >>> [p.pattern for p in reports.monitor.config.ignoreURLs]
+    ['.*/rest/.*']
+
+    A second filter of the same section shares the monitor:
+
+    >>> longrequest.make_filter(
+    ...     DummyApplication(), {'__file__': filename},
+    ...     section='cipher.longrequest.reports').monitor is reports.monitor
+    True
+
+    The requests get marked with the monitor of their application, the
+    one checker thread watches all of them:
+
+    >>> pool = longrequest.THREADPOOL = DummyThreadPool()
+    >>> now = time.time()
+    >>> reportsRequest = makeRequest({'PATH_INFO': '/monthly'})
+    >>> reports(reportsRequest.environ, None)
+    >>> mainRequest = makeRequest({'PATH_INFO': '/dashboard'})
+    >>> main(mainRequest.environ, None)
+    >>> longrequest.MONITOR_KEY in mainRequest.environ
+    False
+
+    Of nested filters, the innermost one's monitor watches the request,
+    also if it is the default one:
+
+    >>> inner = longrequest.ThreadpoolCatcher(DummyApplication())
+    >>> outer = longrequest.ThreadpoolCatcher(inner, reports.monitor)
+    >>> nestedRequest = makeRequest({'PATH_INFO': '/nested'})
+    >>> outer(nestedRequest.environ, None)
+    >>> longrequest.getMonitor(nestedRequest.environ)
+    <DefaultMonitor>
+    >>> inner.application = longrequest.ThreadpoolCatcher(
+    ...     DummyApplication(), reports.monitor)
+    >>> outer = longrequest.ThreadpoolCatcher(inner)
+    >>> outer(nestedRequest.environ, None)
+    >>> longrequest.getMonitor(nestedRequest.environ)
+    <Monitor cipher.longrequest.reports>
+
+    >>> pool.worker_tracker[142] = (now - 40, reportsRequest.environ)
+    >>> pool.worker_tracker[143] = (now - 8, mainRequest.environ)
+
+    >>> logger = addSubscribers()
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> rct.doWork()
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+    cipher.longrequest INFO
+      Long running request detected
+    thread_id:143
+    duration:8 sec
+    URL:http://localhost/dashboard
+    ...
+    >>> sorted(longrequest.THREAD_STATES), sorted(reports.monitor.states)
+    ([143], [])
+    >>> logger.clear()
+
+    >>> pool.worker_tracker[142] = (now - 70, reportsRequest.environ)
+    >>> rct.doWork()
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+    cipher.longrequest INFO
+      Long running request detected in cipher.longrequest.reports
+    thread_id:142
+    duration:70 sec
+    URL:http://localhost/monthly
+    ...
+    Other threads:
+    --
+    thread_id:143
+    ...
+    >>> logger.clear()
+
+    The statistics are kept per monitor, and for the whole process:
+
+    >>> del pool.worker_tracker[142]
+    >>> rct.doWork()
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+    cipher.longrequest INFO
+      Long running request finished in cipher.longrequest.reports
+      thread_id:142 duration:70 sec
+    http://localhost/monthly
+    >>> reports.monitor.getMaxRequestTime(), rct.getMaxRequestTime()
+    (70, 70)
+    >>> longrequest.MONITOR.getMaxRequestTime()
+    0
+
+    Reloading reads the settings of all monitors:
+
+    >>> with open(filename) as f:
+    ...     text = f.read().replace('= 60', '= 90')
+    >>> with open(filename, 'w') as f:
+    ...     _ = f.write(text)
+    >>> logger.clear()
+    >>> longrequest.reloadConfig()
+    True
+    >>> main.monitor.config, reports.monitor.config
+    (<Config levels (5, 10, 30), tick 1, verbose False>,
+     <Config levels (90, 120, 300), tick 1, verbose True>)
+    >>> print(logger)
+    cipher.longrequest INFO
+      Configuration changed:
+    ...
+    cipher.longrequest INFO
+      Configuration of cipher.longrequest.reports changed:
+    ...
+
+    Starting the checker thread again keeps the running one:
+
+    >>> longrequest.THREAD = running = threading.current_thread()
+    >>> longrequest.startThread(None, None, None, None)
+    >>> longrequest.THREAD is running
+    True
+
+    >>> longrequest.THREAD = None
+    >>> longrequest.THREADPOOL = None
+    >>> logger.uninstall()
+    >>> tmpdir.cleanup()
+    """
+
+
+def doctest_SpaceSaving():
+    """Test for SpaceSaving
+
+        >>> counter = hitters.SpaceSaving(capacity=2)
+        >>> counter.started('alice')
+        True
+        >>> counter.add('alice', 30)
+        >>> counter.started('bob')
+        True
+        >>> counter.add('bob', 5)
+        >>> counter.finished('bob')
+        >>> counter.top()
+        [('alice', <HitterStats count 1, 30 sec, concurrent 1, error 0>),
+         ('bob', <HitterStats count 1, 5 sec, concurrent 0, error 0>)]
+
+    When full, a new key replaces the one with the fewest seconds, taking
+    over its figures as the error:
+
+        >>> counter.started('carol')
+        True
+        >>> counter.add('carol', 2)
+        >>> counter.get('carol')
+        <HitterStats count 2, 7 sec, concurrent 1, error 5>
+        >>> print(counter.get('bob'))
+        None
+
+    Keys with long requests running stay, with no room left new keys
+    only get counted as dropped:
+
+        >>> counter.started('dave')
+        False
+        >>> counter.dropped
+        1
+        >>> counter.add('dave', 100)
+        >>> counter.finished('dave')
+        >>> sorted(counter.entries)
+        ['alice', 'carol']
+
+    Once there is, the key replacing another one may overestimate a lot,
+    up to its error:
+
+        >>> counter.finished('alice')
+        >>> counter.started('dave')
+        True
+        >>> counter.top(1)
+        [('dave', <HitterStats count 2, 30 sec, concurrent 1, error 30>)]
+        >>> counter
+        <SpaceSaving 2/2>
+
+        >>> counter.clear()
+        >>> counter.top()
+        []
+
+    """
+
+
+def doctest_RequestCheckerThread_top_consumers():
+    """Test for the per principal and per tenant long request counts
+
+        >>> longrequest.getTopPrincipals()
+        Traceback (most recent call last):
+          ...
+        ValueError: Not counting principals
+
+        >>> longrequest.PRINCIPALS = hitters.SpaceSaving(10)
+        >>> longrequest.TENANTS = hitters.SpaceSaving(10)
+        >>> longrequest.TENANT_KEY = 'HTTP_X_TENANT'
+
+        >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+        >>> longrequest.THREADPOOL = DummyThreadPool()
+        >>> now = time.time()
+        >>> longrequest.NOW = lambda: now
+
+    The principal comes from the zope request, REMOTE_USER otherwise:
+
+        >>> req = makeRequest({'HTTP_X_TENANT': 'acme'})
+        >>> longrequest.ZOPE_THREAD_REQUESTS[142] = DummyZopeRequest('alice')
+        >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 5, req.environ)
+        >>> req = makeRequest({'HTTP_X_TENANT': 'acme', 'REMOTE_USER': 'bob'})
+        >>> longrequest.THREADPOOL.worker_tracker[143] = (now - 1, req.environ)
+        >>> rct.doWork()
+        >>> longrequest.getTopPrincipals()
+        [('alice', <HitterStats count 1, 5 sec, concurrent 1, error 0>)]
+
+    Requests count once they are long ones, with their whole duration,
+    growing while they run:
+
+        >>> now += 10
+        >>> rct.doWork()
+        >>> longrequest.getTopPrincipals()
+        [('alice', <HitterStats count 1, 15 sec, concurrent 1, error 0>),
+         ('bob', <HitterStats count 1, 11 sec, concurrent 1, error 0>)]
+        >>> longrequest.getTopTenants()
+        [('acme', <HitterStats count 2, 26 sec, concurrent 2, error 0>)]
+
+        >>> del longrequest.THREADPOOL.worker_tracker[142]
+        >>> now += 1
+        >>> rct.doWork()
+        >>> longrequest.getTopPrincipals(1)
+        [('alice', <HitterStats count 1, 15 sec, concurrent 0, error 0>)]
+        >>> longrequest.getTopTenants()
+        [('acme', <HitterStats count 2, 27 sec, concurrent 1, error 0>)]
+
+        >>> longrequest.THREADPOOL = None
+        >>> longrequest.NOW = time.time
+
+    """
+
+
+def doctest_CoRunning():
+    """Test for CoRunning
+
+        >>> counter = corunning.CoRunning(maxPairs=3)
+        >>> counter.record('/import', {'/import': 2, '/report': 1})
+        >>> counter.record('/report', {'/import': 1, '/report': 1})
+        >>> counter.top()
+        [(('/import', '/report'), 2), (('/import', '/import'), 1)]
+        >>> counter.top(template='/report')
+        [(('/import', '/report'), 2)]
+
+    When full, a new pair replaces the least counted one, taking over its
+    count:
+
+        >>> counter.record('/login',
+        ...                {'/login': 1, '/search': 1, '/import': 1})
+        >>> counter.top()
+        [(('/import', '/report'), 2), (('/import', '/login'), 2),
+         (('/login', '/search'), 1)]
+        >>> counter
+        <CoRunning 3/3>
+
+    Pairs counted more since they were added are not the least counted:
+
+        >>> counter.record('/login', {'/login': 1, '/search': 5})
+        >>> counter.record('/export', {'/export': 1, '/search': 1})
+        >>> counter.top()
+        [(('/login', '/search'), 6), (('/export', '/search'), 3),
+         (('/import', '/report'), 2)]
+        >>> len(counter.heap)
+        3
+
+        >>> counter.clear()
+        >>> counter.top()
+        []
+
+    """
+
+
+def doctest_RequestCheckerThread_corunning():
+    """Test for the requests running together with long ones
+
+        >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+        >>> longrequest.THREADPOOL = DummyThreadPool()
+        >>> now = time.time()
+        >>> longrequest.NOW = lambda: now
+
+        >>> tracker = longrequest.THREADPOOL.worker_tracker
+        >>> tracker[142] = (now - 5, makeRequest({'PATH_INFO': '/import'}).environ)
+        >>> tracker[143] = (now - 1, makeRequest({'PATH_INFO': '/report'}).environ)
+        >>> tracker[144] = (now - 1, makeRequest({'PATH_INFO': '/search'}).environ)
+
+    Counted when a request becomes a long one, for each other busy
+    request, no matter whether that one is a long one:
+
+        >>> rct.doWork()
+        >>> longrequest.getCorunningPairs()
+        [(('/import', '/report'), 1), (('/import', '/search'), 1)]
+
+    Only once per long request:
+
+        >>> now += 10
+        >>> rct.doWork()
+        >>> longrequest.getCorunningPairs(template='/report')
+        [(('/import', '/report'), 2), (('/report', '/search'), 2)]
+
+    The busy requests get looked at once per tick, for all long requests:
+
+        >>> snapshot = longrequest.takeSnapshot(longrequest.THREADPOOL)
+        >>> longrequest.getCorunning(snapshot)
+        [(142, '/import', 15), (143, '/report', 11), (144, '/search', 11)]
+        >>> longrequest.getCorunning(snapshot) is snapshot.corunning
+        True
+        >>> sorted(longrequest.getTemplateCounts(snapshot).items())
+        [('/import', 1), ('/report', 1), ('/search', 1)]
+
+    The summary lists the other requests, longest first, with where they
+    are:
+
+        >>> def importing():
+        ...     return sys._getframe()
+        >>> def searching():
+        ...     return sys._getframe()
+        >>> sys._current_frames.return_value = {
+        ...     142: importing(), 143: sys._getframe(), 144: searching()}
+        >>> print(longrequest.formatCorunning(143, snapshot))
+        Co-running requests:
+          thread_id:142 duration:15 sec /import at <doctest ...>:2 in importing
+          thread_id:144 duration:11 sec /search at <doctest ...>:2 in searching
+
+    Where the threads are gets looked up once per tick too:
+
+        >>> sys._current_frames.reset_mock()
+        >>> print(longrequest.formatCorunning(142, snapshot))
+        Co-running requests:
+          thread_id:143 duration:11 sec /report at <doctest ...>:1 in <module>
+          thread_id:144 duration:11 sec /search at <doctest ...>:2 in searching
+        >>> sys._current_frames.called
+        False
+
+        >>> del tracker[142], tracker[144]
+        >>> snapshot = longrequest.takeSnapshot(longrequest.THREADPOOL)
+        >>> longrequest.formatCorunning(143, snapshot)
+        ''
+
+        >>> longrequest.CORUNNING = None
+        >>> longrequest.getCorunningPairs()
+        Traceback (most recent call last):
+          ...
+        ValueError: Not counting co-running requests
+
+        >>> longrequest.THREADPOOL = None
+        >>> longrequest.NOW = time.time
+
+    """  # noqa: E501 line too long
+
+
+def doctest_P2Quantile():
+    """Test for P2Quantile
+
+        >>> estimator = thresholds.P2Quantile(0.5)
+        >>> print(estimator.value())
+        None
+
+    With a few observations the estimate is exact:
+
+        >>> for x in (5, 1, 3):
+        ...     estimator.add(x)
+        >>> estimator.value()
+        3
+
+    With many, the estimate gets close to the real quantile, while only
+    five markers are kept:
+
+        >>> import random
+        >>> rnd = random.Random(42)
+        >>> estimator = thresholds.P2Quantile(0.99)
+        >>> for i in range(20000):
+        ...     estimator.add(rnd.uniform(0, 100))
+        >>> 98 < estimator.value() < 100
+        True
+        >>> len(estimator.heights)
+        5
+
+    """
+
+
+def doctest_ThresholdLearner():
+    """Test for ThresholdLearner
+
+        >>> learner = thresholds.ThresholdLearner(
+        ...     quantile=0.5, factors=(2, 4, 8), minSamples=3, maxKeys=2)
+
+    Nothing gets learned until there are enough samples:
+
+        >>> learner.record('/report', 1.0)
+        >>> learner.record('/report', 1.0)
+        >>> print(learner.getLevels('/report'))
+        None
+        >>> learner.record('/report', 1.0)
+        >>> learner.getQuantile('/report')
+        1.0
+        >>> learner.getLevels('/report')
+        (2.0, 4.0, 8.0)
+
+        >>> print(learner.getLevels('/unknown'))
+        None
+
+    The number of tracked URLs is bounded, the URL recorded least recently
+    makes room, so that new ones still get learned:
+
+        >>> learner.record('/dashboard', 0.1)
+        >>> learner.record('/report', 1.0)
+        >>> learner.record('/profile', 0.1)
+        >>> list(learner.estimators)
+        ['/report', '/profile']
+        >>> for i in range(3):
+        ...     learner.record('/dashboard', 0.5)
+        >>> learner.getLevels('/dashboard')
+        (1.0, 2.0, 4.0)
+        >>> list(learner.estimators)
+        ['/profile', '/dashboard']
+
+        >>> learner.clear()
+        >>> len(learner.estimators)
+        0
+
+    """
+
+
+def doctest_getDurationLevels():
+    """Test for getDurationLevels
+
+    By default the global levels apply:
+
+        >>> longrequest.getDurationLevels('http://localhost/export/all')
+        (2, 10, 30)
+
+    Explicit URL thresholds win:
+
+        >>> longrequest.CONFIG = longrequest.CONFIG.replace(
+        ...     urlThresholds=[('.*/export/.*', (30, 60, 120))])
+        >>> longrequest.getDurationLevels('http://localhost/export/all')
+        (30, 60, 120)
+        >>> longrequest.getDurationLevels('http://localhost/dashboard')
+        (2, 10, 30)
+
+    Learned levels are used for URLs with enough history, the query string
+    does not matter:
+
+        >>> longrequest.THRESHOLDS = thresholds.ThresholdLearner(
+        ...     factors=(3, 10, 30), minSamples=1)
+        >>> longrequest.THRESHOLDS.record('/dashboard', 0.1)
+        >>> longrequest.getDurationLevels('http://localhost/dashboard?a=1')
+        (0.30000000000000004, 1.0, 3.0)
+        >>> longrequest.getDurationLevels('http://localhost/export/all')
+        (30, 60, 120)
+
+    """
+
+
+def doctest_getLevelEvent():
+    """Test for getLevelEvent
+
+        >>> longrequest.getLevelEvent(1, (2, 10, 30))
+        >>> longrequest.getLevelEvent(3, (2, 10, 30))
+        <class 'cipher.longrequest.interfaces.LongRequestEventOver1'>
+        >>> longrequest.getLevelEvent(11, (2, 10, 30))
+        <class 'cipher.longrequest.interfaces.LongRequestEventOver2'>
+        >>> longrequest.getLevelEvent(31, (2, 10, 30))
+        <class 'cipher.longrequest.interfaces.LongRequestEventOver3'>
+        >>> longrequest.getLevelEvent(31, (2, 10, None))
+        <class 'cipher.longrequest.interfaces.LongRequestEventOver2'>
+        >>> longrequest.getLevelEvent(31, (None, None, None))
+
+    """
+
+
+def doctest_RequestCheckerThread_adaptive_thresholds():
+    """Test for RequestCheckerThread, with learned thresholds
+
+    A normally fast page gets reported after a single second, an export
+    that normally takes long stays quiet:
+
+    >>> longrequest.THRESHOLDS = thresholds.ThresholdLearner(
+    ...     factors=(10, 30, 100), minSamples=2)
+    >>> for i in range(2):
+    ...     longrequest.THRESHOLDS.record('/dashboard', 0.05)
+    ...     longrequest.THRESHOLDS.record('/export', 20)
+
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> logger = addSubscribers()
+
+    >>> longrequest.THREADPOOL = DummyThreadPool()
+    >>> now = time.time()
+    >>> req = makeRequest({'PATH_INFO': '/dashboard'})
+    >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 1.5, req.environ)
+    >>> req = makeRequest({'PATH_INFO': '/export'})
+    >>> longrequest.THREADPOOL.worker_tracker[143] = (now - 40, req.environ)
+
+    >>> rct.doWork()
+
+    >>> print(logger)
+    cipher.longrequest DEBUG
+      checking request threads
+    cipher.longrequest INFO
+      Long running request detected
+    thread_id:142
+    duration:1 sec
+    URL:http://localhost/dashboard
+    threads in use:2
+    environment:{'PATH_INFO': '/dashboard',
+     'REMOTE_ADDR': '1.1.1.1',
+     'SERVER_NAME': 'localhost',
+     'SERVER_PORT': '80'}
+    username:
+    form:
+    Thread stack:
+      File "module.py", line 69, in main
+        do_stuff()
+      File "submodule.py", line 42, in helper
+        endless_loop()
+    Top of stack
+
+    >>> logger.uninstall()
+    >>> longrequest.THREADPOOL = None
+
+    """
+
+
+def doctest_queuetime():
+    """Test for measuring the time requests wait for a thread
+
+        >>> queuetime.parseRequestStart('t=1700000000.5')
+        1700000000.5
+        >>> queuetime.parseRequestStart('t=1700000000500')
+        1700000000.5
+        >>> queuetime.parseRequestStart('1700000000500000')
+        1700000000.5
+        >>> print(queuetime.parseRequestStart('t=soon'))
+        None
+
+    The first header present counts, clock differences don't make delays
+    negative:
+
+        >>> environ = {'HTTP_X_QUEUE_START': 't=1700000001',
+        ...            'HTTP_X_REQUEST_START': 't=1700000000.5'}
+        >>> queuetime.getQueueDelay(environ, 1700000001.0)
+        0.5
+        >>> queuetime.getQueueDelay(environ, 1700000000.0)
+        0.0
+        >>> print(queuetime.getQueueDelay({}, 1700000000.0))
+        None
+
+        >>> histogram = queuetime.Histogram(bounds=(0.1, 1, 10))
+        >>> print(histogram.quantile(0.5), histogram.getPeak())
+        None None
+        >>> for value in (0.05, 0.05, 0.5, 2, 20):
+        ...     histogram.add(value)
+        >>> histogram.getBuckets()
+        [(0.1, 2), (1, 1), (10, 1), (None, 1)]
+        >>> histogram.quantile(0.5), histogram.quantile(0.99)
+        (1, 20)
+        >>> histogram.getPeak(clear=True), histogram.getPeak()
+        (20, None)
+        >>> histogram
+        <Histogram 5 values>
+
+    """
+
+
+def doctest_ThreadpoolCatcher_queue_delay():
+    """Test for ThreadpoolCatcher measuring the queue wait
+
+        >>> longrequest.getQueueStats()
+        Traceback (most recent call last):
+          ...
+        ValueError: Not measuring queue wait
+
+        >>> longrequest.QUEUE_TIMES = queuetime.Histogram()
+        >>> longrequest.NOW = lambda: 1700000002.0
+
+        >>> tc = longrequest.ThreadpoolCatcher(DummyApplication())
+        >>> req = makeRequest({'HTTP_X_REQUEST_START': 't=1700000000.5'})
+        >>> tc(req.environ, start_response)
+        >>> req.environ['cipher.longrequest.queue_delay']
+        1.5
+        >>> tc(makeRequest().environ, start_response)
+
+        >>> stats = longrequest.getQueueStats()
+        >>> stats['count'], stats['mean'], stats['p99'], stats['max']
+        (1, 1.5, 1.5, 1.5)
+
+    Long request events and reports tell the wait:
+
+        >>> logger = addSubscribers()
+        >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+        >>> longrequest.THREADPOOL = DummyThreadPool()
+        >>> longrequest.THREADPOOL.worker_tracker[142] = (
+        ...     1700000002.0 - 5, req.environ)
+        >>> events = collectEvents(interfaces.ILongRequestEvent)
+        >>> rct.doWork()
+        >>> events[0].queue_delay
+        1.5
+        >>> print(logger)
+        cipher.longrequest DEBUG
+          checking request threads
+        cipher.longrequest INFO
+          Long running request detected
+        thread_id:142
+        duration:5 sec
+        queue wait:1.500 sec
+        URL:http://localhost
+        ...
+        >>> logger.uninstall()
+
+        >>> longrequest.THREADPOOL = None
+        >>> longrequest.NOW = time.time
+
+    """
+
+
+def doctest_tracing():
+    r"""Test for request ids
+
+        >>> tracing.parseTraceparent(
+        ...     '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01')
+        ('4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7')
+        >>> print(tracing.parseTraceparent(
+        ...     '00-00000000000000000000000000000000-00f067aa0ba902b7-01'))
+        None
+        >>> print(tracing.parseTraceparent('garbage'))
+        None
+
+    X-Request-ID wins, then the trace id, a new id is made otherwise:
+
+        >>> tracing.getRequestId({
+        ...     'HTTP_X_REQUEST_ID': ' req-42 ',
+        ...     'HTTP_TRACEPARENT':
+        ...         '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'})
+        'req-42'
+        >>> tracing.getRequestId({
+        ...     'HTTP_X_REQUEST_ID': 'no spaces\nor newlines',
+        ...     'HTTP_TRACEPARENT':
+        ...         '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'})
+        '4bf92f3577b34da6a3ce929d0e0e4736'
+        >>> len(tracing.getRequestId({'HTTP_X_REQUEST_ID': 'x' * 201}))
+        32
+
+    """
+
+
+def doctest_ThreadpoolCatcher_request_id():
+    """Test for ThreadpoolCatcher giving requests an id
+
+        >>> longrequest.REQUEST_IDS = True
+        >>> longrequest.REQUEST_ID_RESPONSE_HEADER = 'X-Request-ID'
+
+        >>> tc = longrequest.ThreadpoolCatcher(DummyStreamingApplication())
+        >>> req = makeRequest({'HTTP_X_REQUEST_ID': 'req-42'})
+        >>> tc(req.environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain'), ('X-Request-ID', 'req-42')]
+        [b'Hello']
+        >>> req.environ['cipher.longrequest.request_id']
+        'req-42'
+
+    A filter further in keeps the id, and the response header:
+
+        >>> inner = longrequest.ThreadpoolCatcher(DummyStreamingApplication())
+        >>> tc = longrequest.ThreadpoolCatcher(inner)
+        >>> req = makeRequest()
+        >>> with mock.patch.object(tracing, 'newRequestId', lambda: 'new'):
+        ...     tc(req.environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain'), ('X-Request-ID', 'new')]
+        [b'Hello']
+
+    Events and reports tell the id:
+
+        >>> logger = addSubscribers()
+        >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+        >>> longrequest.THREADPOOL = DummyThreadPool()
+        >>> now = time.time()
+        >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 5, req.environ)
+        >>> events = collectEvents(interfaces.ILongRequestEvent,
+        ...                        interfaces.ILongRequestFinishedEvent)
+        >>> rct.doWork()
+        >>> del longrequest.THREADPOOL.worker_tracker[142]
+        >>> rct.doWork()
+        >>> [(event.__class__.__name__, event.request_id) for event in events]
+        [('LongRequestEventOver1', 'new'), ('LongRequestFinishedEvent', 'new')]
+        >>> print(logger)
+        cipher.longrequest DEBUG
+          checking request threads
+        cipher.longrequest INFO
+          Long running request detected
+        thread_id:142
+        request_id:new
+        duration:5 sec
+        ...
+        cipher.longrequest INFO
+          Long running request finished thread_id:142 request_id:new
+          duration:5 sec
+        http://localhost
+        >>> logger.uninstall()
+
+        >>> longrequest.THREADPOOL = None
+
+    """
+
+
+def doctest_spans():
+    r"""Test for Span and SpanExporter
+
+        >>> from pprint import pprint
+        >>> span = spans.Span('/orders/{id}', 100.5,
+        ...                   '4bf92f3577b34da6a3ce929d0e0e4736',
+        ...                   '00f067aa0ba902b7',
+        ...                   {'thread.id': 142, 'enduser.id': None,
+        ...                    'http.route': '/orders/{id}'})
+        >>> span.addEvent('level 1 crossed', 103, {'ratio': 0.5})
+        >>> encoded = span.encode(110)
+        >>> encoded['spanId'] == span.span_id, len(span.span_id)
+        (True, 16)
+        >>> del encoded['spanId']
+        >>> pprint(encoded)
+        {'attributes': [{'key': 'thread.id', 'value': {'intValue': '142'}},
+                        {'key': 'http.route',
+                         'value': {'stringValue': '/orders/{id}'}}],
+         'endTimeUnixNano': '110000000000',
+         'events': [{'attributes': [{'key': 'ratio',
+                                     'value': {'doubleValue': 0.5}}],
+                     'name': 'level 1 crossed',
+                     'timeUnixNano': '103000000000'}],
+         'kind': 2,
+         'name': '/orders/{id}',
+         'parentSpanId': '00f067aa0ba902b7',
+         'startTimeUnixNano': '100500000000',
+         'traceId': '4bf92f3577b34da6a3ce929d0e0e4736'}
+
+    Without a trace context, the span starts a trace:
+
+        >>> span = spans.Span('/', 100)
+        >>> len(span.trace_id), span.parent_id
+        (32, None)
+
+    Batches get written as lines of OTLP/JSON:
+
+        >>> import json, os, socket, tempfile
+        >>> tmpdir = tempfile.TemporaryDirectory()
+        >>> filename = os.path.join(tmpdir.name, 'spans.json')
+        >>> exporter = spans.SpanExporter(filename, maxBatch=2)
+        >>> exporter.export([{'name': 'a'}, {'name': 'b'}, {'name': 'c'}])
+        >>> exporter.close()
+        >>> with open(filename) as f:
+        ...     lines = f.readlines()
+        >>> len(lines)
+        2
+        >>> request = json.loads(lines[1])
+        >>> request['resourceSpans'][0]['resource']
+        {'attributes': [{'key': 'service.name',
+                         'value': {'stringValue': 'cipher.longrequest'}}]}
+        >>> request['resourceSpans'][0]['scopeSpans']
+        [{'scope': {'name': 'cipher.longrequest'}, 'spans': [{'name': 'c'}]}]
+
+    or to a Unix socket, by a thread of the exporter, failures get logged:
+
+        >>> path = os.path.join(tmpdir.name, 'collector.sock')
+        >>> exporter = spans.SpanExporter('unix:' + path)
+        >>> logger = loggingsupport.InstalledHandler('cipher.longrequest')
+        >>> exporter.export([{'name': 'a'}])
+        >>> exporter.flush()
+        >>> exporter.failed
+        1
+        >>> print(logger)
+        cipher.longrequest ERROR
+          Exporting 1 spans to unix:.../collector.sock failed
+        >>> logger.uninstall()
+
+        >>> server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        >>> server.bind(path)
+        >>> server.listen(1)
+        >>> exporter.export([{'name': 'a'}])
+        >>> exporter.flush()
+        >>> conn, address = server.accept()
+        >>> conn.recv(1000)
+        b'{"resourceSpans":[...,"spans":[{"name":"a"}]}]}]}\n'
+        >>> exporter.exported, exporter.failed
+        (1, 1)
+        >>> exporter.close()
+        >>> conn.close()
+        >>> server.close()
+
+    A slow target does not hold up the caller, the batches not fitting in
+    the queue get dropped:
+
+        >>> import threading
+        >>> writing = threading.Event()
+        >>> release = threading.Event()
+        >>> def write(batch):
+        ...     writing.set()
+        ...     release.wait()
+        >>> exporter = spans.SpanExporter(filename, maxBatch=1, maxQueue=1)
+        >>> exporter.write = write
+        >>> exporter.export([{'name': 'a'}])
+        >>> writing.wait(5)
+        True
+        >>> exporter.export([{'name': 'b'}, {'name': 'c'}])
+        >>> exporter.dropped
+        1
+        >>> release.set()
+        >>> exporter.close()
+        >>> exporter.thread is None
+        True
+        >>> tmpdir.cleanup()
+
+    """
+
+
+def doctest_RequestCheckerThread_spans():
+    """Test for exporting long requests as spans
+
+        >>> import json, os, tempfile
+        >>> from pprint import pprint
+        >>> tmpdir = tempfile.TemporaryDirectory()
+        >>> filename = os.path.join(tmpdir.name, 'spans.json')
+        >>> longrequest.SPAN_EXPORTER = spans.SpanExporter(filename)
+        >>> zope.component.provideHandler(
+        ...     longrequest.exportSpans,
+        ...     adapts=(interfaces.ILongRequestBatchEvent,))
+
+        >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+        >>> longrequest.THREADPOOL = DummyThreadPool()
+        >>> now = 1700000000
+        >>> longrequest.NOW = lambda: now
+        >>> req = makeRequest({
+        ...     'PATH_INFO': '/orders/42', 'REQUEST_METHOD': 'POST',
+        ...     'HTTP_TRACEPARENT':
+        ...         '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'})
+        >>> longrequest.ZOPE_THREAD_REQUESTS[142] = DummyZopeRequest('alice')
+        >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 5, req.environ)
+
+    Only requests crossing a level get exported, when they finish:
+
+        >>> rct.doWork()
+        >>> now += 10
+        >>> rct.doWork()
+        >>> os.path.exists(filename)
+        False
+        >>> del longrequest.THREADPOOL.worker_tracker[142]
+        >>> now += 1
+        >>> rct.doWork()
+        >>> longrequest.SPAN_EXPORTER.flush()
+
+        >>> with open(filename) as f:
+        ...     lines = f.readlines()
+        >>> len(lines)
+        1
+        >>> span, = json.loads(lines[0])['resourceSpans'][0]['scopeSpans'][0][
+        ...     'spans']
+        >>> span['traceId'], span['parentSpanId'], span['name']
+        ('4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7', '/orders/{id}')
+        >>> span['startTimeUnixNano'], span['endTimeUnixNano']
+        ('1699999995000000000', '1700000011000000000')
+        >>> pprint({a['key']: a['value'] for a in span['attributes']})
+        {'cipher.longrequest.duration': {'intValue': '15'},
+         'client.address': {'stringValue': '1.1.1.1'},
+         'enduser.id': {'stringValue': 'alice'},
+         'http.request.method': {'stringValue': 'POST'},
+         'http.route': {'stringValue': '/orders/{id}'},
+         'thread.id': {'intValue': '142'},
+         'url.full': {'stringValue': 'http://localhost/orders/42'}}
+        >>> for event in span['events']:
+        ...     print(event['name'], event['timeUnixNano'])
+        ...     print(event['attributes'][1]['value']['stringValue'])
+        level 1 crossed 1700000000000000000
+          File "module.py", line 69, in main
+            do_stuff()
+          File "submodule.py", line 42, in helper
+            endless_loop()
+        level 2 crossed 1700000010000000000
+          File "module.py", line 69, in main
+        ...
+        >>> longrequest.RUNNING_SPANS
+        {}
+
+        >>> longrequest.SPAN_EXPORTER.close()
+        >>> tmpdir.cleanup()
+        >>> longrequest.THREADPOOL = None
+        >>> longrequest.NOW = time.time
+
+    """  # noqa: E501 line too long
+
+
+def doctest_ReportThrottle():
+    """Test for ReportThrottle
+
+        >>> limits = throttle.ReportThrottle(levelRate=1, levelBurst=3,
+        ...                                  urlRate=0.5, urlBurst=2)
+
+    Each URL template gets its own burst, the level a bigger one:
+
+        >>> [limits.allow(1, '/import', 100) for i in range(3)]
+        [True, True, False]
+        >>> [limits.allow(1, '/report', 100) for i in range(2)]
+        [True, False]
+        >>> limits.allow(2, '/report', 100)
+        True
+        >>> limits.takeSuppressed()
+        [(1, 2)]
+        >>> limits.takeSuppressed()
+        []
+
+    Tokens come back at the rates, a denied report takes none:
+
+        >>> limits.allow(1, '/report', 100.5)
+        False
+        >>> limits.allow(1, '/report', 101)
+        True
+        >>> limits.levels
+        {1: <TokenBucket 0.0/3>, 2: <TokenBucket 2.0/3>}
+
+    The number of URL buckets is bounded:
+
+        >>> limits = throttle.ReportThrottle(urlRate=1, maxURLs=2)
+        >>> for template in ('/a', '/b', '/a', '/c'):
+        ...     ok = limits.allow(1, template, 100)
+        >>> list(limits.urls)
+        [(1, '/a'), (1, '/c')]
+
+    """
+
+
+def doctest_RequestCheckerThread_throttle():
+    """Test for rate limiting the long request reports
+
+        >>> longrequest.THROTTLE = throttle.ReportThrottle(
+        ...     levelRate=1, levelBurst=2)
+        >>> zope.component.provideHandler(
+        ...     longrequest.addLogEntrySuppressed,
+        ...     adapts=(interfaces.IReportsSuppressedEvent,))
+        >>> logger = addSubscribers()
+        >>> events = collectEvents(interfaces.ILongRequestEvent)
+
+        >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+        >>> longrequest.THREADPOOL = DummyThreadPool()
+        >>> now = time.time()
+        >>> longrequest.NOW = lambda: now
+        >>> for thread_id in range(5):
+        ...     longrequest.THREADPOOL.worker_tracker[thread_id] = (
+        ...         now - 5, makeRequest().environ)
+
+    All requests get notified, only some reported, a line tells the
+    number of the others:
+
+        >>> rct.doWork()
+        >>> len(events)
+        5
+        >>> for record in logger.records:
+        ...     print(record.levelname, record.getMessage().splitlines()[0])
+        DEBUG checking request threads
+        INFO Long running request detected
+        INFO Long running request detected
+        WARNING 3 more requests over level 1 suppressed
+
+        >>> logger.uninstall()
+        >>> longrequest.THREADPOOL = None
+        >>> longrequest.NOW = time.time
+
+    """
+
+
+def doctest_IncidentTracker():
+    """Test for IncidentTracker
+
+        >>> def makeStack(*names):
+        ...     code = compile('pass', 'app.py', 'exec')
+        ...     codes = [code.replace(co_name=name) for name in names]
+        ...     return stacks.Stack([(code, 1) for code in codes])
+        >>> db = makeStack('query', 'fetch', 'render', 'publish')
+        >>> lock = makeStack('acquire', 'cache', 'render', 'publish')
+        >>> incidents.similarity(incidents.getFingerprint(db),
+        ...                      incidents.getFingerprint(lock))
+        0.333...
+
+        >>> tracker = incidents.IncidentTracker(threshold=0.5, closeAfter=10)
+        >>> opened, updated, closed = tracker.update(
+        ...     {1, 2}, [(1, '/import', db), (2, '/import', db)], 1700000000)
+        >>> opened, updated, closed
+        ([<Incident 20231114-221320-..., 2 requests, 2 active>], [], [])
+        >>> incident = opened[0]
+
+    Requests of the same URL template need less similar stacks:
+
+        >>> tracker.update({1, 2, 3}, [(3, '/import', lock)], 1700000001)
+        ([], [<Incident ..., 3 requests, 3 active>], [])
+        >>> tracker.update({1, 2, 3, 4}, [(4, '/report', lock)], 1700000002)
+        ([<Incident ..., 1 requests, 1 active>], [], [])
+        >>> incident.getTemplates()
+        [('/import', 3)]
+
+    Incidents close a while after their last request finished:
+
+        >>> tracker.update({4}, [], 1700000003)
+        ([], [], [])
+        >>> incident.active, incident.end
+        (set(), 1700000002)
+        >>> tracker.update({4}, [], 1700000012)
+        ([], [], [<Incident ..., 3 requests, 0 active>])
+        >>> tracker.open
+        [<Incident ..., 1 requests, 1 active>]
+
+    The number of open incidents is bounded:
+
+        >>> tracker.maxOpen = 1
+        >>> tracker.update({4, 5}, [(5, '/login', db)], 1700000013)
+        ([], [], [])
+        >>> tracker.dropped, tracker.isKnown(5)
+        (1, True)
+
+        >>> tracker.clear()
+        >>> tracker.open, tracker.assigned
+        ([], {})
+
+    """
+
+
+def doctest_RequestCheckerThread_incidents():
+    """Test for the checker thread grouping long requests into incidents
+
+        >>> longrequest.INCIDENTS = incidents.IncidentTracker(closeAfter=5)
+        >>> for handler in (longrequest.addLogEntryIncidentOpened,
+        ...                 longrequest.addLogEntryIncidentUpdated,
+        ...                 longrequest.addLogEntryIncidentClosed):
+        ...     zope.component.provideHandler(handler)
+        >>> logger = loggingsupport.InstalledHandler('cipher.longrequest')
+
+        >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+        >>> longrequest.THREADPOOL = DummyThreadPool()
+        >>> now = 1700000000
+        >>> longrequest.NOW = lambda: now
+        >>> tracker = longrequest.THREADPOOL.worker_tracker
+        >>> tracker[142] = (now - 5, makeRequest({'PATH_INFO': '/a'}).environ)
+        >>> tracker[143] = (now - 1, makeRequest({'PATH_INFO': '/a'}).environ)
+
+        >>> rct.doWork()
+        >>> print(logger)
+        cipher.longrequest DEBUG
+          checking request threads
+        cipher.longrequest WARNING
+          Incident 20231114-221320-... opened, 1 requests
+        URL templates:
+          1 requests /a
+        Stack:
+          File ".../longrequest.py", line ..., in checkIncidents
+        ...
+        >>> logger.clear()
+
+        >>> now += 5
+        >>> rct.doWork()
+        >>> print(logger)
+        cipher.longrequest DEBUG
+          checking request threads
+        cipher.longrequest INFO
+          Incident ... now has 2 requests, 2 running
+        >>> logger.clear()
+
+        >>> tracker.clear()
+        >>> now += 1
+        >>> rct.doWork()
+        >>> now += 5
+        >>> rct.doWork()
+        >>> print(logger)
+        cipher.longrequest DEBUG
+          checking request threads
+        cipher.longrequest DEBUG
+          checking request threads
+        cipher.longrequest INFO
+          Incident ... closed, 2 requests in 5 sec
+          2 requests /a
+
+        >>> logger.uninstall()
+        >>> longrequest.THREADPOOL = None
+        >>> longrequest.NOW = time.time
+
+    """
+
+
+def doctest_ThreadpoolCatcher_records_durations():
+    """Test for ThreadpoolCatcher feeding the threshold learner
+
+        >>> longrequest.THRESHOLDS = thresholds.ThresholdLearner(
+        ...     minSamples=1)
+        >>> saveNOW = longrequest.NOW
+        >>> longrequest.NOW = lambda: 100
+
+        >>> tc = longrequest.ThreadpoolCatcher(DummyStreamingApplication())
+        >>> req = makeRequest({'PATH_INFO': '/dashboard',
+        ...                    'QUERY_STRING': 'a=1'})
+        >>> app_iter = tc(req.environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain')]
+
+        >>> longrequest.NOW = lambda: 102.5
+        >>> app_iter.close()
+
+        >>> longrequest.THRESHOLDS.getQuantile('/dashboard')
+        2.5
+
+        >>> longrequest.NOW = saveNOW
+
+    """
+
+
+def doctest_URLNormalizer():
+    """Test for URLNormalizer
+
+    IDs in path segments get replaced, the query string is dropped:
+
+        >>> normalizer = urls.URLNormalizer()
+        >>> normalizer.normalize('http://localhost/users/123/report?q=1')
+        '/users/{id}/report'
+        >>> normalizer.normalize(
+        ...     'http://localhost/doc/0b7c5e0e-3f0c-4c4e-9f6e-2a1b7c1d9e4f')
+        '/doc/{uuid}'
+        >>> normalizer.normalize('http://localhost/blob/5d41402abc4b2a76b9719')
+        '/blob/{hex}'
+        >>> normalizer.normalize('http://localhost/blob/5d41402a;edit')
+        '/blob/{hex};edit'
+
+    Words and partial matches stay:
+
+        >>> normalizer.normalize('http://localhost/deadbeef/v2/page2')
+        '/deadbeef/v2/page2'
+
+    The scheme and host, which clients can vary, are left out:
+
+        >>> normalizer.normalize('https://evil.example/users/123/report')
+        '/users/{id}/report'
+        >>> normalizer.normalize('http://localhost')
+        '/'
+
+    Declared patterns win:
+
+        >>> normalizer = urls.URLNormalizer([
+        ...     ('.*/static/', '/static/*'),
+        ...     ('.*/users/[^/]+$', '/users/{name}')])
+        >>> normalizer.normalize('http://localhost/static/img/logo.png')
+        '/static/*'
+        >>> normalizer.normalize('http://localhost/users/john?tab=1')
+        '/users/{name}'
+        >>> normalizer.normalize('http://localhost/users/john/42')
+        '/users/john/{id}'
+
+    Each pattern is a regex of its own, inline flags and backreferences
+    work:
+
+        >>> normalizer = urls.URLNormalizer([
+        ...     ('(?i).*/Users/', '/users/*'),
+        ...     (r'.*/(\\w+)/\\1$', '/{twice}')])
+        >>> normalizer.normalize('http://localhost/users/john')
+        '/users/*'
+        >>> normalizer.normalize('http://localhost/a/b/b')
+        '/{twice}'
+        >>> normalizer.normalize('http://localhost/a/b/c')
+        '/a/b/c'
+
+    Results are cached in a bounded LRU:
+
+        >>> normalizer = urls.URLNormalizer(maxSize=2)
+        >>> for i in range(3):
+        ...     _ = normalizer.normalize('http://localhost/%s/1' % i)
+        >>> list(normalizer.cache)
+        ['http://localhost/1/1', 'http://localhost/2/1']
+        >>> normalizer.normalize('http://localhost/1/1')
+        '/{id}/{id}'
+        >>> list(normalizer.cache)
+        ['http://localhost/2/1', 'http://localhost/1/1']
+
+    """
+
+
+def doctest_RequestCheckerThread_templates():
+    """Test for RequestCheckerThread, events carry the URL template
+
+    >>> events = collectEvents(interfaces.ILongRequestEvent,
+    ...                        interfaces.ILongRequestFinishedEvent)
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+
+    >>> longrequest.THREADPOOL = DummyThreadPool()
+    >>> now = time.time()
+    >>> req = makeRequest({'PATH_INFO': '/users/123/report',
+    ...                    'QUERY_STRING': 'year=2020'})
+    >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 15, req.environ)
+
+    >>> rct.doWork()
+    >>> event = events.pop()
+    >>> event.uri
+    'http://localhost/users/123/report?year=2020'
+    >>> event.template
+    '/users/{id}/report'
+
+    >>> del longrequest.THREADPOOL.worker_tracker[142]
+    >>> rct.doWork()
+    >>> event = events.pop()
+    >>> interfaces.ILongRequestFinishedEvent.providedBy(event)
+    True
+    >>> event.template
+    '/users/{id}/report'
+
+    >>> longrequest.THREADPOOL = None
+
+    """
+
+
+def doctest_benchmark_runScenario():
+    """Test for benchmark.runScenario
+
+        >>> result = benchmark.runScenario(10, 2, True, ticks=1)
+        >>> sorted(result)
+        ['alloc_peak', 'cpu_cold', 'cpu_warm', 'patterns', 'probe_latency',
+         'threads', 'verbose']
+        >>> result['alloc_peak'] > 0
+        True
+
+    The global state is left alone:
+
+        >>> print(longrequest.THREADPOOL)
+        None
+        >>> longrequest.CONFIG.ignoreURLs
+        ()
+        >>> longrequest.CONFIG.verbose
+        False
+        >>> longrequest.VERBOSE_MAX_THREADS
+        20
+        >>> sm = zope.component.getGlobalSiteManager()
+        >>> list(sm.registeredHandlers())
+        []
+
+    Verbose runs report all threads in full, however many there are:
+
+        >>> with benchmark.scenario(100, 0, True):
+        ...     snapshot = longrequest.takeSnapshot(longrequest.THREADPOOL)
+        ...     longrequest.isVerbose(longrequest.MONITOR, snapshot)
+        True
+
+    """
+
+
+def doctest_benchmark_compareResults():
+    """Test for benchmark.compareResults
+
+        >>> result = dict(threads=10, patterns=0, verbose=False,
+        ...               cpu_cold=0.002, cpu_warm=0.001, alloc_peak=1000,
+        ...               probe_latency=0.0001)
+        >>> benchmark.getKey(result)
+        'threads=10 patterns=0 verbose=False'
+
+        >>> baseline = {benchmark.getKey(result): dict(
+        ...     result, cpu_cold=0.001, alloc_peak=900, probe_latency=0)}
+        >>> for regression in benchmark.compareResults([result], baseline):
+        ...     print(regression)
+        threads=10 patterns=0 verbose=False cpu_cold: 0.001 -> 0.002 (+100%)
+
+        >>> benchmark.compareResults([result], {})
+        []
+
+        >>> print(benchmark.formatResult(result))
+        threads=10 patterns=0 verbose=False  cold  2.00 ms  warm  1.00 ms
+          alloc  1000 B  probe  0.10 ms
+
+    """
+
+
+def doctest_loadtest_SyntheticApplication():
+    """Test for loadtest.SyntheticApplication
+
+        >>> app = loadtest.SyntheticApplication(slowTime=0.01, cpuTime=0.01)
+        >>> app(makeRequest().environ, start_response)
+        200 OK
+        [('Content-Type', 'text/plain'), ('Content-Length', '4')]
+        [b'fast']
+
+        >>> started = time.perf_counter()
+        >>> app(makeRequest({'QUERY_STRING': 'mode=slow'}).environ,
+        ...     lambda status, headers: None)
+        [b'slow']
+        >>> app(makeRequest({'QUERY_STRING': 'mode=cpu'}).environ,
+        ...     lambda status, headers: None)
+        [b'cpu']
+        >>> time.perf_counter() - started >= 0.02
+        True
+
+    """
+
+
+def doctest_loadtest_helpers():
+    """Test for the load test helpers
+
+        >>> values = list(range(1, 101))
+        >>> [loadtest.percentile(values, p) for p in (50, 90, 99, 100)]
+        [50, 90, 99, 100]
+        >>> print(loadtest.percentile([], 50))
+        None
+
+        >>> loadtest.makePaths(3, dict(fast=1))
+        ['/load?mode=fast&i=0', '/load?mode=fast&i=1', '/load?mode=fast&i=2']
+
+        >>> sorted(loadtest.parseMix('fast=0.9, slow=0.1').items())
+        [('fast', 0.9), ('slow', 0.1)]
+
+        >>> print(loadtest.formatResult(dict(
+        ...     scenario='idle', requests=10, errors=0, throughput=100.0,
+        ...     p50=0.001, p90=0.002, p99=0.01)))
+        idle  100.0 req/s  p50  1.00 ms  p90  2.00 ms  p99  10.00 ms
+          errors 0
+
+    """
+
+
+def doctest_loadtest_runScenario():
+    """Test for loadtest.runScenario, on localhost
+
+        >>> for scenario in ('absent', 'idle'):
+        ...     result = loadtest.runScenario(
+        ...         scenario, requests=20, concurrency=2, workers=5,
+        ...         mix=dict(fast=1))
+        ...     print(result['scenario'], result['errors'],
+        ...           result['throughput'] > 0, result['p99'] > 0)
+        absent 0 True True
+        idle 0 True True
+
+    The watchdog is cleaned up:
+
+        >>> print(longrequest.THREAD, longrequest.THREADPOOL)
+        None None
+        >>> longrequest.CONFIG.durationLevels
+        (2, 10, 30)
+
+    Firing, the slow requests get reported, straight over the third level
+    as durations count whole seconds:
+
+        >>> events = collectEvents(interfaces.ILongRequestEvent)
+        >>> result = loadtest.runScenario(
+        ...     'firing', requests=2, concurrency=2, workers=5,
+        ...     mix=dict(slow=1), slowTime=1.3, tick=0.05)
+        >>> result['errors']
+        0
+        >>> sorted(set(type(event).__name__ for event in events))
+        ['LongRequestEventOver3']
+        >>> len(set(event.thread_id for event in events))
+        2
+        >>> longrequest.CONFIG.durationLevels
+        (2, 10, 30)
+
+    """
+
+
+def doctest_make_filter():
+    """Test for make_filter
+
+    >>> import os.path
+    >>> here = os.path.dirname(__file__)
+    >>> cfg = os.path.join(here, 'testing', 'paster.ini')
+
+    >>> global_conf = {'__file__': cfg, 'here': here}
+
+    >>> longrequest.make_filter(None, global_conf)
+    <ThreadpoolCatcher>
+
+    >>> settings = longrequest.CONFIG
+    >>> settings.durationLevels
+    (3, 7, 42)
+
+    >>> print(longrequest.INITIAL_DELAY)
+    11
+    >>> print(settings.tick)
+    5
+
+    >>> [p.pattern for p in settings.ignoreURLs]
+    ['.*/rest/.*', '.*/admin/.*']
+
+    >>> longrequest.BULKHEADS
+    [<Bulkhead .*/reports/.* 0/2>]
+    >>> print(longrequest.BULKHEAD_WAIT)
+    0.5
+
+    >>> [(p.pattern, levels) for p, levels in settings.urlThresholds]
+    [('.*/export/.*', (30, 60, 120))]
+
+    >>> [(p.pattern, template)
+    ...  for p, template in longrequest.NORMALIZER.patterns]
+    [('.*/static/.*', '/static/*')]
+    >>> longrequest.NORMALIZER.maxSize
+    500
+
+    >>> longrequest.CAPTURE_DIR, longrequest.CAPTURE_LEVEL
+    ('/tmp/captures', 3)
+    >>> longrequest.CAPTURE_MEMORY, longrequest.CAPTURE_MAX_BODY
+    (1024, 4096)
+    >>> longrequest.CAPTURE_REDACT
+    ('HTTP_COOKIE', 'HTTP_AUTHORIZATION', 'HTTP_X_API_KEY')
+
+    >>> learner = longrequest.THRESHOLDS
+    >>> learner.quantile, learner.factors, learner.minSamples, learner.maxKeys
+    (0.95, (2.0, 5.0, 10.0), 50, 1000)
+
+    >>> renderer = longrequest.RENDERER
+    >>> renderer.maxSize, renderer.maxDepth, renderer.maxItems
+    (2000, 3, 20)
+    >>> renderer.render({'Password': 'x', 'cookie': 'y'})
+    "{'Password': <redacted>, 'cookie': 'y'}"
+
+    >>> longrequest.STACK_CAPTURE, longrequest.STACK_DEPTH
+    ('fast', 20)
+
+    >>> longrequest.DUMP_FILE, longrequest.DUMP_TIMEOUT
+    (None, 60.0)
+
+    >>> longrequest.STALL_TICKS, longrequest.RECOVER_TICKS
+    (10, 4)
+
+    >>> locks.isPatched(), locks.TABLE.maxSize
+    (True, 200)
+
+    >>> longrequest.CONFIG_FILE == cfg, longrequest.CONFIG_MTIME is not None
+    (True, True)
+    >>> longrequest.ADMIN_URL, longrequest.ADMIN_TOKEN
+    ('/++longrequest++', 's3cret')
+    >>> threading.RLock()
+    <TrackedRLock <doctest ...>:1 owner=None>
+
+    """
+
+
+def doctest_getAllThreadInfo():
+    r"""Test for getAllThreadInfo
+
+    >>> longrequest.THREADPOOL = DummyThreadPool()
+    >>> now = time.time()
+    >>> kw = {'wsgi.url_scheme': 'https', 'PATH_INFO': '/rest/update-it',
+    ...     'QUERY_STRING': 'bar=42', 'SERVER_PORT': '443'}
+    >>> req = makeRequest(kw)
+    >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 7, req.environ)
+    >>> longrequest.ZOPE_THREAD_REQUESTS[142] = DummyZopeRequest(
+    ...     username='foo.admin', form={'foobar': '42'})
+
+    >>> kw = {'wsgi.url_scheme': 'https', 'PATH_INFO': '/customer/dashboard',
+    ...     'SERVER_PORT': '443'}
+    >>> req = makeRequest(kw)
+    >>> longrequest.THREADPOOL.worker_tracker[143] = (now - 7, req.environ)
+
+    >>> info = longrequest.getAllThreadInfo()
+    >>> print('\n--\n'.join(info))
+    thread_id:142
+    duration:7 sec
+    URL:https://localhost/rest/update-it?bar=42
+    threads in use:2
+    environment:{'PATH_INFO': '/rest/update-it',
+     'QUERY_STRING': 'bar=42',
+     'REMOTE_ADDR': '1.1.1.1',
+     'SERVER_NAME': 'localhost',
+     'SERVER_PORT': '443',
+     'wsgi.url_scheme': 'https',
+     'wsgi.version': (1, 0)}
+    username:foo.admin
+    form:{'foobar': '42'}
+    Thread stack:
+      File "module.py", line 69, in main
+        do_stuff()
+      File "submodule.py", line 42, in helper
+        endless_loop()
+    Top of stack
+    --
+    thread_id:143
+    duration:7 sec
+    URL:https://localhost/customer/dashboard
+    threads in use:2
+    environment:{'PATH_INFO': '/customer/dashboard',
+     'REMOTE_ADDR': '1.1.1.1',
+     'SERVER_NAME': 'localhost',
+     'SERVER_PORT': '443',
+     'wsgi.url_scheme': 'https',
+     'wsgi.version': (1, 0)}
+    username:
+    form:
+    Thread stack:
+      File "module.py", line 69, in main
+        do_stuff()
+      File "submodule.py", line 42, in helper
+        endless_loop()
+    Top of stack
+
+    >>> info = longrequest.getAllThreadInfo(omitThreads=(143,))
+    >>> print('\n--\n'.join(info))
+    thread_id:142
+    duration:7 sec
+    URL:https://localhost/rest/update-it?bar=42
+    threads in use:2
+    environment:{'PATH_INFO': '/rest/update-it',
+     'QUERY_STRING': 'bar=42',
+     'REMOTE_ADDR': '1.1.1.1',
+     'SERVER_NAME': 'localhost',
+     'SERVER_PORT': '443',
+     'wsgi.url_scheme': 'https',
+     'wsgi.version': (1, 0)}
+    username:foo.admin
+    form:{'foobar': '42'}
+    Thread stack:
+      File "module.py", line 69, in main
+        do_stuff()
+      File "submodule.py", line 42, in helper
+        endless_loop()
+    Top of stack
+
+    >>> longrequest.THREADPOOL = None
+    """
+
+
+def doctest_getThreadTraceback():
+    """Test getThreadTraceback
+
+    Normally, getThreadTraceback returns the traceback for the frame:
+
+        >>> print(longrequest.getThreadTraceback(142))
+          File "module.py", line 69, in main
+            do_stuff()
+          File "submodule.py", line 42, in helper
+            endless_loop()
+
+    However, when the thread_id parameter does not match any existing
+    thread:
+
+        >>> sys._current_frames.return_value = ret = mock.MagicMock()
         >>> ret.__getitem__.side_effect = KeyError(142)
         >>> sys._current_frames()[142]
         Traceback (most recent call last):
@@ -1079,6 +3983,187 @@ def doctest_getThreadTraceback():
         >>> longrequest.getThreadTraceback(142)
         '  ???'
 
+    The depth of the stack can be limited:
+
+        >>> def outer():
+        ...     return inner()
+        >>> def inner():
+        ...     return sys._getframe()
+        >>> frame = outer()
+        >>> sys._current_frames.return_value = {142: frame}
+
+        >>> longrequest.STACK_DEPTH = 2
+        >>> traceback.print_stack = mock.Mock()
+        >>> longrequest.getThreadTraceback(142)
+        ''
+        >>> traceback.print_stack.call_args
+        call(<frame ...>, limit=2, file=<_io.StringIO ...>)
+
+    In the fast mode the stack is captured by walking the frames, and
+    formatted as the traceback module does:
+
+        >>> longrequest.STACK_CAPTURE = 'fast'
+        >>> print(longrequest.getThreadTraceback(142))
+          File "<doctest ...>", line 2, in outer
+            return inner()
+          File "<doctest ...>", line 2, in inner
+            return sys._getframe()
+        <BLANKLINE>
+
+    """
+
+
+def doctest_stacks():
+    """Test for the stacks module, cheap capture of stacks
+
+        >>> def outer():
+        ...     return inner()
+        >>> def inner():
+        ...     return sys._getframe()
+        >>> frame = outer()
+
+    Capturing keeps just code objects and line numbers, innermost first:
+
+        >>> stack = stacks.capture(frame)
+        >>> [code.co_name for code, lineno in stack.entries[:2]]
+        ['inner', 'outer']
+        >>> len(stack) > 2
+        True
+        >>> len(stacks.capture(frame, limit=1))
+        1
+
+    Formatting reads the source lines, same as the traceback module:
+
+        >>> text = stacks.capture(frame).format()
+        >>> text == ''.join(traceback.format_stack(frame))
+        True
+
+    The formatted entries are cached:
+
+        >>> code = sys._getframe().f_code
+        >>> with mock.patch('linecache.getline', return_value='foo()'):
+        ...     print(stacks.formatEntry(code, 1), end='')
+        ...     print(stacks.formatEntry(code, 1), end='')
+          File "<doctest ...>", line 1, in <module>
+            foo()
+          File "<doctest ...>", line 1, in <module>
+            foo()
+        >>> with mock.patch('linecache.getline') as getline:
+        ...     print(stacks.formatEntry(code, 1), end='')
+          File "<doctest ...>", line 1, in <module>
+            foo()
+        >>> getline.called
+        False
+
+    Equal code in different files doesn't get mixed up:
+
+        >>> a = compile('foo()', 'a.py', 'exec')
+        >>> b = compile('foo()', 'b.py', 'exec')
+        >>> a == b
+        True
+        >>> print(stacks.formatEntry(a, 1) + stacks.formatEntry(b, 1), end='')
+          File "a.py", line 1, in <module>
+          File "b.py", line 1, in <module>
+    """
+
+
+def doctest_dumpAllThreads():
+    """Test for dumpAllThreads, dumping stacks with faulthandler
+
+    >>> import tempfile
+    >>> event = interfaces.LongRequestEventOver3(
+    ...     142, 35, 'http://localhost/slow', {}, None)
+
+    Nothing happens unless there is a dump file:
+
+    >>> longrequest.dumpAllThreads(event)
+    >>> longrequest.armDumpTimer()
+
+    >>> dumpFile = longrequest.DUMP_FILE = tempfile.TemporaryFile('w+')
+    >>> longrequest.dumpAllThreads(event)
+    >>> _ = dumpFile.seek(0)
+    >>> print(dumpFile.read())
+    20...-... Long running request thread_id:142 duration:35 sec
+    URL:http://localhost/slow
+    ...Current thread 0x... (most recent call first):
+      File ".../longrequest.py", line ... in dumpAllThreads
+    ...
+
+    The stacks get dumped once per tick, however many requests cross the
+    level in it:
+
+    >>> longrequest.THREADPOOL = DummyThreadPool()
+    >>> snapshot = longrequest.takeSnapshot(longrequest.THREADPOOL)
+    >>> _ = dumpFile.seek(0)
+    >>> _ = dumpFile.truncate()
+    >>> for thread_id in (142, 143):
+    ...     longrequest.dumpAllThreads(interfaces.LongRequestEventOver3(
+    ...         thread_id, 35, 'http://localhost/slow', {}, None,
+    ...         snapshot=snapshot))
+    >>> _ = dumpFile.seek(0)
+    >>> dump = dumpFile.read()
+    >>> print(dump)
+    20...-... Long running request thread_id:142 duration:35 sec
+    URL:http://localhost/slow
+    ...Current thread 0x... (most recent call first):
+    ...
+    20...-... Long running request thread_id:143 duration:35 sec
+    URL:http://localhost/slow (stacks dumped above)
+    >>> dump.count('Current thread')
+    1
+
+    >>> snapshot = longrequest.takeSnapshot(longrequest.THREADPOOL)
+    >>> longrequest.dumpAllThreads(interfaces.LongRequestEventOver3(
+    ...     143, 36, 'http://localhost/slow', {}, None, snapshot=snapshot))
+    >>> _ = dumpFile.seek(0)
+    >>> dumpFile.read().count('Current thread')
+    2
+    >>> longrequest.THREADPOOL = None
+
+    The timer has to outlast a tick, it would fire at every tick
+    otherwise:
+
+    >>> longrequest.DUMP_TIMEOUT = 1
+    >>> longrequest.checkDumpTimeout(1)
+    Traceback (most recent call last):
+      ...
+    ValueError: dump-timeout 1 is not longer than the tick 1
+    >>> longrequest.checkDumpTimeout(0.5)
+
+    Every tick of the checker thread pushes the timer back, when it stops
+    ticking faulthandler dumps on its own:
+
+    >>> longrequest.DUMP_TIMEOUT = 0.2
+    >>> rct = longrequest.RequestCheckerThread(None, None, None, None)
+    >>> _ = dumpFile.seek(0)
+    >>> _ = dumpFile.truncate()
+    >>> for i in range(5):
+    ...     rct.doWork()
+    ...     time.sleep(0.05)
+    >>> _ = dumpFile.seek(0)
+    >>> dumpFile.read()
+    ''
+
+    >>> time.sleep(0.5)
+    >>> _ = dumpFile.seek(0)
+    >>> print(dumpFile.read())
+    Timeout (0:00:00.200000)!
+    Thread 0x...
+
+    The stacks can be dumped on a signal too:
+
+    >>> import os
+    >>> import signal
+    >>> _ = dumpFile.seek(0)
+    >>> _ = dumpFile.truncate()
+    >>> longrequest.registerDumpSignal('usr1')
+    >>> os.kill(os.getpid(), signal.SIGUSR1)
+    >>> _ = dumpFile.seek(0)
+    >>> print(dumpFile.read())
+    Current thread 0x... (most recent call first):
+    ...
+    >>> faulthandler.unregister(signal.SIGUSR1)
+    True
     """
 
 
@@ -1100,12 +4185,107 @@ def doctest_getURI():
     """
 
 
+def doctest_getRequestURI():
+    """Test for getRequestURI
+
+    The URL gets computed once per request:
+
+    >>> req = makeRequest({'PATH_INFO': '/foo'})
+    >>> longrequest.getRequestURI(142, 100, req.environ)
+    ('http://localhost/foo', '1.1.1.1')
+
+    >>> req.environ['PATH_INFO'] = '/bar'
+    >>> longrequest.getRequestURI(142, 100, req.environ)
+    ('http://localhost/foo', '1.1.1.1')
+
+    A new request on the same thread has a different start time:
+
+    >>> longrequest.getRequestURI(142, 101, req.environ)
+    ('http://localhost/bar', '1.1.1.1')
+
+    >>> longrequest.getRequestURI(143, 100, None)
+    ('n/a', None)
+
+    """
+
+
+def doctest_reconstructURL():
+    """Test for reconstructURL
+
+    Without proxies, the URL comes from the environment:
+
+    >>> environ = makeRequest({'SCRIPT_NAME': '/app', 'PATH_INFO': '/foo',
+    ...                        'QUERY_STRING': 'a=1'}).environ
+    >>> urls.reconstructURL(environ)
+    'http://localhost/app/foo?a=1'
+
+    X-Forwarded-Proto, X-Forwarded-Host and X-Forwarded-Prefix, the first,
+    client side value counts:
+
+    >>> environ['HTTP_X_FORWARDED_PROTO'] = 'HTTPS, http'
+    >>> environ['HTTP_X_FORWARDED_HOST'] = 'example.com:8443, lb.internal'
+    >>> environ['HTTP_X_FORWARDED_PREFIX'] = '/site/'
+    >>> urls.reconstructURL(environ)
+    'https://example.com:8443/site/app/foo?a=1'
+
+    RFC 7239 Forwarded wins over X-Forwarded-*:
+
+    >>> environ['HTTP_FORWARDED'] = (
+    ...     'for=192.0.2.60;proto=http;host="example.org", for=10.0.0.1')
+    >>> urls.reconstructURL(environ)
+    'http://example.org/site/app/foo?a=1'
+
+    X-Original-URL wins over everything, it can be a path:
+
+    >>> environ['HTTP_X_ORIGINAL_URL'] = '/original/path?b=2'
+    >>> urls.reconstructURL(environ)
+    'http://example.org/original/path?b=2'
+
+    or a full URL:
+
+    >>> environ['HTTP_X_ORIGINAL_URL'] = 'https://example.net/x'
+    >>> urls.reconstructURL(environ)
+    'https://example.net/x'
+
+    The environment is not changed:
+
+    >>> environ['wsgi.url_scheme'], environ.get('HTTP_HOST')
+    ('http', None)
+
+    """
+
+
+def doctest_getClientIP():
+    """Test for getClientIP
+
+    >>> environ = makeRequest().environ
+    >>> urls.getClientIP(environ)
+    '1.1.1.1'
+
+    >>> environ['HTTP_X_FORWARDED_FOR'] = '10.0.0.1, 192.168.0.1'
+    >>> urls.getClientIP(environ)
+    '10.0.0.1'
+
+    >>> environ['HTTP_FORWARDED'] = 'for="192.0.2.60:4711";proto=http'
+    >>> urls.getClientIP(environ)
+    '192.0.2.60'
+
+    >>> environ['HTTP_FORWARDED'] = 'For="[2001:db8:cafe::17]:4711"'
+    >>> urls.getClientIP(environ)
+    '2001:db8:cafe::17'
+
+    >>> environ['HTTP_FORWARDED'] = 'for=unknown'
+    >>> urls.getClientIP(environ)
+    'unknown'
+
+    """
+
+
 def doctest_addLogEntry():
     r"""Test for addLogEntry
 
     >>> import logging
-    >>> saveVERBOSE = longrequest.VERBOSE_LOG
-    >>> longrequest.VERBOSE_LOG = True
+    >>> longrequest.CONFIG = longrequest.CONFIG.replace(verbose=True)
 
     >>> longrequest.THREADPOOL = DummyThreadPool()
     >>> now = time.time()
@@ -1113,6 +4293,8 @@ def doctest_addLogEntry():
     ...     'QUERY_STRING': 'bar=42', 'SERVER_PORT': '443'}
     >>> req = makeRequest(kw)
     >>> longrequest.THREADPOOL.worker_tracker[142] = (now - 7, req.environ)
+    >>> longrequest.ZOPE_THREAD_REQUESTS[142] = DummyZopeRequest(
+    ...     username='foo.admin', form={'foobar': '42'})
 
     >>> kw = {'wsgi.url_scheme': 'https', 'PATH_INFO': '/customer/dashboard',
     ...     'SERVER_PORT': '443'}
@@ -1164,10 +4346,43 @@ def doctest_addLogEntry():
       File "submodule.py", line 42, in helper
         endless_loop()
     Top of stack
+    >>> logger.clear()
+
+    With too many busy threads, the other threads get summarized only:
+
+    >>> longrequest.VERBOSE_MAX_THREADS = 1
+    >>> snapshot = longrequest.takeSnapshot(longrequest.THREADPOOL)
+    >>> devent = interfaces.LongRequestEvent(143, 7, 'yadayada', kw, None,
+    ...                                      snapshot=snapshot)
+    >>> longrequest.addLogEntry(devent, logging.INFO)
+    >>> print(logger)
+    cipher.longrequest INFO
+      Long running request detected
+    thread_id:143
+    ...
+    Top of stack
+    Co-running requests:
+      thread_id:142 duration:7 sec /rest/update-it at ...
+    >>> logger.clear()
+
+    With corunning-summary on they always are:
+
+    >>> longrequest.VERBOSE_MAX_THREADS = None
+    >>> longrequest.CORUNNING_SUMMARY = True
+    >>> longrequest.addLogEntry(devent, logging.INFO)
+    >>> print(logger)
+    cipher.longrequest INFO
+      Long running request detected
+    thread_id:143
+    ...
+    Top of stack
+    Co-running requests:
+      thread_id:142 duration:7 sec /rest/update-it at ...
+    >>> 'Other threads' in str(logger)
+    False
 
     >>> logger.uninstall()
 
-    >>> longrequest.VERBOSE_LOG = saveVERBOSE
     >>> longrequest.THREADPOOL = None
     """
 
@@ -1175,11 +4390,17 @@ def doctest_addLogEntry():
 def setUp(test=None):
     PlacelessSetup().setUp()
 
-    longrequest.DURATION_LEVEL_1 = 2
-    longrequest.DURATION_LEVEL_2 = 10
-    longrequest.DURATION_LEVEL_3 = 30
+    longrequest.CONFIG = longrequest.Config()
 
-    longrequest.IGNORE_URLS = []
+    longrequest.BULKHEADS = []
+    longrequest.THRESHOLDS = None
+    longrequest.CORUNNING = corunning.CoRunning()
+    longrequest.NORMALIZER = urls.URLNormalizer()
+    longrequest.RENDERER = render.Renderer()
+    longrequest.STACK_CAPTURE = 'traceback'
+    longrequest.STACK_DEPTH = None
+    longrequest.THREAD_STATES.clear()
+    longrequest.ZOPE_THREAD_REQUESTS.clear()
 
     test.patcher = mock.patch("sys._current_frames")
     test.patcher2 = mock.patch("traceback.print_stack")
@@ -1200,16 +4421,61 @@ def tearDown(test=None):
 
     PlacelessSetup().tearDown()
 
-    longrequest.DURATION_LEVEL_1 = 2
-    longrequest.DURATION_LEVEL_2 = 10
-    longrequest.DURATION_LEVEL_3 = 30
+    longrequest.CONFIG = longrequest.Config()
+    longrequest.MONITORS = (longrequest.MONITOR,)
+    longrequest.MONITOR.maxRequestTime = 0
+    longrequest.CONFIG_FILE = None
+    longrequest.CONFIG_MTIME = None
+    longrequest.RELOAD_PENDING = False
+    longrequest.ADMIN_URL = None
+    longrequest.ADMIN_TOKEN = None
 
     longrequest.INITIAL_DELAY = 1
-    longrequest.TICK = 1
 
-    longrequest.IGNORE_URLS = []
+    longrequest.BULKHEADS = []
+    longrequest.BULKHEAD_WAIT = 0
+    longrequest.THRESHOLDS = None
+    longrequest.CORUNNING = corunning.CoRunning()
+    longrequest.CORUNNING_SUMMARY = False
+    longrequest.QUEUE_TIMES = None
+    longrequest.QUEUE_HEADERS = queuetime.HEADERS
+    longrequest.QUEUE_SATURATION = None
+    longrequest.REQUEST_IDS = False
+    longrequest.SPAN_EXPORTER = None
+    longrequest.THROTTLE = None
+    longrequest.INCIDENTS = None
+    longrequest.VERBOSE_MAX_THREADS = 20
+    longrequest.RUNNING_SPANS.clear()
+    longrequest.REQUEST_ID_RESPONSE_HEADER = None
+    longrequest.PRINCIPALS = None
+    longrequest.TENANTS = None
+    longrequest.TENANT_KEY = None
+    longrequest.NORMALIZER = urls.URLNormalizer()
+    longrequest.RENDERER = render.Renderer()
+    longrequest.STACK_CAPTURE = 'traceback'
+    longrequest.STACK_DEPTH = None
+    longrequest.THREAD_STATES.clear()
+    longrequest.CAPTURE_DIR = None
+    longrequest.CAPTURE_LEVEL = 2
+    longrequest.CAPTURE_MEMORY = 64 * 1024
+    longrequest.CAPTURE_MAX_BODY = 10 * 1024 * 1024
+    longrequest.CAPTURE_REDACT = capture.REDACTED_HEADERS
+    longrequest.CAPTURES.clear()
+    longrequest.ZOPE_THREAD_REQUESTS.clear()
+    if longrequest.DUMP_FILE is not None:
+        faulthandler.cancel_dump_traceback_later()
+        longrequest.DUMP_FILE.close()
+    longrequest.DUMP_FILE = None
+    longrequest.DUMP_TIMEOUT = None
+    longrequest.DUMPED_GENERATION = None
+    longrequest.STALL_TICKS = 5
+    longrequest.RECOVER_TICKS = 3
+    locks.unpatch()
+    locks.TABLE.clear()
+    locks.TABLE.maxSize = locks.MAX_LOCKS
 
 
 def test_suite():
     return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown,
-                                optionflags=doctest.NORMALIZE_WHITESPACE)
+                                optionflags=(doctest.NORMALIZE_WHITESPACE
+                                             | doctest.ELLIPSIS))
@@ -0,0 +1,145 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Duration thresholds learned from the history of finished requests
+"""
+import collections
+import threading
+
+
+class P2Quantile:
+    """Streaming quantile estimate, using the P-square algorithm
+
+    R. Jain and I. Chlamtac, "The P2 algorithm for dynamic calculation of
+    quantiles and histograms without storing observations", 1985.
+
+    Uses five markers, so memory and time per observation are constant.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        q = self.heights
+        self.count += 1
+        if self.count <= 5:
+            q.append(x)
+            if self.count == 5:
+                q.sort()
+            return
+
+        n = self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if ((d >= 1 and n[i + 1] - n[i] > 1)
+                    or (d <= -1 and n[i - 1] - n[i] < -1)):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = self._linear(i, d)
+                q[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q = self.heights
+        n = self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def _linear(self, i, d):
+        q = self.heights
+        n = self.positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+    def value(self):
+        """Return the current estimate, None without observations"""
+        if not self.count:
+            return None
+        if self.count < 5:
+            ordered = sorted(self.heights)
+            return ordered[int(round(self.p * (self.count - 1)))]
+        return self.heights[2]
+
+
+class ThresholdLearner:
+    """Learn per-URL duration levels from finished request durations
+
+    The levels of an URL are `factors` times its `quantile` duration,
+    once at least `minSamples` requests were recorded.  At most `maxKeys`
+    URLs are tracked, so memory stays bounded, the one recorded least
+    recently makes room for a new one.
+    """
+
+    def __init__(self, quantile=0.99, factors=(3, 10, 30), minSamples=100,
+                 maxKeys=1000):
+        self.quantile = quantile
+        self.factors = factors
+        self.minSamples = minSamples
+        self.maxKeys = maxKeys
+        self.estimators = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, key, duration):
+        with self.lock:
+            estimator = self.estimators.get(key)
+            if estimator is None:
+                if len(self.estimators) >= self.maxKeys:
+                    self.estimators.popitem(last=False)
+                estimator = self.estimators[key] = P2Quantile(self.quantile)
+            else:
+                self.estimators.move_to_end(key)
+            estimator.add(duration)
+
+    def getQuantile(self, key):
+        """Return the learned quantile of `key`, None if not enough data"""
+        with self.lock:
+            estimator = self.estimators.get(key)
+            if estimator is None or estimator.count < self.minSamples:
+                return None
+            return estimator.value()
+
+    def getLevels(self, key):
+        """Return the learned (level 1, level 2, level 3) of `key`
+
+        Returns None if there is not enough data yet.
+        """
+        quantile = self.getQuantile(key)
+        if quantile is None:
+            return None
+        return tuple(factor * quantile for factor in self.factors)
+
+    def clear(self):
+        with self.lock:
+            self.estimators.clear()
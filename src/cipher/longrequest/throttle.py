@@ -0,0 +1,111 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Rate limits of the long request reports, for when everything is slow
+"""
+import collections
+import threading
+
+
+# at most this many URL templates get a rate limit of their own
+MAX_URLS = 1000
+
+
+class TokenBucket:
+    """Allow `burst` at once, then `rate` per second"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens >= 1
+
+    def __repr__(self):
+        return '<TokenBucket %.1f/%s>' % (self.tokens, self.burst)
+
+
+class ReportThrottle:
+    """Token buckets limiting the reports per level and per URL template
+
+    A report is allowed when both the bucket of its level and the bucket
+    of its level and URL template have a token, None rates mean no limit.
+    At most `maxURLs` URL buckets are kept, the least recently used ones
+    go, they would be full again anyway.  The reports not allowed get
+    counted per level, until taken by `takeSuppressed`.
+    """
+
+    def __init__(self, levelRate=None, levelBurst=10, urlRate=None,
+                 urlBurst=3, maxURLs=MAX_URLS):
+        self.levelRate = levelRate
+        self.levelBurst = levelBurst
+        self.urlRate = urlRate
+        self.urlBurst = urlBurst
+        self.maxURLs = maxURLs
+        self.levels = {}
+        self.urls = collections.OrderedDict()
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def allow(self, level, template, now):
+        """Whether a report over `level` of a request of `template` may go"""
+        with self.lock:
+            buckets = []
+            if self.levelRate is not None:
+                bucket = self.levels.get(level)
+                if bucket is None:
+                    bucket = self.levels[level] = TokenBucket(
+                        self.levelRate, self.levelBurst, now)
+                buckets.append(bucket)
+            if self.urlRate is not None:
+                key = (level, template)
+                bucket = self.urls.get(key)
+                if bucket is None:
+                    if len(self.urls) >= self.maxURLs:
+                        self.urls.popitem(last=False)
+                    bucket = self.urls[key] = TokenBucket(
+                        self.urlRate, self.urlBurst, now)
+                else:
+                    self.urls.move_to_end(key)
+                buckets.append(bucket)
+            # refill all, take from all or none
+            if not all([bucket.refill(now) for bucket in buckets]):
+                self.suppressed[level] = self.suppressed.get(level, 0) + 1
+                return False
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return True
+
+    def takeSuppressed(self):
+        """Return [(level, count), ...] of the reports not allowed
+
+        Since the last call.
+        """
+        with self.lock:
+            rv = sorted(self.suppressed.items())
+            self.suppressed.clear()
+        return rv
+
+    def clear(self):
+        with self.lock:
+            self.levels.clear()
+            self.urls.clear()
+            self.suppressed.clear()
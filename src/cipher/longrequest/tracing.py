@@ -0,0 +1,66 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Request ids, to find long requests in access logs and traces
+"""
+import re
+import uuid
+
+
+# WSGI environ keys of the headers
+REQUEST_ID_HEADER = 'HTTP_X_REQUEST_ID'
+TRACEPARENT_HEADER = 'HTTP_TRACEPARENT'
+
+# request ids taken from clients, anything else gets replaced
+REQUEST_ID_RE = re.compile(r'^[\w.:/+=@-]{1,200}$', re.ASCII)
+
+# W3C Trace Context: version-trace id-parent span id-flags
+TRACEPARENT_RE = re.compile(
+    r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})')
+
+
+def parseTraceparent(value):
+    """Return (trace id, parent span id) of a traceparent header
+
+    None if it is not valid.
+    """
+    match = TRACEPARENT_RE.match(value.strip())
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == 'ff' or not int(trace_id, 16) or not int(parent_id, 16):
+        return None
+    return trace_id, parent_id
+
+
+def newRequestId():
+    return uuid.uuid4().hex
+
+
+def getRequestId(environ):
+    """Return the id of a request
+
+    The X-Request-ID header if valid, the trace id of the traceparent
+    header if valid, a new one otherwise.
+    """
+    value = environ.get(REQUEST_ID_HEADER)
+    if value:
+        value = value.strip()
+        if REQUEST_ID_RE.match(value):
+            return value
+    value = environ.get(TRACEPARENT_HEADER)
+    if value:
+        context = parseTraceparent(value)
+        if context is not None:
+            return context[0]
+    return newRequestId()
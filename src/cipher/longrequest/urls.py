@@ -0,0 +1,162 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Request URLs: reconstruction behind proxies, mapping to route templates
+"""
+import collections
+import re
+import threading
+from urllib.parse import urlsplit
+
+from paste.request import construct_url
+
+
+# path segments that are most probably IDs
+SEGMENT_RE = re.compile(
+    r'(?<=/)(?:'
+    r'(?P<uuid>[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}'
+    r'-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})'
+    r'|(?P<id>[0-9]+)'
+    r'|(?P<hex>(?=[a-fA-F]*[0-9])[0-9a-fA-F]{8,})'
+    r')(?=[/;]|$)')
+
+SEGMENT_TEMPLATES = {
+    'uuid': '{uuid}',
+    'id': '{id}',
+    'hex': '{hex}',
+}
+
+
+def _replaceSegment(match):
+    return SEGMENT_TEMPLATES[match.lastgroup]
+
+
+class URLNormalizer:
+    """Map URLs to templates, so that per-URL data stays bounded
+
+    `patterns` is a sequence of (regex, template) pairs, the template of the
+    first regex matching the URL (without query string) wins.  The regexes
+    take no flags, use `(?iLmsux)`.  Other URLs get their path, without
+    the scheme and host clients can vary, with numeric, UUID and hex
+    segments replaced by placeholders.
+
+    Results are cached, at most `maxSize` of them.
+    """
+
+    def __init__(self, patterns=(), maxSize=10000):
+        self.patterns = [(re.compile(regex), template)
+                         for regex, template in patterns]
+        self.maxSize = maxSize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def normalize(self, uri):
+        with self.lock:
+            try:
+                template = self.cache[uri]
+            except KeyError:
+                pass
+            else:
+                self.cache.move_to_end(uri)
+                return template
+
+        template = self.getTemplate(uri)
+
+        with self.lock:
+            self.cache[uri] = template
+            if len(self.cache) > self.maxSize:
+                self.cache.popitem(last=False)
+        return template
+
+    def getTemplate(self, uri):
+        """Compute the template of `uri`, bypassing the cache"""
+        uri = uri.split('?', 1)[0]
+        for pattern, template in self.patterns:
+            if pattern.match(uri):
+                return template
+        path = urlsplit(uri).path or '/'
+        return SEGMENT_RE.sub(_replaceSegment, path)
+
+
+def firstValue(header):
+    """Return the first, client side value of a comma separated header"""
+    if not header:
+        return None
+    return header.split(',', 1)[0].strip() or None
+
+
+def parseForwarded(header):
+    """Return the parameters of the first element of a RFC 7239 header"""
+    params = {}
+    element = firstValue(header)
+    if element is None:
+        return params
+    for pair in element.split(';'):
+        name, sep, value = pair.partition('=')
+        if sep:
+            params[name.strip().lower()] = value.strip().strip('"')
+    return params
+
+
+def stripPort(address):
+    """Strip the port from an IPv4 or bracketed IPv6 node address"""
+    if address.startswith('['):
+        return address[1:].split(']', 1)[0]
+    if address.count(':') == 1:
+        return address.split(':', 1)[0]
+    return address
+
+
+def reconstructURL(environ):
+    """Return the URL as the client requested it, before any proxies
+
+    Honours ``X-Original-URL``, RFC 7239 ``Forwarded`` and the
+    ``X-Forwarded-Proto/Host/Prefix`` headers.
+    """
+    original = environ.get('HTTP_X_ORIGINAL_URL')
+    if original and '://' in original:
+        return original
+
+    forwarded = parseForwarded(environ.get('HTTP_FORWARDED'))
+    proto = (forwarded.get('proto')
+             or firstValue(environ.get('HTTP_X_FORWARDED_PROTO')))
+    host = (forwarded.get('host')
+            or firstValue(environ.get('HTTP_X_FORWARDED_HOST')))
+    if proto or host:
+        environ = dict(environ)
+        if proto:
+            environ['wsgi.url_scheme'] = proto.lower()
+        if host:
+            environ['HTTP_HOST'] = host
+
+    script_name = environ.get('SCRIPT_NAME', '')
+    prefix = firstValue(environ.get('HTTP_X_FORWARDED_PREFIX'))
+    if prefix:
+        script_name = prefix.rstrip('/') + script_name
+
+    if original:
+        # a path, possibly with query string, as the proxy got it
+        path, _, query = original.partition('?')
+        return construct_url(environ, script_name='', path_info=path,
+                             querystring=query)
+    return construct_url(environ, script_name=script_name)
+
+
+def getClientIP(environ):
+    """Return the IP address of the client, before any proxies"""
+    client = parseForwarded(environ.get('HTTP_FORWARDED')).get('for')
+    if client is None:
+        client = firstValue(environ.get('HTTP_X_FORWARDED_FOR'))
+    if client is None:
+        return environ.get('REMOTE_ADDR')
+    return stripPort(client)